@@ -2,13 +2,15 @@ import sqlite3
 import os
 import logging
 import json
+import re
 import tempfile
 import shutil
 import time
 import secrets # For generating random codes
 import asyncio
+import threading
 from datetime import datetime, timedelta, timezone # <<< Added timezone import
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import math # Add math for pagination calculation
 from decimal import Decimal # Ensure Decimal is imported
 
@@ -28,8 +30,8 @@ import telegram.error as telegram_error
 
 # --- Local Imports ---
 from utils import (
-    CITIES, DISTRICTS, PRODUCT_TYPES, ADMIN_ID, LANGUAGES, THEMES,
-    BOT_MEDIA, SIZES, fetch_reviews, format_currency, send_message_with_retry,
+    CITIES, DISTRICTS, PRODUCT_TYPES, get_sorted_product_types, get_sorted_city_ids, get_sorted_district_ids, db_pool, download_file_streamed, get_file_cached, ADMIN_ID, LANGUAGES, THEMES,
+    BOT_MEDIA, SIZES, fetch_reviews, format_currency, cents_to_eur, send_message_with_retry,
     get_date_range, TOKEN, load_all_data, format_discount_value,
     SECONDARY_ADMIN_IDS,
     get_db_connection, MEDIA_DIR, BOT_MEDIA_JSON_PATH, # Import helpers/paths
@@ -143,6 +145,17 @@ logger = logging.getLogger(__name__)
 MEDIA_GROUP_COLLECTION_DELAY = 2.0 # Seconds to wait for more media in a group
 TEMPLATES_PER_PAGE = 5 # Pagination for welcome templates
 
+# --- Price Input Parsing ---
+# One pass over a price reply: a number with an optional '.'/',' decimal part and an optional €/eur suffix.
+# Unlike a bare float(), this rejects 'nan', 'inf' and exponent forms.
+# A decimal comma takes at most two digits, so a thousands separator ("1,000", "1,500€") is rejected, not read as 1.0 / 1.5
+_PRICE_RE = re.compile(r'^(\d+(?:\.\d+|,\d{1,2})?|\.\d+|,\d{1,2})\s*(?:€|eur|euro)?$', re.IGNORECASE)
+
+def _parse_price_text(price_text: str) -> float | None:
+    """Returns the price in a reply like '12.50', '12,5' or '12.50€', or None when it isn't one."""
+    m = _PRICE_RE.match(price_text.strip())
+    return float(m.group(1).replace(',', '.')) if m else None
+
 # --- Helper Function to Remove Existing Job ---
 def remove_job_if_exists(name: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Removes a job by name if it exists."""
@@ -157,6 +170,104 @@ def remove_job_if_exists(name: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
         logger.debug(f"Removed existing job: {name}")
     return True
 
+# --- Helper to Remove a Temp Media Dir ---
+def _remove_temp_dir(path: str) -> bool:
+    """Removes a temp media dir; returns whether it existed. Call via one asyncio.to_thread hop."""
+    if not os.path.exists(path): return False
+    shutil.rmtree(path, ignore_errors=True)
+    return True
+
+# --- Single Drop Flow user_data Keys ---
+# Swept on completion, error and cancel of the add-drop flow (admin and worker); module-level so the sweeps
+# don't rebuild the lists per call
+_DROP_PENDING_KEYS = ("state", "pending_drop", "pending_drop_size", "pending_drop_price")
+_DROP_LOCATION_KEYS = ("admin_city_id", "admin_district_id", "admin_product_type", "admin_city", "admin_district")
+_DROP_MEDIA_GROUP_KEYS = ("collecting_media_group_id", "collected_media")
+_DROP_REQUIRED_CONTEXT = ("admin_city", "admin_district", "admin_product_type", "pending_drop_size", "pending_drop_price")
+_BULK_SETUP_KEYS = ("state", "bulk_admin_city_id", "bulk_admin_district_id", "bulk_admin_product_type", "bulk_admin_city",
+                    "bulk_admin_district", "bulk_pending_drop_size", "bulk_pending_drop_price", "bulk_setup_summary")
+_BULK_TEMPLATE_KEYS = ("bulk_template", "bulk_drops")
+_BULK_MESSAGE_KEYS = ("bulk_messages", "bulk_processing_groups", "bulk_collected_media", "bulk_collecting_media_group_id")
+# Temp-file extension per stored media type; Telegram sends animations as MP4, "animation" comes from bulk messages
+_MEDIA_EXTENSIONS = {"photo": ".jpg", "video": ".mp4", "gif": ".mp4", "animation": ".gif"}
+
+def _missing_fields(**fields) -> list:
+    """Names of the given fields that are None or an empty string (0 and other falsy values count as set)."""
+    return [name for name, value in fields.items() if value is None or value == ""]
+
+# Cancel keyboards of the size/price prompts never change, so one markup each is shared by every prompt
+_CANCEL_ADD_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel Add", callback_data="cancel_add")]])
+_CANCEL_BULK_ADD_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel Bulk Add", callback_data="cancel_bulk_add")]])
+
+# Location/type/size/price block shown on the bulk setup, collection status and confirmation screens
+_BULK_SETUP_TMPL = "📍 Location: {city} / {district}\n{emoji} Type: {p_type}\n📏 Size: {size}\n💰 Price: {price}€\n\n"
+
+def _bulk_setup_summary(user_data) -> str:
+    """
+    The filled-in _BULK_SETUP_TMPL for the current bulk session. Built once when the price is set (the setup
+    can't change after that) and kept in user_data, so each collected message's status render reuses it.
+    """
+    summary = user_data.get("bulk_setup_summary")
+    if summary is None:
+        p_type = user_data.get("bulk_admin_product_type", "")
+        summary = user_data["bulk_setup_summary"] = _BULK_SETUP_TMPL.format(
+            city=user_data.get("bulk_admin_city", ""), district=user_data.get("bulk_admin_district", ""),
+            emoji=PRODUCT_TYPES.get(p_type, DEFAULT_PRODUCT_EMOJI), p_type=p_type,
+            size=user_data.get("bulk_pending_drop_size", ""), price=format_currency(user_data.get("bulk_pending_drop_price", 0)))
+    return summary
+
+BULK_MEDIA_DOWNLOAD_CONCURRENCY = 8 # Concurrent Telegram downloads while executing a message-based bulk add
+
+# --- Persisted Media Cache ---
+# Telegram file_id -> a copy already saved under MEDIA_DIR. Adding media that is already on disk again (e.g.
+# "Add Another Same Type" with the same photos) copies the local file instead of get_file + a fresh download.
+MEDIA_PATH_CACHE_MAX = 1024
+_media_path_cache: OrderedDict = OrderedDict()
+_media_path_cache_lock = threading.Lock() # Filled from the to_thread DB helpers
+
+def _remember_media_path(file_id: str, path: str):
+    with _media_path_cache_lock:
+        _media_path_cache[file_id] = path
+        _media_path_cache.move_to_end(file_id)
+        if len(_media_path_cache) > MEDIA_PATH_CACHE_MAX: _media_path_cache.popitem(last=False)
+
+def _cached_media_path(file_id: str) -> str | None:
+    with _media_path_cache_lock:
+        path = _media_path_cache.get(file_id)
+        if path: _media_path_cache.move_to_end(file_id)
+        return path
+
+def _copy_media_file(src_path: str, dest_path: str):
+    """
+    Copies a media file in the kernel: copy_file_range (a reflink on btrfs/xfs) where available, otherwise
+    shutil.copyfile, which uses sendfile on Linux. Media needs no copied metadata, unlike copy2.
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+                remaining = os.fstat(src.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dest.fileno(), remaining)
+                    if copied == 0: break
+                    remaining -= copied
+            if remaining <= 0: return
+        except OSError: pass # e.g. not supported by this filesystem pair; fall through to copyfile
+    shutil.copyfile(src_path, dest_path)
+
+def _link_or_copy(src_path: str, dest_path: str):
+    """Hard-links src_path to dest_path, copying instead where links aren't supported (e.g. across filesystems)."""
+    try: os.link(src_path, dest_path)
+    except OSError: _copy_media_file(src_path, dest_path)
+
+def _copy_cached_media(file_id: str, cached_path: str, dest_path: str) -> bool:
+    """Hard-links (or copies) a cached media file to dest_path. Drops the entry and returns False if the copy is gone."""
+    try:
+        _link_or_copy(cached_path, dest_path)
+        return True
+    except OSError:
+        with _media_path_cache_lock: _media_path_cache.pop(file_id, None)
+        return False
+
 # --- Helper to Prepare and Confirm Drop (Handles Download) ---
 async def _prepare_and_confirm_drop(
     context: ContextTypes.DEFAULT_TYPE,
@@ -167,12 +278,10 @@ async def _prepare_and_confirm_drop(
     collected_media_info: list
     ):
     """Downloads media (if any) and presents the confirmation message."""
-    required_context = ["admin_city", "admin_district", "admin_product_type", "pending_drop_size", "pending_drop_price"]
-    if not all(k in user_data for k in required_context):
+    if not all(k in user_data for k in _DROP_REQUIRED_CONTEXT):
         logger.error(f"_prepare_and_confirm_drop: Context lost for user {user_id}.")
         await send_message_with_retry(context.bot, chat_id, "❌ Error: Context lost. Please start adding product again.", parse_mode=None)
-        keys_to_clear = ["state", "pending_drop", "pending_drop_size", "pending_drop_price", "collecting_media_group_id", "collected_media"]
-        for key in keys_to_clear: user_data.pop(key, None)
+        for key in _DROP_PENDING_KEYS + _DROP_MEDIA_GROUP_KEYS: user_data.pop(key, None)
         return
 
     temp_dir = None
@@ -183,32 +292,43 @@ async def _prepare_and_confirm_drop(
         try:
             temp_dir = await asyncio.to_thread(tempfile.mkdtemp)
             logger.info(f"Created temp dir for media download: {temp_dir} (User: {user_id})")
-            for i, media_info in enumerate(collected_media_info):
+            total = len(collected_media_info)
+
+            async def _download(i: int, media_info: dict) -> dict | None:
                 media_type = media_info['type']
                 file_id = media_info['file_id']
-                file_extension = ".jpg" if media_type == "photo" else ".mp4" if media_type in ["video", "gif"] else ".dat"
+                file_extension = _MEDIA_EXTENSIONS.get(media_type, ".dat")
                 temp_file_path = os.path.join(temp_dir, f"{file_id}{file_extension}")
                 try:
-                    logger.info(f"Downloading media {i+1}/{len(collected_media_info)} ({file_id}) to {temp_file_path}")
-                    file_obj = await context.bot.get_file(file_id)
-                    await file_obj.download_to_drive(custom_path=temp_file_path)
-                    if not await asyncio.to_thread(os.path.exists, temp_file_path) or await asyncio.to_thread(os.path.getsize, temp_file_path) == 0:
+                    cached_path = _cached_media_path(file_id)
+                    if cached_path and await asyncio.to_thread(_copy_cached_media, file_id, cached_path, temp_file_path):
+                        logger.info(f"Media {i+1}/{total} ({file_id}) reused from {cached_path}")
+                    else:
+                        logger.info(f"Downloading media {i+1}/{total} ({file_id}) to {temp_file_path}")
+                        file_obj = await get_file_cached(context.bot, file_id)
+                        await download_file_streamed(file_obj, temp_file_path)
+                    # getsize raises OSError for a missing file, so one thread hop covers both checks
+                    if await asyncio.to_thread(os.path.getsize, temp_file_path) == 0:
                         raise IOError(f"Downloaded file {temp_file_path} is missing or empty.")
-                    media_list_for_db.append({"type": media_type, "path": temp_file_path, "file_id": file_id})
                     logger.info(f"Media download {i+1} successful.")
+                    return {"type": media_type, "path": temp_file_path, "file_id": file_id}
                 except (telegram_error.TelegramError, IOError, OSError) as e:
                     logger.error(f"Error downloading/verifying media {i+1} ({file_id}): {e}")
-                    download_errors += 1
                 except Exception as e:
                     logger.error(f"Unexpected error downloading media {i+1} ({file_id}): {e}", exc_info=True)
-                    download_errors += 1
+                return None
+
+            # Downloads run concurrently; gather keeps the album order for the media rows
+            results = await asyncio.gather(*(_download(i, m) for i, m in enumerate(collected_media_info)))
+            media_list_for_db = [r for r in results if r is not None]
+            download_errors = total - len(media_list_for_db)
             if download_errors > 0:
                 await send_message_with_retry(context.bot, chat_id, f"⚠️ Warning: {download_errors} media file(s) failed to download. Adding drop with successfully downloaded media only.", parse_mode=None)
         except Exception as e:
              logger.error(f"Error setting up/during media download loop user {user_id}: {e}", exc_info=True)
              await send_message_with_retry(context.bot, chat_id, "⚠️ Warning: Error during media processing. Drop will be added without media.", parse_mode=None)
              media_list_for_db = []
-             if temp_dir and await asyncio.to_thread(os.path.exists, temp_dir): await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True); temp_dir = None
+             if temp_dir: await asyncio.to_thread(_remove_temp_dir, temp_dir); temp_dir = None
 
     user_data["pending_drop"] = {
         "city": user_data["admin_city"], "district": user_data["admin_district"],
@@ -296,12 +416,10 @@ async def handle_adm_drop_details_message(update: Update, context: ContextTypes.
         logger.debug(f"Ignoring drop details message from user {user_id}, state is not 'awaiting_drop_details' (state: {user_specific_data.get('state')})")
         return
 
-    required_context = ["admin_city", "admin_district", "admin_product_type", "pending_drop_size", "pending_drop_price"]
-    if not all(k in user_specific_data for k in required_context):
+    if not all(k in user_specific_data for k in _DROP_REQUIRED_CONTEXT):
         logger.warning(f"Context lost for user {user_id} before processing drop details.")
         await send_message_with_retry(context.bot, chat_id, "❌ Error: Context lost. Please start adding product again.", parse_mode=None)
-        keys_to_clear = ["state", "pending_drop", "pending_drop_size", "pending_drop_price", "collecting_media_group_id", "collected_media"]
-        for key in keys_to_clear: user_specific_data.pop(key, None)
+        for key in _DROP_PENDING_KEYS + _DROP_MEDIA_GROUP_KEYS: user_specific_data.pop(key, None)
         return
 
     media_group_id = update.message.media_group_id
@@ -316,23 +434,19 @@ async def handle_adm_drop_details_message(update: Update, context: ContextTypes.
 
     if media_group_id:
         logger.debug(f"Received message part of media group {media_group_id} from user {user_id}")
-        if 'collected_media' not in user_specific_data:
-            user_specific_data['collected_media'] = {}
-
-        if media_group_id not in user_specific_data['collected_media']:
-            user_specific_data['collected_media'][media_group_id] = {'media': [], 'caption': None}
+        collected_media = user_specific_data.setdefault('collected_media', {})
+        group = collected_media.get(media_group_id)
+        if group is None:
+            group = collected_media[media_group_id] = {'media': [], 'caption': None}
             logger.info(f"Started collecting media for group {media_group_id} user {user_id}")
             user_specific_data['collecting_media_group_id'] = media_group_id
 
-        if media_type and file_id:
-            if not any(m['file_id'] == file_id for m in user_specific_data['collected_media'][media_group_id]['media']):
-                user_specific_data['collected_media'][media_group_id]['media'].append(
-                    {'type': media_type, 'file_id': file_id}
-                )
-                logger.debug(f"Added media {file_id} ({media_type}) to group {media_group_id}")
+        if media_type and file_id and not any(m['file_id'] == file_id for m in group['media']):
+            group['media'].append({'type': media_type, 'file_id': file_id})
+            logger.debug(f"Added media {file_id} ({media_type}) to group {media_group_id}")
 
         if text:
-             user_specific_data['collected_media'][media_group_id]['caption'] = text
+             group['caption'] = text
              logger.debug(f"Stored/updated caption for group {media_group_id}")
 
         remove_job_if_exists(job_name, context)
@@ -358,9 +472,7 @@ async def handle_adm_drop_details_message(update: Update, context: ContextTypes.
         user_specific_data.pop('collecting_media_group_id', None)
         user_specific_data.pop('collected_media', None)
 
-        single_media_info = []
-        if media_type and file_id:
-            single_media_info.append({'type': media_type, 'file_id': file_id})
+        single_media_info = [{'type': media_type, 'file_id': file_id}] if media_type and file_id else []
 
         await _prepare_and_confirm_drop(context, user_specific_data, chat_id, user_id, text, single_media_info)
 
@@ -405,8 +517,8 @@ async def handle_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE,
         c = conn.cursor()
         c.execute("SELECT COUNT(*) as count FROM users")
         res_users = c.fetchone(); total_users = res_users['count'] if res_users else 0
-        c.execute("SELECT COALESCE(SUM(balance), 0.0) as total_bal FROM users")
-        res_balance = c.fetchone(); total_user_balance = Decimal(str(res_balance['total_bal'])) if res_balance else Decimal('0.0')
+        c.execute("SELECT COALESCE(SUM(balance_cents), 0) as total_bal_cents FROM users")
+        res_balance = c.fetchone(); total_user_balance = cents_to_eur(res_balance['total_bal_cents']) if res_balance else Decimal('0.0')
         c.execute("SELECT COUNT(*) as count FROM products WHERE available > reserved")
         res_products = c.fetchone(); active_products = res_products['count'] if res_products else 0
         c.execute("SELECT COALESCE(SUM(price_paid), 0.0) as total_sales FROM purchases")
@@ -650,7 +762,7 @@ async def handle_adm_city(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
     lang, lang_data = _get_lang_data(context) # Use helper
     if not CITIES:
         return await query.edit_message_text("No cities configured. Please add a city first via 'Manage Cities'.", parse_mode=None)
-    sorted_city_ids = sorted(CITIES.keys(), key=lambda city_id: CITIES.get(city_id, ''))
+    sorted_city_ids = get_sorted_city_ids()
     keyboard = [[InlineKeyboardButton(f"🏙️ {CITIES.get(c,'N/A')}", callback_data=f"adm_dist|{c}")] for c in sorted_city_ids]
     keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data="admin_menu")])
     select_city_text = lang_data.get("admin_select_city", "Select City to Add Product:")
@@ -672,13 +784,8 @@ async def handle_adm_dist(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
         keyboard = [[InlineKeyboardButton("⬅️ Back to Cities", callback_data="adm_city")]]
         return await query.edit_message_text(f"No districts found for {city_name}. Please add districts via 'Manage Districts'.",
                                 reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-    sorted_district_ids = sorted(districts_in_city.keys(), key=lambda dist_id: districts_in_city.get(dist_id,''))
-    keyboard = []
-    for d in sorted_district_ids:
-        dist_name = districts_in_city.get(d)
-        if dist_name:
-            keyboard.append([InlineKeyboardButton(f"🏘️ {dist_name}", callback_data=f"adm_type|{city_id}|{d}")])
-        else: logger.warning(f"District name missing for ID {d} in city {city_id}")
+    sorted_district_ids = get_sorted_district_ids(city_id)
+    keyboard = [[InlineKeyboardButton(f"🏘️ {districts_in_city[d]}", callback_data=f"adm_type|{city_id}|{d}")] for d in sorted_district_ids if d in districts_in_city]
     keyboard.append([InlineKeyboardButton("⬅️ Back to Cities", callback_data="adm_city")])
     select_district_text = select_district_template.format(city=city_name)
     await query.edit_message_text(select_district_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
@@ -698,10 +805,7 @@ async def handle_adm_type(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
     if not PRODUCT_TYPES:
         return await query.edit_message_text("No product types configured. Add types via 'Manage Product Types'.", parse_mode=None)
 
-    keyboard = []
-    for type_name, emoji in sorted(PRODUCT_TYPES.items()):
-        keyboard.append([InlineKeyboardButton(f"{emoji} {type_name}", callback_data=f"adm_add|{city_id}|{dist_id}|{type_name}")])
-
+    keyboard = [[InlineKeyboardButton(f"{emoji} {type_name}", callback_data=f"adm_add|{city_id}|{dist_id}|{type_name}")] for type_name, emoji in get_sorted_product_types()]
     keyboard.append([InlineKeyboardButton("⬅️ Back to Districts", callback_data=f"adm_dist|{city_id}")])
     await query.edit_message_text(select_type_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
@@ -737,9 +841,8 @@ async def handle_adm_size(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
         return await query.edit_message_text("❌ Error: Context lost. Please start adding the product again.", parse_mode=None)
     context.user_data["pending_drop_size"] = size
     context.user_data["state"] = "awaiting_price"
-    keyboard = [[InlineKeyboardButton("❌ Cancel Add", callback_data="cancel_add")]]
     await query.edit_message_text(f"Size set to {size}. Please reply with the price (e.g., 12.50 or 12.5):",
-                            reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+                            reply_markup=_CANCEL_ADD_MARKUP, parse_mode=None)
     await query.answer("Enter price in chat.")
 
 async def handle_adm_custom_size(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
@@ -749,17 +852,87 @@ async def handle_adm_custom_size(update: Update, context: ContextTypes.DEFAULT_T
     if not all(k in context.user_data for k in ["admin_city", "admin_district", "admin_product_type"]):
         return await query.edit_message_text("❌ Error: Context lost. Please start adding the product again.", parse_mode=None)
     context.user_data["state"] = "awaiting_custom_size"
-    keyboard = [[InlineKeyboardButton("❌ Cancel Add", callback_data="cancel_add")]]
     await query.edit_message_text("Please reply with the custom size (e.g., 10g, 1/4 oz):",
-                            reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+                            reply_markup=_CANCEL_ADD_MARKUP, parse_mode=None)
     await query.answer("Enter custom size in chat.")
 
+_PRODUCT_INSERT_SQL = """INSERT INTO products
+                (city, district, product_type, size, name, price, available, reserved, original_text, added_by, added_date)
+             VALUES (?, ?, ?, ?, ?, ?, 1, 0, ?, ?, ?) RETURNING id"""
+_PRODUCT_MEDIA_INSERT_SQL = "INSERT INTO product_media (product_id, media_type, file_path, telegram_file_id) VALUES (?, ?, ?, ?)"
+MEDIA_INDEX_REBUILD_MIN_ROWS = 500 # Bulk media batches above this may rebuild the product_id index instead of maintaining it
+
+def _insert_bulk_product_media(c, media_inserts: list):
+    """
+    Inserts product_media rows inside the caller's transaction. When the batch is over MEDIA_INDEX_REBUILD_MIN_ROWS
+    and outnumbers the rows already stored, idx_product_media_product_id is dropped and built once afterwards instead
+    of being updated per row; both happen in the same transaction, so readers never see the table without it.
+    """
+    rebuild_index = (len(media_inserts) > MEDIA_INDEX_REBUILD_MIN_ROWS and
+                     c.execute("SELECT COUNT(*) FROM product_media").fetchone()[0] < len(media_inserts))
+    if rebuild_index: c.execute("DROP INDEX IF EXISTS idx_product_media_product_id")
+    c.executemany(_PRODUCT_MEDIA_INSERT_SQL, media_inserts)
+    if rebuild_index: c.execute("CREATE INDEX IF NOT EXISTS idx_product_media_product_id ON product_media(product_id)")
+
+def _move_drop_media(product_id: int, media_list: list, copy: bool = False, linked: dict | None = None) -> list:
+    """
+    Moves (or copies, for bulk drops sharing one download) temp media into MEDIA_DIR/<product_id>. Returns product_media rows.
+    With copy, `linked` maps temp paths to their first persisted copy; later drops hard-link that copy instead of
+    writing the file again (falls back to copying where links aren't supported).
+    """
+    media_inserts = []
+    valid_items = []
+    for media_item in media_list:
+        if "path" in media_item and "type" in media_item and "file_id" in media_item: valid_items.append(media_item)
+        else: logger.warning(f"Incomplete media item: {media_item}")
+    if not valid_items: return media_inserts
+    final_media_dir = os.path.join(MEDIA_DIR, str(product_id)); os.makedirs(final_media_dir, exist_ok=True)
+    for media_item in valid_items:
+        temp_file_path = media_item["path"]
+        final_persistent_path = os.path.join(final_media_dir, os.path.basename(temp_file_path))
+        try:
+            if not copy: shutil.move(temp_file_path, final_persistent_path)
+            elif linked is not None and temp_file_path in linked:
+                try: os.link(linked[temp_file_path], final_persistent_path)
+                except OSError: _copy_media_file(temp_file_path, final_persistent_path) # from the temp copy, in case the linked one is gone
+            else:
+                _copy_media_file(temp_file_path, final_persistent_path)
+                if linked is not None: linked[temp_file_path] = final_persistent_path
+            media_inserts.append((product_id, media_item["type"], final_persistent_path, media_item["file_id"]))
+            _remember_media_path(media_item["file_id"], final_persistent_path)
+        except FileNotFoundError: logger.warning(f"Temp media not found: {temp_file_path}")
+        except OSError as move_err: logger.error(f"Error {'copying' if copy else 'moving'} media {temp_file_path}: {move_err}")
+    return media_inserts
+
+def _add_product_sync(city: str, district: str, p_type: str, size: str, product_name: str, price, original_text: str, media_list: list) -> int:
+    """Inserts one confirmed drop and its media on a pooled connection, in one transaction. Returns the new product id."""
+    with db_pool.acquire() as conn, conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        product_id = c.execute(_PRODUCT_INSERT_SQL, (
+            city, district, p_type, size, product_name, price, original_text, ADMIN_ID, datetime.now(timezone.utc).isoformat()
+        )).fetchone()['id']
+        media_inserts = _move_drop_media(product_id, media_list) if media_list else []
+        if media_inserts: c.executemany(_PRODUCT_MEDIA_INSERT_SQL, media_inserts)
+    return product_id
+
+# (chat_id, message_id) of drop confirmations already being handled or done. A double tap on "Yes" delivers two
+# callbacks for the same confirmation message; only the first may insert. Only touched from the event loop.
+_CONFIRMED_DROP_MESSAGES: OrderedDict = OrderedDict()
+_CONFIRMED_DROP_MESSAGES_MAX = 1024
+
 async def handle_confirm_add_drop(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles confirmation (Yes/No) for adding the drop."""
     query = update.callback_query
     user_id = query.from_user.id
     if user_id != ADMIN_ID: return await query.answer("Access denied.", show_alert=True)
     chat_id = query.message.chat_id
+    confirm_key = (chat_id, query.message.message_id)
+    if confirm_key in _CONFIRMED_DROP_MESSAGES:
+        logger.info(f"Ignoring repeated drop confirmation from user {user_id} (message {confirm_key[1]}).")
+        return await query.answer("This drop is already being added.")
+    _CONFIRMED_DROP_MESSAGES[confirm_key] = None
+    if len(_CONFIRMED_DROP_MESSAGES) > _CONFIRMED_DROP_MESSAGES_MAX: _CONFIRMED_DROP_MESSAGES.popitem(last=False)
     user_specific_data = context.user_data # Use context.user_data for the admin's data
     pending_drop = user_specific_data.get("pending_drop")
 
@@ -772,40 +945,19 @@ async def handle_confirm_add_drop(update: Update, context: ContextTypes.DEFAULT_
     size = pending_drop.get("size"); price = pending_drop.get("price"); original_text = pending_drop.get("original_text", "")
     media_list = pending_drop.get("media", []); temp_dir = pending_drop.get("temp_dir")
 
-    if not all([city, district, p_type, size, price is not None]):
-        logger.error(f"Missing data in pending_drop for user {user_id}: {pending_drop}")
-        if temp_dir and await asyncio.to_thread(os.path.exists, temp_dir): await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
-        keys_to_clear = ["state", "pending_drop", "pending_drop_size", "pending_drop_price", "admin_city_id", "admin_district_id", "admin_product_type", "admin_city", "admin_district"]
-        for key in keys_to_clear: user_specific_data.pop(key, None)
+    missing = _missing_fields(city=city, district=district, product_type=p_type, size=size, price=price)
+    if missing:
+        logger.error(f"Missing {', '.join(missing)} in pending_drop for user {user_id}: {pending_drop}")
+        if temp_dir: await asyncio.to_thread(_remove_temp_dir, temp_dir)
+        for key in _DROP_PENDING_KEYS + _DROP_LOCATION_KEYS: user_specific_data.pop(key, None)
         return await query.edit_message_text("❌ Error: Incomplete drop data. Please start again.", parse_mode=None)
 
-    product_name = f"{p_type} {size} {int(time.time())}"; conn = None; product_id = None
+    product_name = f"{p_type} {size} {int(time.time())}"
     try:
-        conn = get_db_connection(); c = conn.cursor(); c.execute("BEGIN")
-        insert_params = (
-            city, district, p_type, size, product_name, price, original_text, ADMIN_ID, datetime.now(timezone.utc).isoformat()
-        )
-        logger.debug(f"Inserting product with params count: {len(insert_params)}") # Add debug log
-        c.execute("""INSERT INTO products
-                        (city, district, product_type, size, name, price, available, reserved, original_text, added_by, added_date)
-                     VALUES (?, ?, ?, ?, ?, ?, 1, 0, ?, ?, ?)""", insert_params)
-        product_id = c.lastrowid
-
-        if product_id and media_list and temp_dir:
-            final_media_dir = os.path.join(MEDIA_DIR, str(product_id)); await asyncio.to_thread(os.makedirs, final_media_dir, exist_ok=True); media_inserts = []
-            for media_item in media_list:
-                if "path" in media_item and "type" in media_item and "file_id" in media_item:
-                    temp_file_path = media_item["path"]
-                    if await asyncio.to_thread(os.path.exists, temp_file_path):
-                        new_filename = os.path.basename(temp_file_path); final_persistent_path = os.path.join(final_media_dir, new_filename)
-                        try: await asyncio.to_thread(shutil.move, temp_file_path, final_persistent_path); media_inserts.append((product_id, media_item["type"], final_persistent_path, media_item["file_id"]))
-                        except OSError as move_err: logger.error(f"Error moving media {temp_file_path}: {move_err}")
-                    else: logger.warning(f"Temp media not found: {temp_file_path}")
-                else: logger.warning(f"Incomplete media item: {media_item}")
-            if media_inserts: c.executemany("INSERT INTO product_media (product_id, media_type, file_path, telegram_file_id) VALUES (?, ?, ?, ?)", media_inserts)
-
-        conn.commit(); logger.info(f"Added product {product_id} ({product_name}).")
-        if temp_dir and await asyncio.to_thread(os.path.exists, temp_dir): await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True); logger.info(f"Cleaned temp dir: {temp_dir}")
+        # Insert, media move and commit run in one worker-thread hop so the event loop keeps serving other users
+        product_id = await asyncio.to_thread(_add_product_sync, city, district, p_type, size, product_name, price, original_text, media_list if temp_dir else [])
+        logger.info(f"Added product {product_id} ({product_name}).")
+        if temp_dir and await asyncio.to_thread(_remove_temp_dir, temp_dir): logger.info(f"Cleaned temp dir: {temp_dir}")
         await query.edit_message_text("✅ Drop Added Successfully!", parse_mode=None)
         
         # Check if this is a worker operation
@@ -822,15 +974,11 @@ async def handle_confirm_add_drop(update: Update, context: ContextTypes.DEFAULT_
                          [InlineKeyboardButton("🔧 Admin Menu", callback_data="admin_menu"), InlineKeyboardButton("🏠 User Home", callback_data="back_start")] ]
         await send_message_with_retry(context.bot, chat_id, "What next?", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
     except (sqlite3.Error, OSError, Exception) as e:
-        try: conn.rollback() if conn and conn.in_transaction else None
-        except Exception as rb_err: logger.error(f"Rollback failed: {rb_err}")
         logger.error(f"Error saving confirmed drop for user {user_id}: {e}", exc_info=True)
         await query.edit_message_text("❌ Error: Failed to save the drop. Please check logs and try again.", parse_mode=None)
-        if temp_dir and await asyncio.to_thread(os.path.exists, temp_dir): await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True); logger.info(f"Cleaned temp dir after error: {temp_dir}")
+        if temp_dir and await asyncio.to_thread(_remove_temp_dir, temp_dir): logger.info(f"Cleaned temp dir after error: {temp_dir}")
     finally:
-        if conn: conn.close()
-        keys_to_clear = ["state", "pending_drop", "pending_drop_size", "pending_drop_price"]
-        for key in keys_to_clear: user_specific_data.pop(key, None)
+        for key in _DROP_PENDING_KEYS: user_specific_data.pop(key, None)
 
 
 async def cancel_add(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
@@ -841,14 +989,12 @@ async def cancel_add(update: Update, context: ContextTypes.DEFAULT_TYPE, params=
     pending_drop = user_specific_data.get("pending_drop")
     if pending_drop and "temp_dir" in pending_drop and pending_drop["temp_dir"]:
         temp_dir_path = pending_drop["temp_dir"]
-        if await asyncio.to_thread(os.path.exists, temp_dir_path):
-            try: await asyncio.to_thread(shutil.rmtree, temp_dir_path, ignore_errors=True); logger.info(f"Cleaned temp dir on cancel: {temp_dir_path}")
-            except Exception as e: logger.error(f"Error cleaning temp dir {temp_dir_path}: {e}")
-    keys_to_clear = ["state", "pending_drop", "pending_drop_size", "pending_drop_price", "admin_city_id", "admin_district_id", "admin_product_type", "admin_city", "admin_district", "collecting_media_group_id", "collected_media"]
-    for key in keys_to_clear: user_specific_data.pop(key, None)
-    if 'collecting_media_group_id' in user_specific_data:
-        media_group_id = user_specific_data.pop('collecting_media_group_id', None)
-        if media_group_id: job_name = f"process_media_group_{user_id}_{media_group_id}"; remove_job_if_exists(job_name, context)
+        try:
+            if await asyncio.to_thread(_remove_temp_dir, temp_dir_path): logger.info(f"Cleaned temp dir on cancel: {temp_dir_path}")
+        except Exception as e: logger.error(f"Error cleaning temp dir {temp_dir_path}: {e}")
+    media_group_id = user_specific_data.get('collecting_media_group_id') # Read before the sweep drops it
+    for key in _DROP_PENDING_KEYS + _DROP_LOCATION_KEYS + _DROP_MEDIA_GROUP_KEYS: user_specific_data.pop(key, None)
+    if media_group_id: job_name = f"process_media_group_{user_id}_{media_group_id}"; remove_job_if_exists(job_name, context)
     if query:
          try:
              await query.edit_message_text("❌ Add Product Cancelled", parse_mode=None)
@@ -870,7 +1016,7 @@ async def handle_adm_bulk_city(update: Update, context: ContextTypes.DEFAULT_TYP
     lang, lang_data = _get_lang_data(context) # Use helper
     if not CITIES:
         return await query.edit_message_text("No cities configured. Please add a city first via 'Manage Cities'.", parse_mode=None)
-    sorted_city_ids = sorted(CITIES.keys(), key=lambda city_id: CITIES.get(city_id, ''))
+    sorted_city_ids = get_sorted_city_ids()
     keyboard = [[InlineKeyboardButton(f"🏙️ {CITIES.get(c,'N/A')}", callback_data=f"adm_bulk_dist|{c}")] for c in sorted_city_ids]
     keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data="admin_menu")])
     select_city_text = lang_data.get("admin_select_city", "Select City to Add Bulk Products:")
@@ -892,13 +1038,8 @@ async def handle_adm_bulk_dist(update: Update, context: ContextTypes.DEFAULT_TYP
         keyboard = [[InlineKeyboardButton("⬅️ Back to Cities", callback_data="adm_bulk_city")]]
         return await query.edit_message_text(f"No districts found for {city_name}. Please add districts via 'Manage Districts'.",
                                 reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-    sorted_district_ids = sorted(districts_in_city.keys(), key=lambda d_id: districts_in_city.get(d_id,''))
-    keyboard = []
-    for d in sorted_district_ids:
-        dist_name = districts_in_city.get(d)
-        if dist_name:
-            keyboard.append([InlineKeyboardButton(f"🏘️ {dist_name}", callback_data=f"adm_bulk_type|{city_id}|{d}")])
-        else: logger.warning(f"District name missing for ID {d} in city {city_id}")
+    sorted_district_ids = get_sorted_district_ids(city_id)
+    keyboard = [[InlineKeyboardButton(f"🏘️ {districts_in_city[d]}", callback_data=f"adm_bulk_type|{city_id}|{d}")] for d in sorted_district_ids if d in districts_in_city]
     keyboard.append([InlineKeyboardButton("⬅️ Back to Cities", callback_data="adm_bulk_city")])
     select_district_text = select_district_template.format(city=city_name)
     await query.edit_message_text(select_district_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
@@ -918,10 +1059,7 @@ async def handle_adm_bulk_type(update: Update, context: ContextTypes.DEFAULT_TYP
     if not PRODUCT_TYPES:
         return await query.edit_message_text("No product types configured. Add types via 'Manage Product Types'.", parse_mode=None)
 
-    keyboard = []
-    for type_name, emoji in sorted(PRODUCT_TYPES.items()):
-        keyboard.append([InlineKeyboardButton(f"{emoji} {type_name}", callback_data=f"adm_bulk_add|{city_id}|{dist_id}|{type_name}")])
-
+    keyboard = [[InlineKeyboardButton(f"{emoji} {type_name}", callback_data=f"adm_bulk_add|{city_id}|{dist_id}|{type_name}")] for type_name, emoji in get_sorted_product_types()]
     keyboard.append([InlineKeyboardButton("⬅️ Back to Districts", callback_data=f"adm_bulk_dist|{city_id}")])
     await query.edit_message_text(f"📦 Bulk Add Products - {city_name} / {district_name}\n\n{select_type_text}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
@@ -959,9 +1097,8 @@ async def handle_adm_bulk_size(update: Update, context: ContextTypes.DEFAULT_TYP
         return await query.edit_message_text("❌ Error: Context lost. Please start adding the bulk products again.", parse_mode=None)
     context.user_data["bulk_pending_drop_size"] = size
     context.user_data["state"] = "awaiting_bulk_price"
-    keyboard = [[InlineKeyboardButton("❌ Cancel Bulk Add", callback_data="cancel_bulk_add")]]
     await query.edit_message_text(f"📦 Bulk Products - Size set to {size}. Please reply with the price (e.g., 12.50 or 12.5):",
-                            reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+                            reply_markup=_CANCEL_BULK_ADD_MARKUP, parse_mode=None)
     await query.answer("Enter price in chat.")
 
 async def handle_adm_bulk_custom_size(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
@@ -971,9 +1108,8 @@ async def handle_adm_bulk_custom_size(update: Update, context: ContextTypes.DEFA
     if not all(k in context.user_data for k in ["bulk_admin_city", "bulk_admin_district", "bulk_admin_product_type"]):
         return await query.edit_message_text("❌ Error: Context lost. Please start adding the bulk products again.", parse_mode=None)
     context.user_data["state"] = "awaiting_bulk_custom_size"
-    keyboard = [[InlineKeyboardButton("❌ Cancel Bulk Add", callback_data="cancel_bulk_add")]]
     await query.edit_message_text("📦 Bulk Products - Please reply with the custom size (e.g., 10g, 1/4 oz):",
-                            reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+                            reply_markup=_CANCEL_BULK_ADD_MARKUP, parse_mode=None)
     await query.answer("Enter custom size in chat.")
 
 async def handle_adm_bulk_custom_size_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -990,9 +1126,8 @@ async def handle_adm_bulk_custom_size_message(update: Update, context: ContextTy
 
     context.user_data["bulk_pending_drop_size"] = size
     context.user_data["state"] = "awaiting_bulk_price"
-    keyboard = [[InlineKeyboardButton("❌ Cancel Bulk Add", callback_data="cancel_bulk_add")]]
     await send_message_with_retry(context.bot, chat_id, f"📦 Bulk Products - Size set to: {size}\n\nPlease reply with the price (e.g., 12.50 or 12.5):",
-                            reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+                            reply_markup=_CANCEL_BULK_ADD_MARKUP, parse_mode=None)
 
 async def handle_adm_bulk_price_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles the price reply for bulk products."""
@@ -1003,8 +1138,8 @@ async def handle_adm_bulk_price_message(update: Update, context: ContextTypes.DE
     if context.user_data.get("state") != "awaiting_bulk_price": return
 
     price_text = update.message.text.strip()
-    try: price = float(price_text)
-    except ValueError: return await send_message_with_retry(context.bot, chat_id, "❌ Invalid price format. Please enter a number (e.g., 12.50).", parse_mode=None)
+    price = _parse_price_text(price_text)
+    if price is None: return await send_message_with_retry(context.bot, chat_id, "❌ Invalid price format. Please enter a number (e.g., 12.50).", parse_mode=None)
     if price <= 0: return await send_message_with_retry(context.bot, chat_id, "❌ Price must be greater than 0.", parse_mode=None)
     if price > 999999: return await send_message_with_retry(context.bot, chat_id, "❌ Price too high (max 999999).", parse_mode=None)
 
@@ -1013,19 +1148,10 @@ async def handle_adm_bulk_price_message(update: Update, context: ContextTypes.DE
     
     # Initialize bulk messages collection
     context.user_data["bulk_messages"] = []
-    
-    price_str = format_currency(price)
-    size = context.user_data.get("bulk_pending_drop_size", "")
-    p_type = context.user_data.get("bulk_admin_product_type", "")
-    city = context.user_data.get("bulk_admin_city", "")
-    district = context.user_data.get("bulk_admin_district", "")
-    type_emoji = PRODUCT_TYPES.get(p_type, DEFAULT_PRODUCT_EMOJI)
+    context.user_data.pop("bulk_setup_summary", None) # Rebuilt below for this session's setup
     
     msg = (f"📦 Bulk Products Setup Complete\n\n"
-           f"📍 Location: {city} / {district}\n"
-           f"{type_emoji} Type: {p_type}\n"
-           f"📏 Size: {size}\n"
-           f"💰 Price: {price_str}€\n\n"
+           f"{_bulk_setup_summary(context.user_data)}"
            f"Now forward or send up to 10 different messages. Each message can contain:\n"
            f"• Photos, videos, GIFs\n"
            f"• Text descriptions\n"
@@ -1115,15 +1241,8 @@ async def handle_adm_bulk_drop_details_message(update: Update, context: ContextT
         context.user_data.pop('bulk_collected_media', None)
 
         # Extract message content
-        message_data = {
-            "text": text,
-            "media": [],
-            "timestamp": int(time.time())
-        }
-
-        # Get media content for single message
-        if media_type and file_id:
-            message_data["media"].append({"type": media_type, "file_id": file_id})
+        media = [{"type": media_type, "file_id": file_id}] if media_type and file_id else []
+        message_data = {"text": text, "media": media}
 
         # Store the message
         bulk_messages.append(message_data)
@@ -1139,19 +1258,9 @@ async def show_bulk_messages_status(update: Update, context: ContextTypes.DEFAUL
     chat_id = update.effective_chat.id if update.effective_chat else update.message.chat_id
     
     bulk_messages = context.user_data.get("bulk_messages", [])
-    price = context.user_data.get("bulk_pending_drop_price", 0)
-    size = context.user_data.get("bulk_pending_drop_size", "")
-    p_type = context.user_data.get("bulk_admin_product_type", "")
-    city = context.user_data.get("bulk_admin_city", "")
-    district = context.user_data.get("bulk_admin_district", "")
-    type_emoji = PRODUCT_TYPES.get(p_type, DEFAULT_PRODUCT_EMOJI)
-    price_str = format_currency(price)
     
     msg = (f"📦 Bulk Products Collection\n\n"
-           f"📍 Location: {city} / {district}\n"
-           f"{type_emoji} Type: {p_type}\n"
-           f"📏 Size: {size}\n"
-           f"💰 Price: {price_str}€\n\n"
+           f"{_bulk_setup_summary(context.user_data)}"
            f"Messages collected: {len(bulk_messages)}/10\n\n")
     
     if not bulk_messages:
@@ -1231,21 +1340,17 @@ async def handle_adm_bulk_confirm_all(update: Update, context: ContextTypes.DEFA
     district = context.user_data.get("bulk_admin_district", "")
     p_type = context.user_data.get("bulk_admin_product_type", "")
     size = context.user_data.get("bulk_pending_drop_size", "")
-    price = context.user_data.get("bulk_pending_drop_price", 0)
+    price = context.user_data.get("bulk_pending_drop_price")
     
-    if not all([city, district, p_type, size, price]):
-        return await query.edit_message_text("❌ Error: Missing setup data. Please start again.", parse_mode=None)
+    missing = _missing_fields(city=city, district=district, product_type=p_type, size=size, price=price)
+    if missing:
+        logger.warning(f"Bulk confirmation for user {query.from_user.id} missing setup data: {', '.join(missing)}")
+        return await query.edit_message_text(f"❌ Error: Missing setup data ({', '.join(missing)}). Please start again.", parse_mode=None)
     
     # Show confirmation
-    type_emoji = PRODUCT_TYPES.get(p_type, DEFAULT_PRODUCT_EMOJI)
-    price_str = format_currency(price)
-    
     msg = f"⚠️ Confirm Bulk Creation\n\n"
     msg += f"You are about to create {len(bulk_messages)} products:\n\n"
-    msg += f"📍 Location: {city} / {district}\n"
-    msg += f"{type_emoji} Type: {p_type}\n"
-    msg += f"📏 Size: {size}\n"
-    msg += f"💰 Price: {price_str}€\n\n"
+    msg += _bulk_setup_summary(context.user_data)
     msg += f"Products to create:\n"
     for i, msg_data in enumerate(bulk_messages, 1):
         text_preview = msg_data.get("text", "")[:40]
@@ -1268,147 +1373,6 @@ async def handle_adm_bulk_confirm_all(update: Update, context: ContextTypes.DEFA
     
     await query.edit_message_text(msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
-async def handle_adm_bulk_execute(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
-    """Executes the bulk product creation."""
-    query = update.callback_query
-    if query.from_user.id != ADMIN_ID: return await query.answer("Access denied.", show_alert=True)
-    
-    chat_id = query.message.chat_id
-    bulk_template = context.user_data.get("bulk_template", {})
-    bulk_drops = context.user_data.get("bulk_drops", [])
-    
-    if not bulk_drops or not bulk_template:
-        return await query.edit_message_text("❌ Error: Missing bulk data. Please start again.", parse_mode=None)
-    
-    await query.edit_message_text("⏳ Creating bulk products...", parse_mode=None)
-    
-    p_type = bulk_template.get("product_type", "")
-    size = bulk_template.get("size", "")
-    price = bulk_template.get("price", 0)
-    original_text = bulk_template.get("original_text", "")
-    media_list = bulk_template.get("media", [])
-    
-    created_count = 0
-    failed_count = 0
-    
-    # Create a temporary directory for media if needed
-    temp_dir = None
-    if media_list:
-        import tempfile
-        temp_dir = await asyncio.to_thread(tempfile.mkdtemp, prefix="bulk_media_")
-        
-        # Download media to temp directory
-        for i, media_item in enumerate(media_list):
-            try:
-                file_obj = await context.bot.get_file(media_item["file_id"])
-                file_extension = os.path.splitext(file_obj.file_path)[1] if file_obj.file_path else ""
-                if not file_extension:
-                    if media_item["type"] == "photo": file_extension = ".jpg"
-                    elif media_item["type"] == "video": file_extension = ".mp4"
-                    elif media_item["type"] == "animation": file_extension = ".gif"
-                    else: file_extension = ".bin"
-                
-                temp_file_path = os.path.join(temp_dir, f"media_{i}_{int(time.time())}{file_extension}")
-                await file_obj.download_to_drive(temp_file_path)
-                media_item["path"] = temp_file_path
-            except Exception as e:
-                logger.error(f"Error downloading media for bulk operation: {e}")
-                failed_count += 1
-    
-    # Create products for each location
-    for drop in bulk_drops:
-        city = drop["city"]
-        district = drop["district"]
-        product_name = f"{p_type} {size} {int(time.time())}"
-        
-        conn = None
-        product_id = None
-        try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("BEGIN")
-            
-            insert_params = (
-                city, district, p_type, size, product_name, price, original_text, ADMIN_ID, datetime.now(timezone.utc).isoformat()
-            )
-            
-            c.execute("""INSERT INTO products
-                            (city, district, product_type, size, name, price, available, reserved, original_text, added_by, added_date)
-                         VALUES (?, ?, ?, ?, ?, ?, 1, 0, ?, ?, ?)""", insert_params)
-            product_id = c.lastrowid
-            
-            # Handle media for this product
-            if product_id and media_list and temp_dir:
-                final_media_dir = os.path.join(MEDIA_DIR, str(product_id))
-                await asyncio.to_thread(os.makedirs, final_media_dir, exist_ok=True)
-                
-                media_inserts = []
-                for media_item in media_list:
-                    if "path" in media_item and "type" in media_item and "file_id" in media_item:
-                        temp_file_path = media_item["path"]
-                        if await asyncio.to_thread(os.path.exists, temp_file_path):
-                            new_filename = os.path.basename(temp_file_path)
-                            final_persistent_path = os.path.join(final_media_dir, new_filename)
-                            try:
-                                # Copy instead of move so we can reuse for other products
-                                await asyncio.to_thread(shutil.copy2, temp_file_path, final_persistent_path)
-                                media_inserts.append((product_id, media_item["type"], final_persistent_path, media_item["file_id"]))
-                            except OSError as move_err:
-                                logger.error(f"Error copying media {temp_file_path}: {move_err}")
-                        else:
-                            logger.warning(f"Temp media not found: {temp_file_path}")
-                    else:
-                        logger.warning(f"Incomplete media item: {media_item}")
-                
-                if media_inserts:
-                    c.executemany("INSERT INTO product_media (product_id, media_type, file_path, telegram_file_id) VALUES (?, ?, ?, ?)", media_inserts)
-            
-            conn.commit()
-            created_count += 1
-            logger.info(f"Bulk created product {product_id} ({product_name}) in {city}/{district}")
-            
-        except Exception as e:
-            failed_count += 1
-            logger.error(f"Error creating bulk product in {city}/{district}: {e}", exc_info=True)
-            if conn:
-                try:
-                    conn.rollback()
-                except Exception as rb_err:
-                    logger.error(f"Rollback failed: {rb_err}")
-        finally:
-            if conn:
-                conn.close()
-    
-    # Clean up temp directory
-    if temp_dir and await asyncio.to_thread(os.path.exists, temp_dir):
-        await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
-        logger.info(f"Cleaned bulk temp dir: {temp_dir}")
-    
-    # Clear bulk data from context
-    keys_to_clear = ["bulk_template", "bulk_drops", "bulk_admin_city_id", "bulk_admin_district_id", 
-                     "bulk_admin_product_type", "bulk_admin_city", "bulk_admin_district", 
-                     "bulk_pending_drop_size", "bulk_pending_drop_price", "state"]
-    for key in keys_to_clear:
-        context.user_data.pop(key, None)
-    
-    # Show results
-    type_emoji = PRODUCT_TYPES.get(p_type, DEFAULT_PRODUCT_EMOJI)
-    result_msg = f"✅ Bulk Operation Complete!\n\n"
-    result_msg += f"{type_emoji} Product: {p_type} {size}\n"
-    result_msg += f"💰 Price: {format_currency(price)}€\n\n"
-    result_msg += f"📊 Results:\n"
-    result_msg += f"✅ Created: {created_count}\n"
-    if failed_count > 0:
-        result_msg += f"❌ Failed: {failed_count}\n"
-    
-    keyboard = [
-        [InlineKeyboardButton("📦 Add More Bulk Products", callback_data="adm_bulk_city")],
-        [InlineKeyboardButton("🔧 Admin Menu", callback_data="admin_menu"), 
-         InlineKeyboardButton("🏠 User Home", callback_data="back_start")]
-    ]
-    
-    await send_message_with_retry(context.bot, chat_id, result_msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-
 async def cancel_bulk_add(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Cancels the bulk add product flow and cleans up."""
     query = update.callback_query
@@ -1422,13 +1386,12 @@ async def cancel_bulk_add(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
             if "path" in media_item:
                 temp_file_path = media_item["path"]
                 temp_dir = os.path.dirname(temp_file_path)
-                if await asyncio.to_thread(os.path.exists, temp_dir):
-                    try:
-                        await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
+                try:
+                    if await asyncio.to_thread(_remove_temp_dir, temp_dir):
                         logger.info(f"Cleaned bulk temp dir on cancel: {temp_dir}")
                         break  # Only need to remove the directory once
-                    except Exception as e:
-                        logger.error(f"Error cleaning bulk temp dir {temp_dir}: {e}")
+                except Exception as e:
+                    logger.error(f"Error cleaning bulk temp dir {temp_dir}: {e}")
     
     # Cancel any scheduled bulk media group jobs
     if 'bulk_collecting_media_group_id' in user_specific_data:
@@ -1439,11 +1402,7 @@ async def cancel_bulk_add(update: Update, context: ContextTypes.DEFAULT_TYPE, pa
             logger.info(f"Cancelled bulk media group job: {job_name}")
     
     # Clear all bulk-related data
-    keys_to_clear = ["state", "bulk_template", "bulk_drops", "bulk_admin_city_id", "bulk_admin_district_id", 
-                     "bulk_admin_product_type", "bulk_admin_city", "bulk_admin_district", 
-                     "bulk_pending_drop_size", "bulk_pending_drop_price", "bulk_messages", "bulk_processing_groups",
-                     "bulk_collected_media", "bulk_collecting_media_group_id"]
-    for key in keys_to_clear:
+    for key in _BULK_SETUP_KEYS + _BULK_TEMPLATE_KEYS + _BULK_MESSAGE_KEYS:
         user_specific_data.pop(key, None)
     
     if query:
@@ -1474,7 +1433,7 @@ async def handle_adm_manage_cities(update: Update, context: ContextTypes.DEFAULT
          return await query.edit_message_text("No cities configured. Use 'Add New City'.", parse_mode=None,
                                  reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("➕ Add New City", callback_data="adm_add_city")],
                                                                       [InlineKeyboardButton("⬅️ Back to Admin Menu", callback_data="admin_menu")]]))
-    sorted_city_ids = sorted(CITIES.keys(), key=lambda city_id: CITIES.get(city_id, ''))
+    sorted_city_ids = get_sorted_city_ids()
     keyboard = []
     for c in sorted_city_ids:
         city_name = CITIES.get(c,'N/A')
@@ -1536,7 +1495,7 @@ async def handle_adm_manage_districts(update: Update, context: ContextTypes.DEFA
     if not CITIES:
          return await query.edit_message_text("No cities configured. Add a city first.", parse_mode=None,
                                  reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin Menu", callback_data="admin_menu")]]))
-    sorted_city_ids = sorted(CITIES.keys(), key=lambda city_id: CITIES.get(city_id,''))
+    sorted_city_ids = get_sorted_city_ids()
     keyboard = [[InlineKeyboardButton(f"🏙️ {CITIES.get(c, 'N/A')}", callback_data=f"adm_manage_districts_city|{c}")] for c in sorted_city_ids]
     keyboard.append([InlineKeyboardButton("⬅️ Back to Admin Menu", callback_data="admin_menu")])
     await query.edit_message_text("🗺️ Manage Districts\n\nSelect the city whose districts you want to manage:",
@@ -1569,7 +1528,7 @@ async def handle_adm_manage_districts_city(update: Update, context: ContextTypes
     keyboard = []
     if not districts_in_city: msg += "No districts found for this city."
     else:
-        sorted_district_ids = sorted(districts_in_city.keys(), key=lambda dist_id: districts_in_city.get(dist_id,''))
+        sorted_district_ids = sorted(districts_in_city, key=districts_in_city.__getitem__)
         for d_id in sorted_district_ids:
             dist_name = districts_in_city.get(d_id)
             if dist_name:
@@ -1669,7 +1628,7 @@ async def handle_adm_manage_products(update: Update, context: ContextTypes.DEFAU
     if not CITIES:
          return await query.edit_message_text("No cities configured. Add a city first.", parse_mode=None,
                                  reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Admin Menu", callback_data="admin_menu")]]))
-    sorted_city_ids = sorted(CITIES.keys(), key=lambda city_id: CITIES.get(city_id,''))
+    sorted_city_ids = get_sorted_city_ids()
     keyboard = [[InlineKeyboardButton(f"🏙️ {CITIES.get(c,'N/A')}", callback_data=f"adm_manage_products_city|{c}")] for c in sorted_city_ids]
     keyboard.append([InlineKeyboardButton("⬅️ Back to Admin Menu", callback_data="admin_menu")])
     await query.edit_message_text("🗑️ Manage Products\n\nSelect the city where the products are located:",
@@ -1690,13 +1649,8 @@ async def handle_adm_manage_products_city(update: Update, context: ContextTypes.
          keyboard = [[InlineKeyboardButton("⬅️ Back to Cities", callback_data="adm_manage_products")]]
          return await query.edit_message_text(f"No districts found for {city_name}. Cannot manage products.",
                                  reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-    sorted_district_ids = sorted(districts_in_city.keys(), key=lambda d_id: districts_in_city.get(d_id,''))
-    keyboard = []
-    for d in sorted_district_ids:
-         dist_name = districts_in_city.get(d)
-         if dist_name:
-             keyboard.append([InlineKeyboardButton(f"🏘️ {dist_name}", callback_data=f"adm_manage_products_dist|{city_id}|{d}")])
-         else: logger.warning(f"District name missing for ID {d} in city {city_id} (manage products)")
+    sorted_district_ids = get_sorted_district_ids(city_id)
+    keyboard = [[InlineKeyboardButton(f"🏘️ {districts_in_city[d]}", callback_data=f"adm_manage_products_dist|{city_id}|{d}")] for d in sorted_district_ids if d in districts_in_city]
     keyboard.append([InlineKeyboardButton("⬅️ Back to Cities", callback_data="adm_manage_products")])
     await query.edit_message_text(f"🗑️ Manage Products in {city_name}\n\nSelect district:",
                             reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
@@ -1723,11 +1677,7 @@ async def handle_adm_manage_products_dist(update: Update, context: ContextTypes.
              keyboard = [[InlineKeyboardButton("⬅️ Back to Districts", callback_data=f"adm_manage_products_city|{city_id}")]]
              return await query.edit_message_text(f"No product types found in {city_name} / {district_name}.",
                                      reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-        keyboard = []
-        for pt in product_types_in_dist:
-             emoji = PRODUCT_TYPES.get(pt, DEFAULT_PRODUCT_EMOJI)
-             keyboard.append([InlineKeyboardButton(f"{emoji} {pt}", callback_data=f"adm_manage_products_type|{city_id}|{dist_id}|{pt}")])
-
+        keyboard = [[InlineKeyboardButton(f"{PRODUCT_TYPES.get(pt, DEFAULT_PRODUCT_EMOJI)} {pt}", callback_data=f"adm_manage_products_type|{city_id}|{dist_id}|{pt}")] for pt in product_types_in_dist]
         keyboard.append([InlineKeyboardButton("⬅️ Back to Districts", callback_data=f"adm_manage_products_city|{city_id}")])
         await query.edit_message_text(f"🗑️ Manage Products in {city_name} / {district_name}\n\nSelect product type:",
                                 reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
@@ -1842,11 +1792,10 @@ async def handle_adm_manage_types(update: Update, context: ContextTypes.DEFAULT_
     """Shows options to manage product types (edit emoji, delete)."""
     query = update.callback_query
     if query.from_user.id != ADMIN_ID: return await query.answer("Access denied.", show_alert=True)
-    load_all_data() # Ensure PRODUCT_TYPES is up-to-date
     if not PRODUCT_TYPES: msg = "🧩 Manage Product Types\n\nNo product types configured."
     else: msg = "🧩 Manage Product Types\n\nSelect a type to edit or delete:"
     keyboard = []
-    for type_name, emoji in sorted(PRODUCT_TYPES.items()):
+    for type_name, emoji in get_sorted_product_types():
          keyboard.append([
              InlineKeyboardButton(f"{emoji} {type_name}", callback_data=f"adm_edit_type_menu|{type_name}"),
              InlineKeyboardButton(f"🗑️ Delete", callback_data=f"adm_delete_type|{type_name}")
@@ -2548,11 +2497,10 @@ async def handle_adm_broadcast_target_type(update: Update, context: ContextTypes
         await query.answer("Send the message content.")
 
     elif target_type == 'city':
-        load_all_data()
         if not CITIES:
              await query.edit_message_text("No cities configured. Cannot target by city.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back", callback_data="adm_broadcast_start")]]), parse_mode=None)
              return
-        sorted_city_ids = sorted(CITIES.keys(), key=lambda city_id: CITIES.get(city_id, ''))
+        sorted_city_ids = get_sorted_city_ids()
         keyboard = [[InlineKeyboardButton(f"🏙️ {CITIES.get(c,'N/A')}", callback_data=f"adm_broadcast_target_city|{CITIES.get(c,'N/A')}")] for c in sorted_city_ids if CITIES.get(c)]
         keyboard.append([InlineKeyboardButton("❌ Cancel Broadcast", callback_data="cancel_broadcast")])
         select_city_text = lang_data.get("broadcast_select_city_target", "🏙️ Select City to Target\n\nUsers whose last purchase was in:")
@@ -3747,9 +3695,8 @@ async def handle_adm_custom_size_message(update: Update, context: ContextTypes.D
         return
     context.user_data["pending_drop_size"] = custom_size
     context.user_data["state"] = "awaiting_price"
-    keyboard = [[InlineKeyboardButton("❌ Cancel Add", callback_data="cancel_add")]]
     await send_message_with_retry(context.bot, chat_id, f"Custom size set to '{custom_size}'. Reply with the price (e.g., 12.50):",
-                                  reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+                                  reply_markup=_CANCEL_ADD_MARKUP, parse_mode=None)
 
 async def handle_adm_price_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles price input for regular product adding."""
@@ -3763,14 +3710,13 @@ async def handle_adm_price_message(update: Update, context: ContextTypes.DEFAULT
     if not price_text:
         return await send_message_with_retry(context.bot, chat_id, "Price cannot be empty.", parse_mode=None)
     
-    try:
-        price = float(price_text)
-        if price <= 0:
-            return await send_message_with_retry(context.bot, chat_id, "Price must be greater than 0.", parse_mode=None)
-        if price > 10000:
-            return await send_message_with_retry(context.bot, chat_id, "Price too high (max 10000).", parse_mode=None)
-    except ValueError:
+    price = _parse_price_text(price_text)
+    if price is None:
         return await send_message_with_retry(context.bot, chat_id, "Invalid price format. Use numbers like 12.50", parse_mode=None)
+    if price <= 0:
+        return await send_message_with_retry(context.bot, chat_id, "Price must be greater than 0.", parse_mode=None)
+    if price > 10000:
+        return await send_message_with_retry(context.bot, chat_id, "Price too high (max 10000).", parse_mode=None)
     
     # Check required context
     if not all(k in context.user_data for k in ["admin_city", "admin_district", "admin_product_type", "pending_drop_size"]):
@@ -3801,8 +3747,7 @@ async def handle_adm_new_type_name_message(update: Update, context: ContextTypes
             "❌ Please enter a valid type name.", parse_mode=None)
         return
     
-    # Check if type already exists
-    load_all_data()
+    # Check if type already exists (PRODUCT_TYPES is reloaded after every type change)
     if type_name in PRODUCT_TYPES:
         await send_message_with_retry(context.bot, update.effective_chat.id, 
             f"❌ Product type '{type_name}' already exists. Please choose a different name.", parse_mode=None)
@@ -3888,7 +3833,7 @@ async def handle_adm_new_type_description_message(update: Update, context: Conte
         
         # Create the manage types keyboard to show the updated list
         keyboard = []
-        for existing_type_name, existing_emoji in sorted(PRODUCT_TYPES.items()):
+        for existing_type_name, existing_emoji in get_sorted_product_types():
             keyboard.append([
                 InlineKeyboardButton(f"{existing_emoji} {existing_type_name}", callback_data=f"adm_edit_type_menu|{existing_type_name}"),
                 InlineKeyboardButton(f"🗑️ Delete", callback_data=f"adm_delete_type|{existing_type_name}")
@@ -3995,6 +3940,36 @@ async def handle_adm_bulk_back_to_messages(update: Update, context: ContextTypes
     context.user_data["state"] = "awaiting_bulk_messages"
     await show_bulk_messages_status(update, context)
 
+def _create_message_products_sync(city: str, district: str, p_type: str, size: str, price, message_products: list) -> tuple[int, int]:
+    """
+    Inserts one product per collected bulk message, message_products holding (product_name, text, media_list),
+    in a single transaction with one executemany for all media rows. Each product runs under its own SAVEPOINT,
+    so a failing one is rolled back alone and counted as failed. Returns (created_count, failed_count).
+    """
+    created_count = failed_count = 0
+    with db_pool.acquire() as conn, conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        media_inserts = []
+        added_date = datetime.now(timezone.utc).isoformat()
+        for i, (product_name, text_content, media_list) in enumerate(message_products):
+            c.execute("SAVEPOINT bulk_message")
+            try:
+                product_id = c.execute(_PRODUCT_INSERT_SQL, (
+                    city, district, p_type, size, product_name, price, text_content, ADMIN_ID, added_date
+                )).fetchone()['id']
+                if media_list: media_inserts.extend(_move_drop_media(product_id, media_list))
+                c.execute("RELEASE SAVEPOINT bulk_message")
+                created_count += 1
+                logger.info(f"Bulk created product {product_id} ({product_name}) from message {i+1}")
+            except Exception as e:
+                c.execute("ROLLBACK TO SAVEPOINT bulk_message"); c.execute("RELEASE SAVEPOINT bulk_message")
+                failed_count += 1
+                logger.error(f"Error creating bulk product from message {i+1}: {e}", exc_info=True)
+        if media_inserts:
+            _insert_bulk_product_media(c, media_inserts)
+    return created_count, failed_count
+
 async def handle_adm_bulk_execute_messages(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Executes the bulk product creation from collected messages."""
     query = update.callback_query
@@ -4018,104 +3993,79 @@ async def handle_adm_bulk_execute_messages(update: Update, context: ContextTypes
     created_count = 0
     failed_count = 0
     
-    # Process each message as a separate product
+    # Download the media of every message up front, all files concurrently (bounded so a full 10-message
+    # batch doesn't open dozens of Telegram downloads at once)
+    download_sema = asyncio.Semaphore(BULK_MEDIA_DOWNLOAD_CONCURRENCY)
+    temp_dirs = {} # message index -> temp dir holding its media
+    # file_id -> future for the first download of that file; the same photo in later messages is linked
+    # from that copy instead of fetched again (resolves to None if the first download failed)
+    first_downloads = {}
+    download_errors = [] # (message number, error), logged once after the fan-out
+
+    async def _download(i: int, j: int, temp_dir: str, media_item: dict) -> bool:
+        file_id = media_item["file_id"]
+        first_download = first_downloads.get(file_id)
+        if first_download is not None:
+            source_path = await first_download
+            if not source_path: return False
+            temp_file_path = os.path.join(temp_dir, f"media_{j}_{int(time.time())}{os.path.splitext(source_path)[1]}")
+            try: await asyncio.to_thread(_link_or_copy, source_path, temp_file_path)
+            except OSError as e:
+                download_errors.append((i + 1, repr(e)))
+                return False
+            media_item["path"] = temp_file_path
+            return True
+        first_downloads[file_id] = first_download = asyncio.get_running_loop().create_future()
+        downloaded = await _download_first(i, j, temp_dir, media_item)
+        first_download.set_result(media_item.get("path") if downloaded else None)
+        return downloaded
+
+    async def _download_first(i: int, j: int, temp_dir: str, media_item: dict) -> bool:
+        async with download_sema:
+            try:
+                file_obj = await get_file_cached(context.bot, media_item["file_id"])
+                file_extension = os.path.splitext(file_obj.file_path)[1] if file_obj.file_path else ""
+                if not file_extension: file_extension = _MEDIA_EXTENSIONS.get(media_item["type"], ".bin")
+                
+                temp_file_path = os.path.join(temp_dir, f"media_{j}_{int(time.time())}{file_extension}")
+                await download_file_streamed(file_obj, temp_file_path)
+                media_item["path"] = temp_file_path
+                return True
+            except Exception as e:
+                download_errors.append((i + 1, repr(e)))
+                return False
+
+    downloads = []
     for i, message_data in enumerate(bulk_messages):
-        text_content = message_data.get("text", "")
         media_list = message_data.get("media", [])
-        
-        # Create unique product name
-        product_name = f"{p_type} {size} {int(time.time())}_{i+1}"
-        
-        conn = None
-        product_id = None
-        temp_dir = None
-        
-        try:
-            # Download media if present
-            if media_list:
-                temp_dir = await asyncio.to_thread(tempfile.mkdtemp, prefix="bulk_msg_media_")
-                
-                for j, media_item in enumerate(media_list):
-                    try:
-                        file_obj = await context.bot.get_file(media_item["file_id"])
-                        file_extension = os.path.splitext(file_obj.file_path)[1] if file_obj.file_path else ""
-                        if not file_extension:
-                            if media_item["type"] == "photo": file_extension = ".jpg"
-                            elif media_item["type"] == "video": file_extension = ".mp4"
-                            elif media_item["type"] == "animation": file_extension = ".gif"
-                            else: file_extension = ".bin"
-                        
-                        temp_file_path = os.path.join(temp_dir, f"media_{j}_{int(time.time())}{file_extension}")
-                        await file_obj.download_to_drive(temp_file_path)
-                        media_item["path"] = temp_file_path
-                    except Exception as e:
-                        logger.error(f"Error downloading media for bulk message {i+1}: {e}")
-                        failed_count += 1
-            
-            # Create product in database
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("BEGIN")
-            
-            insert_params = (
-                city, district, p_type, size, product_name, price, text_content, ADMIN_ID, datetime.now(timezone.utc).isoformat()
-            )
-            
-            c.execute("""INSERT INTO products
-                            (city, district, product_type, size, name, price, available, reserved, original_text, added_by, added_date)
-                         VALUES (?, ?, ?, ?, ?, ?, 1, 0, ?, ?, ?)""", insert_params)
-            product_id = c.lastrowid
-            
-            # Handle media for this product
-            if product_id and media_list and temp_dir:
-                final_media_dir = os.path.join(MEDIA_DIR, str(product_id))
-                await asyncio.to_thread(os.makedirs, final_media_dir, exist_ok=True)
-                
-                media_inserts = []
-                for media_item in media_list:
-                    if "path" in media_item and "type" in media_item and "file_id" in media_item:
-                        temp_file_path = media_item["path"]
-                        if await asyncio.to_thread(os.path.exists, temp_file_path):
-                            new_filename = os.path.basename(temp_file_path)
-                            final_persistent_path = os.path.join(final_media_dir, new_filename)
-                            try:
-                                await asyncio.to_thread(shutil.move, temp_file_path, final_persistent_path)
-                                media_inserts.append((product_id, media_item["type"], final_persistent_path, media_item["file_id"]))
-                            except OSError as move_err:
-                                logger.error(f"Error moving media {temp_file_path}: {move_err}")
-                        else:
-                            logger.warning(f"Temp media not found: {temp_file_path}")
-                    else:
-                        logger.warning(f"Incomplete media item: {media_item}")
-                
-                if media_inserts:
-                    c.executemany("INSERT INTO product_media (product_id, media_type, file_path, telegram_file_id) VALUES (?, ?, ?, ?)", media_inserts)
-            
-            conn.commit()
-            created_count += 1
-            logger.info(f"Bulk created product {product_id} ({product_name}) from message {i+1}")
-            
-        except Exception as e:
-            failed_count += 1
-            logger.error(f"Error creating bulk product from message {i+1}: {e}", exc_info=True)
-            if conn:
-                try:
-                    conn.rollback()
-                except Exception as rb_err:
-                    logger.error(f"Rollback failed: {rb_err}")
-        finally:
-            if conn:
-                conn.close()
-            
-            # Clean up temp directory for this message
-            if temp_dir and await asyncio.to_thread(os.path.exists, temp_dir):
-                await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
+        if media_list:
+            try: temp_dirs[i] = await asyncio.to_thread(tempfile.mkdtemp, prefix="bulk_msg_media_")
+            except OSError as e:
+                logger.error(f"Could not create temp dir for bulk message {i+1}: {e}")
+                continue
+            downloads.extend(_download(i, j, temp_dirs[i], m) for j, m in enumerate(media_list))
+    if downloads: failed_count += (await asyncio.gather(*downloads)).count(False)
+    if download_errors:
+        logger.warning(f"Bulk message media failures: {len(download_errors)} items, first: {download_errors[:5]}")
+    
+    # Each message becomes a separate product; all of them commit in one transaction and one thread hop
+    name_stamp = int(time.time())
+    message_products = [
+        (f"{p_type} {size} {name_stamp}_{i+1}", message_data.get("text", ""), message_data.get("media", []) if i in temp_dirs else [])
+        for i, message_data in enumerate(bulk_messages)
+    ]
+    try:
+        bulk_created, bulk_failed = await asyncio.to_thread(_create_message_products_sync, city, district, p_type, size, price, message_products)
+        created_count += bulk_created
+        failed_count += bulk_failed
+    except Exception as e:
+        failed_count += len(message_products)
+        logger.error(f"Error creating bulk products from messages: {e}", exc_info=True)
+    finally:
+        for temp_dir in temp_dirs.values(): await asyncio.to_thread(_remove_temp_dir, temp_dir)
     
     # Clear bulk data from context
-    keys_to_clear = ["bulk_messages", "bulk_admin_city_id", "bulk_admin_district_id", 
-                     "bulk_admin_product_type", "bulk_admin_city", "bulk_admin_district", 
-                     "bulk_pending_drop_size", "bulk_pending_drop_price", "state"]
-    for key in keys_to_clear:
+    for key in ("bulk_messages",) + _BULK_SETUP_KEYS:
         context.user_data.pop(key, None)
     
     # Show results
@@ -4138,6 +4088,62 @@ async def handle_adm_bulk_execute_messages(update: Update, context: ContextTypes
     
     await send_message_with_retry(context.bot, chat_id, result_msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
+# One statement inserts every drop of a location-based bulk add: the locations ride as one JSON array of
+# [city, district] pairs (json_each), shared columns are bound once
+_BULK_PRODUCT_INSERT_SQL = """INSERT INTO products
+                (city, district, product_type, size, name, price, available, reserved, original_text, added_by, added_date)
+             SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]'), ?, ?, ?, ?, 1, 0, ?, ?, ? FROM json_each(?)
+             RETURNING id, city, district"""
+
+BULK_INSERT_CHUNK_SIZE = 200 # Drops per transaction, so one commit's WAL growth stays within the page cache
+
+def _create_bulk_products_sync(bulk_drops: list, p_type: str, size: str, price, original_text: str, media_list: list) -> tuple[int, int]:
+    """
+    Inserts one product per drop with a set-based INSERT per BULK_INSERT_CHUNK_SIZE drops, then links the downloaded
+    media into each product; every chunk is its own transaction, so chunks committed before a failure stay. A product
+    whose media can't be stored is deleted again and counted as failed. Returns (created_count, failed_count).
+    """
+    created_count = failed_count = 0
+    # Every drop shares one name stamp and added_date
+    now = time.time()
+    product_name = f"{p_type} {size} {int(now)}"
+    added_date = datetime.fromtimestamp(now, timezone.utc).isoformat()
+    linked_media = {} # temp path -> first persisted copy, hard-linked for the remaining drops
+    media_errors = [] # (product id, error), logged once at the end
+    with db_pool.acquire() as conn:
+        for chunk_start in range(0, len(bulk_drops), BULK_INSERT_CHUNK_SIZE):
+            chunk = bulk_drops[chunk_start:chunk_start + BULK_INSERT_CHUNK_SIZE]
+            locations = json.dumps([[drop["city"], drop["district"]] for drop in chunk])
+            try:
+                with conn:
+                    c = conn.cursor()
+                    c.execute("BEGIN IMMEDIATE")
+                    created = c.execute(_BULK_PRODUCT_INSERT_SQL, (
+                        p_type, size, product_name, price, original_text, ADMIN_ID, added_date, locations
+                    )).fetchall()
+                    media_inserts, failed_ids = [], []
+                    for row in created:
+                        try:
+                            # Copy instead of move so the downloaded media can be reused for the other drops
+                            if media_list: media_inserts.extend(_move_drop_media(row['id'], media_list, copy=True, linked=linked_media))
+                            logger.info(f"Bulk created product {row['id']} ({product_name}) in {row['city']}/{row['district']}")
+                        except Exception as e:
+                            failed_ids.append(row['id'])
+                            media_errors.append((row['id'], repr(e)))
+                    if failed_ids:
+                        c.execute("DELETE FROM products WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(failed_ids),))
+                    if media_inserts:
+                        _insert_bulk_product_media(c, media_inserts)
+            except sqlite3.Error as e:
+                failed_count += len(chunk)
+                logger.error(f"Error inserting bulk products {chunk_start + 1}-{chunk_start + len(chunk)} of {len(bulk_drops)}: {e}", exc_info=True)
+                continue
+            created_count += len(created) - len(failed_ids)
+            failed_count += len(chunk) - len(created) + len(failed_ids)
+    if media_errors:
+        logger.warning(f"Bulk media storage failures: {len(media_errors)} products removed, first: {media_errors[:5]}")
+    return created_count, failed_count
+
 async def handle_adm_bulk_execute(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Executes the bulk product creation."""
     query = update.callback_query
@@ -4167,98 +4173,44 @@ async def handle_adm_bulk_execute(update: Update, context: ContextTypes.DEFAULT_
         import tempfile
         temp_dir = await asyncio.to_thread(tempfile.mkdtemp, prefix="bulk_media_")
         
-        # Download media to temp directory
-        for i, media_item in enumerate(media_list):
+        # Download media to temp directory, all files concurrently
+        download_errors = [] # (media index, error), logged once after the fan-out
+        async def _download(i: int, media_item: dict) -> bool:
             try:
-                file_obj = await context.bot.get_file(media_item["file_id"])
+                cached_path = _cached_media_path(media_item["file_id"])
+                if cached_path:
+                    temp_file_path = os.path.join(temp_dir, f"media_{i}_{int(time.time())}{os.path.splitext(cached_path)[1]}")
+                    if await asyncio.to_thread(_copy_cached_media, media_item["file_id"], cached_path, temp_file_path):
+                        media_item["path"] = temp_file_path
+                        return True
+                file_obj = await get_file_cached(context.bot, media_item["file_id"])
                 file_extension = os.path.splitext(file_obj.file_path)[1] if file_obj.file_path else ""
-                if not file_extension:
-                    if media_item["type"] == "photo": file_extension = ".jpg"
-                    elif media_item["type"] == "video": file_extension = ".mp4"
-                    elif media_item["type"] == "animation": file_extension = ".gif"
-                    else: file_extension = ".bin"
+                if not file_extension: file_extension = _MEDIA_EXTENSIONS.get(media_item["type"], ".bin")
                 
                 temp_file_path = os.path.join(temp_dir, f"media_{i}_{int(time.time())}{file_extension}")
-                await file_obj.download_to_drive(temp_file_path)
+                await download_file_streamed(file_obj, temp_file_path)
                 media_item["path"] = temp_file_path
+                return True
             except Exception as e:
-                logger.error(f"Error downloading media for bulk operation: {e}")
-                failed_count += 1
-    
-    # Create products for each location
-    for drop in bulk_drops:
-        city = drop["city"]
-        district = drop["district"]
-        product_name = f"{p_type} {size} {int(time.time())}"
+                download_errors.append((i, repr(e)))
+                return False
         
-        conn = None
-        product_id = None
-        try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("BEGIN")
-            
-            insert_params = (
-                city, district, p_type, size, product_name, price, original_text, ADMIN_ID, datetime.now(timezone.utc).isoformat()
-            )
-            
-            c.execute("""INSERT INTO products
-                            (city, district, product_type, size, name, price, available, reserved, original_text, added_by, added_date)
-                         VALUES (?, ?, ?, ?, ?, ?, 1, 0, ?, ?, ?)""", insert_params)
-            product_id = c.lastrowid
-            
-            # Handle media for this product
-            if product_id and media_list and temp_dir:
-                final_media_dir = os.path.join(MEDIA_DIR, str(product_id))
-                await asyncio.to_thread(os.makedirs, final_media_dir, exist_ok=True)
-                
-                media_inserts = []
-                for media_item in media_list:
-                    if "path" in media_item and "type" in media_item and "file_id" in media_item:
-                        temp_file_path = media_item["path"]
-                        if await asyncio.to_thread(os.path.exists, temp_file_path):
-                            new_filename = os.path.basename(temp_file_path)
-                            final_persistent_path = os.path.join(final_media_dir, new_filename)
-                            try:
-                                # Copy instead of move so we can reuse for other products
-                                await asyncio.to_thread(shutil.copy2, temp_file_path, final_persistent_path)
-                                media_inserts.append((product_id, media_item["type"], final_persistent_path, media_item["file_id"]))
-                            except OSError as move_err:
-                                logger.error(f"Error copying media {temp_file_path}: {move_err}")
-                        else:
-                            logger.warning(f"Temp media not found: {temp_file_path}")
-                    else:
-                        logger.warning(f"Incomplete media item: {media_item}")
-                
-                if media_inserts:
-                    c.executemany("INSERT INTO product_media (product_id, media_type, file_path, telegram_file_id) VALUES (?, ?, ?, ?)", media_inserts)
-            
-            conn.commit()
-            created_count += 1
-            logger.info(f"Bulk created product {product_id} ({product_name}) in {city}/{district}")
-            
-        except Exception as e:
-            failed_count += 1
-            logger.error(f"Error creating bulk product in {city}/{district}: {e}", exc_info=True)
-            if conn:
-                try:
-                    conn.rollback()
-                except Exception as rb_err:
-                    logger.error(f"Rollback failed: {rb_err}")
-        finally:
-            if conn:
-                conn.close()
+        downloaded = await asyncio.gather(*(_download(i, m) for i, m in enumerate(media_list)))
+        failed_count += downloaded.count(False)
+        if download_errors:
+            logger.warning(f"Bulk media download failures: {len(download_errors)} items, first: {download_errors[:5]}")
+    
+    # Create products for each location: one transaction and one thread hop for the whole batch
+    bulk_created, bulk_failed = await asyncio.to_thread(_create_bulk_products_sync, bulk_drops, p_type, size, price, original_text, media_list if temp_dir else [])
+    created_count += bulk_created
+    failed_count += bulk_failed
     
     # Clean up temp directory
-    if temp_dir and await asyncio.to_thread(os.path.exists, temp_dir):
-        await asyncio.to_thread(shutil.rmtree, temp_dir, ignore_errors=True)
+    if temp_dir and await asyncio.to_thread(_remove_temp_dir, temp_dir):
         logger.info(f"Cleaned bulk temp dir: {temp_dir}")
     
     # Clear bulk data from context
-    keys_to_clear = ["bulk_template", "bulk_drops", "bulk_admin_city_id", "bulk_admin_district_id", 
-                     "bulk_admin_product_type", "bulk_admin_city", "bulk_admin_district", 
-                     "bulk_pending_drop_size", "bulk_pending_drop_price", "state"]
-    for key in keys_to_clear:
+    for key in _BULK_TEMPLATE_KEYS + _BULK_SETUP_KEYS:
         context.user_data.pop(key, None)
     
     # Show results
@@ -4325,11 +4277,7 @@ async def _process_bulk_collected_media(context: ContextTypes.DEFAULT_TYPE):
         logger.warning(f"BULK JOB DEBUG: Already have 10 messages, ignoring group {media_group_id}")
         return
     
-    message_data = {
-        "text": caption,
-        "media": collected_media,
-        "timestamp": int(time.time())
-    }
+    message_data = {"text": caption, "media": collected_media}
     
     bulk_messages.append(message_data)
     user_data["bulk_messages"] = bulk_messages
@@ -4420,15 +4368,8 @@ async def handle_adm_bulk_drop_details_message(update: Update, context: ContextT
         context.user_data.pop('bulk_collected_media', None)
 
         # Extract message content
-        message_data = {
-            "text": text,
-            "media": [],
-            "timestamp": int(time.time())
-        }
-
-        # Get media content for single message
-        if media_type and file_id:
-            message_data["media"].append({"type": media_type, "file_id": file_id})
+        media = [{"type": media_type, "file_id": file_id}] if media_type and file_id else []
+        message_data = {"text": text, "media": media}
 
         # Store the message
         bulk_messages.append(message_data)
@@ -4502,10 +4443,10 @@ async def handle_adm_search_username_message(update: Update, context: ContextTyp
         
         if search_by_id:
             # Search by User ID
-            c.execute("SELECT user_id, username, balance, total_purchases, is_banned, is_reseller FROM users WHERE user_id = ?", (user_id_search,))
+            c.execute("SELECT user_id, username, balance_cents, total_purchases, is_banned, is_reseller FROM users WHERE user_id = ?", (user_id_search,))
         else:
             # Search by username (case insensitive)
-            c.execute("SELECT user_id, username, balance, total_purchases, is_banned, is_reseller FROM users WHERE LOWER(username) = LOWER(?)", (search_term,))
+            c.execute("SELECT user_id, username, balance_cents, total_purchases, is_banned, is_reseller FROM users WHERE LOWER(username) = LOWER(?)", (search_term,))
         
         user_info = c.fetchone()
         
@@ -4547,7 +4488,7 @@ async def display_user_search_results(bot, chat_id: int, user_info: dict):
     """Displays user overview with buttons to view detailed sections."""
     user_id = user_info['user_id']
     username = user_info['username'] or f"ID_{user_id}"
-    balance = Decimal(str(user_info['balance']))
+    balance = cents_to_eur(user_info['balance_cents'])
     total_purchases = user_info['total_purchases']
     is_banned = user_info['is_banned'] == 1
     is_reseller = user_info['is_reseller'] == 1
@@ -4991,7 +4932,7 @@ async def handle_adm_user_overview(update: Update, context: ContextTypes.DEFAULT
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("SELECT user_id, username, balance, total_purchases, is_banned, is_reseller FROM users WHERE user_id = ?", (user_id,))
+        c.execute("SELECT user_id, username, balance_cents, total_purchases, is_banned, is_reseller FROM users WHERE user_id = ?", (user_id,))
         user_info = c.fetchone()
         
         if not user_info:
@@ -18,7 +18,7 @@ from telegram import Update, BotCommand, ReplyKeyboardMarkup, ReplyKeyboardRemov
 from telegram.ext import (
     Application, ApplicationBuilder, Defaults, ContextTypes,
     CommandHandler, CallbackQueryHandler, MessageHandler, filters,
-    PicklePersistence, JobQueue
+    JobQueue
 )
 from telegram.constants import ParseMode
 from telegram.error import Forbidden, BadRequest, NetworkError, RetryAfter, TelegramError
@@ -41,7 +41,11 @@ from utils import (
     format_currency,
     clean_expired_pending_payments,
     get_expired_payments_for_notification,
-    is_worker
+    is_worker,
+    get_user_lang,
+    get_lang_view,
+    start_admin_log_writer, stop_admin_log_writer, close_download_session,
+    checkpoint_wal, disable_wal_autocheckpoint, WAL_CHECKPOINT_INTERVAL
 )
 import user
 import worker # Import user module
@@ -156,7 +160,7 @@ except ImportError:
     async def handle_reseller_delete_discount_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None): pass
 
 import payment
-from payment import credit_user_balance
+from payment import credit_user_balance, CreditKind
 from stock import handle_view_stock
 
 # --- Logging Setup ---
@@ -176,166 +180,165 @@ flask_app = Flask(__name__)
 telegram_app: Application | None = None
 main_loop = None
 
+# --- Callback Dispatch Table ---
+# Built once at import; callback_query_router looks the command (callback_data up to the first '|') up here.
+KNOWN_HANDLERS = {
+    # User Handlers (from user.py)
+    "start": user.start, "back_start": user.handle_back_start, "shop": user.handle_shop,
+    "city": user.handle_city_selection, "dist": user.handle_district_selection,
+    "type": user.handle_type_selection, "product": user.handle_product_selection,
+    "add": user.handle_add_to_basket,
+    "pay_single_item": user.handle_pay_single_item,
+    "view_basket": user.handle_view_basket,
+    "clear_basket": user.handle_clear_basket, "remove": user.handle_remove_from_basket,
+    "profile": user.handle_profile, "language": user.handle_language_selection,
+    "price_list": user.handle_price_list, "price_list_city": user.handle_price_list_city,
+    "reviews": user.handle_reviews_menu, "leave_review": user.handle_leave_review,
+    "view_reviews": user.handle_view_reviews, "leave_review_now": user.handle_leave_review_now,
+    "refill": user.handle_refill,
+    "view_history": user.handle_view_history,
+    "apply_discount_start": user.apply_discount_start, "remove_discount": user.remove_discount,
+    "confirm_pay": user.handle_confirm_pay, # <<< CORRECTED
+    "apply_discount_basket_pay": user.handle_apply_discount_basket_pay,
+    "skip_discount_basket_pay": user.handle_skip_discount_basket_pay,
+    # <<< ADDED Single Item Discount Flow Callbacks (from user.py) >>>
+    "apply_discount_single_pay": user.handle_apply_discount_single_pay,
+    "skip_discount_single_pay": user.handle_skip_discount_single_pay,
+
+    # Payment Handlers (from payment.py)
+    "select_basket_crypto": payment.handle_select_basket_crypto,
+    "cancel_crypto_payment": payment.handle_cancel_crypto_payment,
+    "select_refill_crypto": payment.handle_select_refill_crypto,
+
+    # Primary Admin Handlers (from admin.py)
+    "admin_menu": admin.handle_admin_menu,
+    "sales_analytics_menu": admin.handle_sales_analytics_menu, "sales_dashboard": admin.handle_sales_dashboard,
+    "sales_select_period": admin.handle_sales_select_period, "sales_run": admin.handle_sales_run,
+    "adm_city": admin.handle_adm_city, "adm_dist": admin.handle_adm_dist, "adm_type": admin.handle_adm_type,
+    "adm_add": admin.handle_adm_add, "adm_size": admin.handle_adm_size, "adm_custom_size": admin.handle_adm_custom_size,
+    "confirm_add_drop": admin.handle_confirm_add_drop, "cancel_add": admin.cancel_add,
+    "adm_manage_cities": admin.handle_adm_manage_cities, "adm_add_city": admin.handle_adm_add_city,
+    "adm_edit_city": admin.handle_adm_edit_city, "adm_delete_city": admin.handle_adm_delete_city,
+    "adm_manage_districts": admin.handle_adm_manage_districts, "adm_manage_districts_city": admin.handle_adm_manage_districts_city,
+    "adm_add_district": admin.handle_adm_add_district, "adm_edit_district": admin.handle_adm_edit_district,
+    "adm_remove_district": admin.handle_adm_remove_district,
+    "adm_manage_products": admin.handle_adm_manage_products, "adm_manage_products_city": admin.handle_adm_manage_products_city,
+    "adm_manage_products_dist": admin.handle_adm_manage_products_dist, "adm_manage_products_type": admin.handle_adm_manage_products_type,
+    "adm_delete_prod": admin.handle_adm_delete_prod,
+    "adm_manage_types": admin.handle_adm_manage_types,
+    "adm_edit_type_menu": admin.handle_adm_edit_type_menu,
+    "adm_change_type_emoji": admin.handle_adm_change_type_emoji,
+    "adm_add_type": admin.handle_adm_add_type,
+    "adm_delete_type": admin.handle_adm_delete_type,
+    "confirm_force_delete_prompt": admin.handle_confirm_force_delete_prompt, # Changed from confirm_force_delete_type
+    "adm_manage_discounts": admin.handle_adm_manage_discounts, "adm_toggle_discount": admin.handle_adm_toggle_discount,
+    "adm_delete_discount": admin.handle_adm_delete_discount, "adm_add_discount_start": admin.handle_adm_add_discount_start,
+    "adm_use_generated_code": admin.handle_adm_use_generated_code, "adm_set_discount_type": admin.handle_adm_set_discount_type,
+    "adm_set_media": admin.handle_adm_set_media,
+    "adm_clear_reservations_confirm": admin.handle_adm_clear_reservations_confirm,
+    "confirm_yes": admin.handle_confirm_yes,
+    "adm_broadcast_start": admin.handle_adm_broadcast_start,
+    "adm_broadcast_target_type": admin.handle_adm_broadcast_target_type,
+    "adm_broadcast_target_city": admin.handle_adm_broadcast_target_city,
+    "adm_broadcast_target_status": admin.handle_adm_broadcast_target_status,
+    "cancel_broadcast": admin.handle_cancel_broadcast,
+    "confirm_broadcast": admin.handle_confirm_broadcast,
+    "adm_manage_reviews": admin.handle_adm_manage_reviews,
+    "adm_delete_review_confirm": admin.handle_adm_delete_review_confirm,
+    "adm_manage_welcome": admin.handle_adm_manage_welcome,
+    "adm_activate_welcome": admin.handle_adm_activate_welcome,
+    "adm_add_welcome_start": admin.handle_adm_add_welcome_start,
+    "adm_edit_welcome": admin.handle_adm_edit_welcome,
+    "adm_delete_welcome_confirm": admin.handle_adm_delete_welcome_confirm,
+    "adm_edit_welcome_text": admin.handle_adm_edit_welcome_text,
+    "adm_edit_welcome_desc": admin.handle_adm_edit_welcome_desc,
+    "adm_reset_default_confirm": admin.handle_reset_default_welcome,
+    "confirm_save_welcome": admin.handle_confirm_save_welcome,
+    # Bulk product handlers
+    "adm_bulk_city": admin.handle_adm_bulk_city,
+    "adm_bulk_dist": admin.handle_adm_bulk_dist,
+    "adm_bulk_type": admin.handle_adm_bulk_type,
+    "adm_bulk_add": admin.handle_adm_bulk_add,
+    "adm_bulk_size": admin.handle_adm_bulk_size,
+    "adm_bulk_custom_size": admin.handle_adm_bulk_custom_size,
+    "cancel_bulk_add": admin.cancel_bulk_add,
+    # New bulk message handlers
+    "adm_bulk_remove_last_message": admin.handle_adm_bulk_remove_last_message,
+    "adm_bulk_back_to_messages": admin.handle_adm_bulk_back_to_messages,
+    "adm_bulk_execute_messages": admin.handle_adm_bulk_execute_messages,
+    "adm_bulk_create_all": admin.handle_adm_bulk_confirm_all,
+
+    # Viewer Admin Handlers (from viewer_admin.py)
+    "viewer_admin_menu": handle_viewer_admin_menu,
+    "viewer_added_products": handle_viewer_added_products,
+    "viewer_view_product_media": handle_viewer_view_product_media,
+    "adm_manage_users": handle_manage_users_start,
+    "adm_view_user": handle_view_user_profile,
+    "adm_adjust_balance_start": handle_adjust_balance_start,
+    "adm_toggle_ban": handle_toggle_ban_user,
+
+    # Reseller Management Handlers (from reseller_management.py)
+    "manage_resellers_menu": handle_manage_resellers_menu,
+    "reseller_toggle_status": handle_reseller_toggle_status,
+    "manage_reseller_discounts_select_reseller": handle_manage_reseller_discounts_select_reseller,
+    "reseller_manage_specific": handle_manage_specific_reseller_discounts,
+    "reseller_add_discount_select_type": handle_reseller_add_discount_select_type,
+    "reseller_add_discount_enter_percent": handle_reseller_add_discount_enter_percent,
+    "reseller_edit_discount": handle_reseller_edit_discount,
+    "reseller_delete_discount_confirm": handle_reseller_delete_discount_confirm,
+
+    # Stock Handler (from stock.py)
+    "view_stock": handle_view_stock,
+    
+    # User Search Handlers (from admin.py)
+    "adm_search_user_start": admin.handle_adm_search_user_start,
+    "adm_user_deposits": admin.handle_adm_user_deposits,
+    "adm_user_purchases": admin.handle_adm_user_purchases,
+    "adm_user_actions": admin.handle_adm_user_actions,
+    "adm_user_discounts": admin.handle_adm_user_discounts,
+    "adm_user_overview": admin.handle_adm_user_overview,
+    
+    # Worker Management Handlers (from admin.py)
+    "adm_manage_workers": admin.handle_adm_manage_workers,
+    "adm_add_worker": admin.handle_adm_add_worker,
+    "adm_remove_worker": admin.handle_adm_remove_worker,
+    "adm_confirm_remove_worker": admin.handle_adm_confirm_remove_worker,
+    "adm_execute_remove_worker": admin.handle_adm_execute_remove_worker,
+    
+    # Worker Panel Handlers (from worker.py)
+    "worker_panel": worker.handle_worker_panel,
+    "worker_city": worker.handle_worker_city,
+    "worker_dist": worker.handle_worker_dist,
+    "worker_type": worker.handle_worker_type,
+    "worker_add": worker.handle_worker_add,
+    "worker_size": worker.handle_worker_size,
+    "worker_custom_size": worker.handle_worker_custom_size,
+    "worker_cancel_add": worker.handle_worker_cancel_add,
+    # Worker Bulk Handlers
+    "worker_bulk_city": worker.handle_worker_bulk_city,
+    "worker_bulk_dist": worker.handle_worker_bulk_dist,
+    "worker_bulk_type": worker.handle_worker_bulk_type,
+    "worker_bulk_add": worker.handle_worker_bulk_add,
+    "worker_bulk_size": worker.handle_worker_bulk_size,
+    "worker_bulk_custom_size": worker.handle_worker_bulk_custom_size,
+    "worker_bulk_create_all": worker.handle_worker_bulk_create_all,
+    "worker_bulk_remove_last_message": worker.handle_worker_bulk_remove_last_message,
+    "worker_bulk_back_to_management": worker.handle_worker_bulk_back_to_management,
+    "worker_cancel_bulk_add": worker.handle_worker_cancel_bulk_add,
+    "close_menu": worker.handle_close_menu,
+}
+
 # --- Callback Data Parsing Decorator ---
 def callback_query_router(func):
     @wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         if query and query.data:
-            parts = query.data.split('|')
-            command = parts[0]
-            params = parts[1:]
-            target_func_name = f"handle_{command}"
-
-            KNOWN_HANDLERS = {
-                # User Handlers (from user.py)
-                "start": user.start, "back_start": user.handle_back_start, "shop": user.handle_shop,
-                "city": user.handle_city_selection, "dist": user.handle_district_selection,
-                "type": user.handle_type_selection, "product": user.handle_product_selection,
-                "add": user.handle_add_to_basket,
-                "pay_single_item": user.handle_pay_single_item,
-                "view_basket": user.handle_view_basket,
-                "clear_basket": user.handle_clear_basket, "remove": user.handle_remove_from_basket,
-                "profile": user.handle_profile, "language": user.handle_language_selection,
-                "price_list": user.handle_price_list, "price_list_city": user.handle_price_list_city,
-                "reviews": user.handle_reviews_menu, "leave_review": user.handle_leave_review,
-                "view_reviews": user.handle_view_reviews, "leave_review_now": user.handle_leave_review_now,
-                "refill": user.handle_refill,
-                "view_history": user.handle_view_history,
-                "apply_discount_start": user.apply_discount_start, "remove_discount": user.remove_discount,
-                "confirm_pay": user.handle_confirm_pay, # <<< CORRECTED
-                "apply_discount_basket_pay": user.handle_apply_discount_basket_pay,
-                "skip_discount_basket_pay": user.handle_skip_discount_basket_pay,
-                # <<< ADDED Single Item Discount Flow Callbacks (from user.py) >>>
-                "apply_discount_single_pay": user.handle_apply_discount_single_pay,
-                "skip_discount_single_pay": user.handle_skip_discount_single_pay,
-
-                # Payment Handlers (from payment.py)
-                "select_basket_crypto": payment.handle_select_basket_crypto,
-                "cancel_crypto_payment": payment.handle_cancel_crypto_payment,
-                "select_refill_crypto": payment.handle_select_refill_crypto,
-
-                # Primary Admin Handlers (from admin.py)
-                "admin_menu": admin.handle_admin_menu,
-                "sales_analytics_menu": admin.handle_sales_analytics_menu, "sales_dashboard": admin.handle_sales_dashboard,
-                "sales_select_period": admin.handle_sales_select_period, "sales_run": admin.handle_sales_run,
-                "adm_city": admin.handle_adm_city, "adm_dist": admin.handle_adm_dist, "adm_type": admin.handle_adm_type,
-                "adm_add": admin.handle_adm_add, "adm_size": admin.handle_adm_size, "adm_custom_size": admin.handle_adm_custom_size,
-                "confirm_add_drop": admin.handle_confirm_add_drop, "cancel_add": admin.cancel_add,
-                "adm_manage_cities": admin.handle_adm_manage_cities, "adm_add_city": admin.handle_adm_add_city,
-                "adm_edit_city": admin.handle_adm_edit_city, "adm_delete_city": admin.handle_adm_delete_city,
-                "adm_manage_districts": admin.handle_adm_manage_districts, "adm_manage_districts_city": admin.handle_adm_manage_districts_city,
-                "adm_add_district": admin.handle_adm_add_district, "adm_edit_district": admin.handle_adm_edit_district,
-                "adm_remove_district": admin.handle_adm_remove_district,
-                "adm_manage_products": admin.handle_adm_manage_products, "adm_manage_products_city": admin.handle_adm_manage_products_city,
-                "adm_manage_products_dist": admin.handle_adm_manage_products_dist, "adm_manage_products_type": admin.handle_adm_manage_products_type,
-                "adm_delete_prod": admin.handle_adm_delete_prod,
-                "adm_manage_types": admin.handle_adm_manage_types,
-                "adm_edit_type_menu": admin.handle_adm_edit_type_menu,
-                "adm_change_type_emoji": admin.handle_adm_change_type_emoji,
-                "adm_add_type": admin.handle_adm_add_type,
-                "adm_delete_type": admin.handle_adm_delete_type,
-                "confirm_force_delete_prompt": admin.handle_confirm_force_delete_prompt, # Changed from confirm_force_delete_type
-                "adm_manage_discounts": admin.handle_adm_manage_discounts, "adm_toggle_discount": admin.handle_adm_toggle_discount,
-                "adm_delete_discount": admin.handle_adm_delete_discount, "adm_add_discount_start": admin.handle_adm_add_discount_start,
-                "adm_use_generated_code": admin.handle_adm_use_generated_code, "adm_set_discount_type": admin.handle_adm_set_discount_type,
-                "adm_set_media": admin.handle_adm_set_media,
-                "adm_clear_reservations_confirm": admin.handle_adm_clear_reservations_confirm,
-                "confirm_yes": admin.handle_confirm_yes,
-                "adm_broadcast_start": admin.handle_adm_broadcast_start,
-                "adm_broadcast_target_type": admin.handle_adm_broadcast_target_type,
-                "adm_broadcast_target_city": admin.handle_adm_broadcast_target_city,
-                "adm_broadcast_target_status": admin.handle_adm_broadcast_target_status,
-                "cancel_broadcast": admin.handle_cancel_broadcast,
-                "confirm_broadcast": admin.handle_confirm_broadcast,
-                "adm_manage_reviews": admin.handle_adm_manage_reviews,
-                "adm_delete_review_confirm": admin.handle_adm_delete_review_confirm,
-                "adm_manage_welcome": admin.handle_adm_manage_welcome,
-                "adm_activate_welcome": admin.handle_adm_activate_welcome,
-                "adm_add_welcome_start": admin.handle_adm_add_welcome_start,
-                "adm_edit_welcome": admin.handle_adm_edit_welcome,
-                "adm_delete_welcome_confirm": admin.handle_adm_delete_welcome_confirm,
-                "adm_edit_welcome_text": admin.handle_adm_edit_welcome_text,
-                "adm_edit_welcome_desc": admin.handle_adm_edit_welcome_desc,
-                "adm_reset_default_confirm": admin.handle_reset_default_welcome,
-                "confirm_save_welcome": admin.handle_confirm_save_welcome,
-                # Bulk product handlers
-                "adm_bulk_city": admin.handle_adm_bulk_city,
-                "adm_bulk_dist": admin.handle_adm_bulk_dist,
-                "adm_bulk_type": admin.handle_adm_bulk_type,
-                "adm_bulk_add": admin.handle_adm_bulk_add,
-                "adm_bulk_size": admin.handle_adm_bulk_size,
-                "adm_bulk_custom_size": admin.handle_adm_bulk_custom_size,
-                "cancel_bulk_add": admin.cancel_bulk_add,
-                # New bulk message handlers
-                "adm_bulk_remove_last_message": admin.handle_adm_bulk_remove_last_message,
-                "adm_bulk_back_to_messages": admin.handle_adm_bulk_back_to_messages,
-                "adm_bulk_execute_messages": admin.handle_adm_bulk_execute_messages,
-                "adm_bulk_create_all": admin.handle_adm_bulk_confirm_all,
-
-                # Viewer Admin Handlers (from viewer_admin.py)
-                "viewer_admin_menu": handle_viewer_admin_menu,
-                "viewer_added_products": handle_viewer_added_products,
-                "viewer_view_product_media": handle_viewer_view_product_media,
-                "adm_manage_users": handle_manage_users_start,
-                "adm_view_user": handle_view_user_profile,
-                "adm_adjust_balance_start": handle_adjust_balance_start,
-                "adm_toggle_ban": handle_toggle_ban_user,
-
-                # Reseller Management Handlers (from reseller_management.py)
-                "manage_resellers_menu": handle_manage_resellers_menu,
-                "reseller_toggle_status": handle_reseller_toggle_status,
-                "manage_reseller_discounts_select_reseller": handle_manage_reseller_discounts_select_reseller,
-                "reseller_manage_specific": handle_manage_specific_reseller_discounts,
-                "reseller_add_discount_select_type": handle_reseller_add_discount_select_type,
-                "reseller_add_discount_enter_percent": handle_reseller_add_discount_enter_percent,
-                "reseller_edit_discount": handle_reseller_edit_discount,
-                "reseller_delete_discount_confirm": handle_reseller_delete_discount_confirm,
-
-                # Stock Handler (from stock.py)
-                "view_stock": handle_view_stock,
-                
-                # User Search Handlers (from admin.py)
-                "adm_search_user_start": admin.handle_adm_search_user_start,
-                "adm_user_deposits": admin.handle_adm_user_deposits,
-                "adm_user_purchases": admin.handle_adm_user_purchases,
-                "adm_user_actions": admin.handle_adm_user_actions,
-                "adm_user_discounts": admin.handle_adm_user_discounts,
-                "adm_user_overview": admin.handle_adm_user_overview,
-                
-                # Worker Management Handlers (from admin.py)
-                "adm_manage_workers": admin.handle_adm_manage_workers,
-                "adm_add_worker": admin.handle_adm_add_worker,
-                "adm_remove_worker": admin.handle_adm_remove_worker,
-                "adm_confirm_remove_worker": admin.handle_adm_confirm_remove_worker,
-                "adm_execute_remove_worker": admin.handle_adm_execute_remove_worker,
-                
-                # Worker Panel Handlers (from worker.py)
-                "worker_panel": worker.handle_worker_panel,
-                "worker_city": worker.handle_worker_city,
-                "worker_dist": worker.handle_worker_dist,
-                "worker_type": worker.handle_worker_type,
-                "worker_add": worker.handle_worker_add,
-                "worker_size": worker.handle_worker_size,
-                "worker_custom_size": worker.handle_worker_custom_size,
-                "worker_cancel_add": worker.handle_worker_cancel_add,
-                # Worker Bulk Handlers
-                "worker_bulk_city": worker.handle_worker_bulk_city,
-                "worker_bulk_dist": worker.handle_worker_bulk_dist,
-                "worker_bulk_type": worker.handle_worker_bulk_type,
-                "worker_bulk_add": worker.handle_worker_bulk_add,
-                "worker_bulk_size": worker.handle_worker_bulk_size,
-                "worker_bulk_custom_size": worker.handle_worker_bulk_custom_size,
-                "worker_bulk_create_all": worker.handle_worker_bulk_create_all,
-                "worker_bulk_remove_last_message": worker.handle_worker_bulk_remove_last_message,
-                "worker_bulk_back_to_management": worker.handle_worker_bulk_back_to_management,
-                "worker_cancel_bulk_add": worker.handle_worker_cancel_bulk_add,
-                "close_menu": worker.handle_close_menu,
-            }
+            command, *params = query.data.split('|')
 
             target_func = KNOWN_HANDLERS.get(command)
 
-            if target_func and asyncio.iscoroutinefunction(target_func):
+            if target_func:
                 await target_func(update, context, params)
             else:
                 logger.warning(f"No async handler function found or mapped for callback command: {command}")
@@ -493,24 +496,52 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
              logger.exception(f"An unexpected error occurred during update handling for chat {chat_id} (User: {user_id}).")
              error_message = "An unexpected error occurred. Please contact support."
         try:
-            bot_instance = context.bot if hasattr(context, 'bot') else (telegram_app.bot if telegram_app else None)
+            bot_instance = getattr(context, 'bot', None) or (telegram_app.bot if telegram_app else None)
             if bot_instance: await send_message_with_retry(bot_instance, chat_id, error_message, parse_mode=None)
             else: logger.error("Could not get bot instance to send error message.")
         except Exception as e:
             logger.error(f"Failed to send error message to user {chat_id}: {e}")
 
 # --- Bot Setup Functions ---
+# The application is driven by hand (initialize/start, stop/shutdown) rather than run_webhook(), so PTB never calls
+# post_init/post_shutdown itself: setup_webhooks_and_run() and shutdown() in main() call them directly.
 async def post_init(application: Application) -> None:
     logger.info("Running post_init setup...")
     logger.info("Setting bot commands...")
-    await application.bot.set_my_commands([
-        BotCommand("start", "Start the bot / Main menu"),
-        BotCommand("admin", "Access admin panel (Admin only)"),
-    ])
+    try:
+        await application.bot.set_my_commands([
+            BotCommand("start", "Start the bot / Main menu"),
+            BotCommand("admin", "Access admin panel (Admin only)"),
+        ])
+    except Exception as e:
+        logger.error(f"Failed to set bot commands: {e}") # Not fatal; the writers below must still start
+    payment.start_pending_deposit_writer()
+    payment.start_unreserve_writer()
+    start_admin_log_writer()
     logger.info("Post_init finished.")
 
 async def post_shutdown(application: Application) -> None:
     logger.info("Running post_shutdown cleanup...")
+    try:
+        await payment.stop_pending_deposit_writer()
+    except Exception as e:
+        logger.error(f"Error stopping pending deposit writer: {e}", exc_info=True)
+    try:
+        await payment.stop_unreserve_writer()
+    except Exception as e:
+        logger.error(f"Error stopping un-reserve writer: {e}", exc_info=True)
+    try:
+        await payment.close_session()
+    except Exception as e:
+        logger.error(f"Error closing NOWPayments HTTP session: {e}", exc_info=True)
+    try:
+        await close_download_session()
+    except Exception as e:
+        logger.error(f"Error closing media download session: {e}", exc_info=True)
+    try:
+        await asyncio.to_thread(stop_admin_log_writer)
+    except Exception as e:
+        logger.error(f"Error stopping admin log writer: {e}", exc_info=True)
     logger.info("Post_shutdown finished.")
 
 async def clear_expired_baskets_job_wrapper(context: ContextTypes.DEFAULT_TYPE):
@@ -536,6 +567,19 @@ async def clean_expired_payments_job_wrapper(context: ContextTypes.DEFAULT_TYPE)
     except Exception as e:
         logger.error(f"Error in background job clean_expired_payments_job: {e}", exc_info=True)
 
+async def sweep_payment_intents_job_wrapper(context: ContextTypes.DEFAULT_TYPE):
+    logger.debug("Running background job: sweep_payment_intents_job")
+    try:
+        await asyncio.to_thread(payment.sweep_stuck_payment_intents)
+    except Exception as e:
+        logger.error(f"Error in background job sweep_payment_intents_job: {e}", exc_info=True)
+
+async def checkpoint_wal_job_wrapper(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await asyncio.to_thread(checkpoint_wal)
+    except Exception as e:
+        logger.error(f"Error in background job checkpoint_wal_job: {e}", exc_info=True)
+
 
 async def send_timeout_notifications(context: ContextTypes.DEFAULT_TYPE, user_notifications: list):
     """Send timeout notifications to users whose payments have expired."""
@@ -544,9 +588,8 @@ async def send_timeout_notifications(context: ContextTypes.DEFAULT_TYPE, user_no
         user_lang = user_notification['language']
         
         try:
-            lang_data = LANGUAGES.get(user_lang, LANGUAGES['en'])
-            notification_msg = lang_data.get("payment_timeout_notification", 
-                "⏰ Payment Timeout: Your payment for basket items has expired after 30 minutes. Reserved items have been released.")
+            lang_data = get_lang_view(user_lang)
+            notification_msg = lang_data["payment_timeout_notification"]
             
             await send_message_with_retry(context.bot, user_id, notification_msg, parse_mode=None)
             logger.info(f"Sent payment timeout notification to user {user_id}")
@@ -694,10 +737,13 @@ def nowpayments_webhook():
                 return Response("Internal error: App not ready", status=503)
 
             if is_purchase:
-                if actually_paid_decimal >= expected_crypto_decimal:
+                if actually_paid_decimal >= expected_crypto_decimal and not basket_snapshot:
+                    # Nothing to finalize: alert the admin and keep the pending record for the manual check
+                    asyncio.run_coroutine_threadsafe(payment.handle_missing_basket_snapshot(telegram_app.bot, payment_id, user_id), main_loop)
+                elif actually_paid_decimal >= expected_crypto_decimal:
                     logger.info(f"{log_prefix} {payment_id}: Sufficient payment received. Finalizing purchase.")
                     finalize_future = asyncio.run_coroutine_threadsafe(
-                        payment.process_successful_crypto_purchase(user_id, basket_snapshot, discount_code_used, payment_id, dummy_context),
+                        payment.process_successful_crypto_purchase(user_id, user_id, basket_snapshot, discount_code_used, payment_id, dummy_context), # Private chat: chat_id == user_id
                         main_loop
                     )
                     purchase_finalized = False
@@ -709,7 +755,7 @@ def nowpayments_webhook():
                         if overpaid_eur > Decimal('0.0'):
                             logger.info(f"{log_prefix} {payment_id}: Overpayment detected. Crediting {overpaid_eur:.2f} EUR to user {user_id} balance.")
                             credit_future = asyncio.run_coroutine_threadsafe(
-                                credit_user_balance(user_id, overpaid_eur, f"Overpayment on purchase {payment_id}", dummy_context),
+                                credit_user_balance(user_id, overpaid_eur, f"Overpayment on purchase {payment_id}", dummy_context, payment_id=f"{payment_id}:overpayment", kind=CreditKind.OVERPAYMENT),
                                 main_loop
                             )
                             try: credit_future.result(timeout=30)
@@ -724,7 +770,7 @@ def nowpayments_webhook():
                 else: # Underpayment
                     logger.warning(f"{log_prefix} {payment_id} UNDERPAID by user {user_id}. Crediting balance with received amount.")
                     credit_future = asyncio.run_coroutine_threadsafe(
-                         credit_user_balance(user_id, paid_eur_equivalent, f"Underpayment on purchase {payment_id}", dummy_context),
+                         credit_user_balance(user_id, paid_eur_equivalent, f"Underpayment on purchase {payment_id}", dummy_context, payment_id=f"{payment_id}:underpayment", kind=CreditKind.UNDERPAYMENT),
                          main_loop
                     )
                     credit_success = False
@@ -733,8 +779,11 @@ def nowpayments_webhook():
                     if not credit_success:
                          logger.critical(f"CRITICAL: Failed to credit balance for underpayment {payment_id} user {user_id}. Amount: {paid_eur_equivalent:.2f} EUR. MANUAL CHECK NEEDED!")
                          if ADMIN_ID: asyncio.run_coroutine_threadsafe(send_message_with_retry(telegram_app.bot, ADMIN_ID, f"⚠️ CRITICAL: Failed to credit balance for UNDERPAYMENT {payment_id} user {user_id}. Amount: {paid_eur_equivalent:.2f} EUR. MANUAL CHECK NEEDED!"), main_loop)
-                    lang_data_local = LANGUAGES.get(dummy_context.user_data.get("lang", "en"), LANGUAGES['en'])
-                    fail_msg_template = lang_data_local.get("crypto_purchase_underpaid_credited", "⚠️ Purchase Failed: Underpayment detected. Amount needed was {needed_eur} EUR. Your balance has been credited with the received value ({paid_eur} EUR). Your items were not delivered.")
+                    user_lang = 'en'
+                    try: user_lang = asyncio.run_coroutine_threadsafe(get_user_lang(user_id), main_loop).result(timeout=5)
+                    except Exception as lang_e: logger.error(f"Failed to get lang for user {user_id} notify: {lang_e}")
+                    lang_data_local = get_lang_view(user_lang)
+                    fail_msg_template = lang_data_local["crypto_purchase_underpaid_credited"]
                     fail_msg = fail_msg_template.format(needed_eur=format_currency(target_eur_decimal), paid_eur=format_currency(paid_eur_equivalent))
                     asyncio.run_coroutine_threadsafe(send_message_with_retry(telegram_app.bot, user_id, fail_msg, parse_mode=None), main_loop)
                     asyncio.run_coroutine_threadsafe(asyncio.to_thread(remove_pending_deposit, payment_id, trigger="failure"), main_loop)
@@ -781,19 +830,12 @@ def nowpayments_webhook():
             user_id = pending_info_for_removal['user_id']
             is_purchase_failure = pending_info_for_removal.get('is_purchase') == 1
             try:
-                conn_lang = None; user_lang = 'en'
-                try:
-                    conn_lang = get_db_connection()
-                    c_lang = conn_lang.cursor()
-                    c_lang.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-                    lang_res = c_lang.fetchone()
-                    if lang_res and lang_res['language'] in LANGUAGES: user_lang = lang_res['language']
+                user_lang = 'en'
+                try: user_lang = asyncio.run_coroutine_threadsafe(get_user_lang(user_id), main_loop).result(timeout=5)
                 except Exception as lang_e: logger.error(f"Failed to get lang for user {user_id} notify: {lang_e}")
-                finally:
-                     if conn_lang: conn_lang.close()
-                lang_data_local = LANGUAGES.get(user_lang, LANGUAGES['en'])
-                if is_purchase_failure: fail_msg = lang_data_local.get("crypto_purchase_failed", "Payment Failed/Expired. Your items are no longer reserved.")
-                else: fail_msg = lang_data_local.get("payment_cancelled_or_expired", "Payment Status: Your payment ({payment_id}) was cancelled or expired.").format(payment_id=payment_id)
+                lang_data_local = get_lang_view(user_lang)
+                if is_purchase_failure: fail_msg = lang_data_local["crypto_purchase_failed"]
+                else: fail_msg = lang_data_local["payment_cancelled_or_expired"].format(payment_id=payment_id)
                 dummy_context = ContextTypes.DEFAULT_TYPE(application=telegram_app, chat_id=user_id, user_id=user_id)
                 asyncio.run_coroutine_threadsafe(send_message_with_retry(telegram_app.bot, user_id, fail_msg, parse_mode=None), main_loop)
             except Exception as notify_e: logger.error(f"Error notifying user {user_id} about failed/expired payment {payment_id}: {notify_e}")
@@ -826,8 +868,8 @@ def main() -> None:
     load_all_data()
     defaults = Defaults(parse_mode=None, block=False)
     app_builder = ApplicationBuilder().token(TOKEN).defaults(defaults).job_queue(JobQueue())
-    app_builder.post_init(post_init)
-    app_builder.post_shutdown(post_shutdown)
+    # Wider keep-alive HTTP/2 pool for the Bot API so bursts of sends (purchase deliveries, notifications) reuse connections
+    app_builder.connection_pool_size(16).pool_timeout(10.0).connect_timeout(5.0).read_timeout(20.0).write_timeout(30.0).http_version("2")
     application = app_builder.build()
     application.add_handler(CommandHandler("start", user.start)) # Use user.start
     application.add_handler(CommandHandler("admin", handle_admin_command)) # Route to admin or worker panel
@@ -850,6 +892,13 @@ def main() -> None:
             logger.info("Background jobs setup complete (basket cleanup + payment timeout).")
         else: logger.warning("Job Queue is not available. Background jobs skipped.")
     else: logger.warning("BASKET_TIMEOUT is not positive. Skipping background job setup.")
+    # WAL checkpoints and the payment intent sweeper don't depend on baskets expiring, so they are scheduled regardless of BASKET_TIMEOUT
+    if application.job_queue:
+        # Refund balance purchases stuck between deduction and fulfillment, and close stale pending intents
+        application.job_queue.run_repeating(sweep_payment_intents_job_wrapper, interval=timedelta(minutes=5), first=timedelta(seconds=60), name="sweep_payment_intents")
+        application.job_queue.run_repeating(checkpoint_wal_job_wrapper, interval=timedelta(seconds=WAL_CHECKPOINT_INTERVAL), first=timedelta(seconds=WAL_CHECKPOINT_INTERVAL), name="checkpoint_wal")
+        disable_wal_autocheckpoint() # Only now that the job is registered
+    else: logger.warning("Job Queue is not available. Payment intent sweeper skipped; keeping SQLite's WAL autocheckpoint.")
 
     async def setup_webhooks_and_run():
         nonlocal application
@@ -862,6 +911,7 @@ def main() -> None:
             logger.error("Failed to set Telegram webhook.")
             return
         await application.start()
+        await post_init(application) # Starts the batched writers
         logger.info("Telegram application started (webhook mode).")
         port = int(os.environ.get("PORT", 10000))
         flask_thread = threading.Thread(target=lambda: flask_app.run(host='0.0.0.0', port=port, debug=False), daemon=True)
@@ -880,6 +930,8 @@ def main() -> None:
         logger.info("Shutting down application...")
         if application:
             await application.stop()
+            # Drain the batched writers and close the HTTP sessions before the task sweep below would cancel them
+            await post_shutdown(application)
             await application.shutdown()
         tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
         [task.cancel() for task in tasks]
@@ -7,11 +7,21 @@ import os # Added import
 import shutil # Added import
 import asyncio
 import uuid # For generating unique order IDs
-import requests # For making API calls to NOWPayments
+import aiohttp # For making API calls to NOWPayments
 from decimal import Decimal, ROUND_UP, ROUND_DOWN # Use Decimal for precision
 import json # For parsing potential error messages
-from datetime import datetime, timezone # Added import
-from collections import Counter, defaultdict # Added import
+import re
+try:
+    import orjson # Faster JSON for NOWPayments payloads (optional)
+except ImportError:
+    orjson = None
+from datetime import datetime, timedelta, timezone # Added import
+from collections import Counter, OrderedDict, defaultdict # Added import
+from concurrent.futures import ThreadPoolExecutor
+from enum import IntEnum
+from functools import lru_cache
+from pathlib import Path
+from types import SimpleNamespace
 
 # --- Telegram Imports ---
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -24,14 +34,15 @@ from telegram import InputMediaPhoto, InputMediaVideo, InputMediaAnimation # Imp
 
 # Import necessary items from utils and user
 from utils import ( # Ensure utils imports are correct
-    send_message_with_retry, format_currency, ADMIN_ID,
+    send_message_with_retry, format_currency, format_cents, to_cents, ADMIN_ID,
     LANGUAGES, load_all_data, BASKET_TIMEOUT, MIN_DEPOSIT_EUR,
     NOWPAYMENTS_API_KEY, NOWPAYMENTS_API_URL, WEBHOOK_URL,
     format_expiration_time, FEE_ADJUSTMENT,
-    add_pending_deposit, remove_pending_deposit, # Make sure add_pending_deposit is imported
-    get_nowpayments_min_amount,
-    get_db_connection, MEDIA_DIR, PRODUCT_TYPES, DEFAULT_PRODUCT_EMOJI, # Added PRODUCT_TYPES/Emoji
+    add_pending_deposit, add_pending_deposits_batch, remove_pending_deposit, # Make sure add_pending_deposit is imported
+    get_nowpayments_min_amount, min_amount_cache, get_lang_view, set_user_lang_cache,
+    get_db_connection, db_pool, db_read_pool, MEDIA_DIR, PRODUCT_TYPES, DEFAULT_PRODUCT_EMOJI, # Added PRODUCT_TYPES/Emoji
     clear_expired_basket, # Added import
+    _UNRESERVE_SQL,
     _get_lang_data, # <--- *** ADDED IMPORT HERE ***
     log_admin_action # <<< IMPORT log_admin_action >>>
 )
@@ -40,13 +51,15 @@ import user
 
 # --- Import Reseller Helper ---
 try:
-    from reseller_management import get_reseller_discount
+    from reseller_management import get_reseller_discount, get_reseller_discounts
 except ImportError:
     logger_dummy_reseller_payment = logging.getLogger(__name__ + "_dummy_reseller_payment")
     logger_dummy_reseller_payment.error("Could not import get_reseller_discount from reseller_management.py. Reseller discounts will not work in payment processing.")
     # Define a dummy function that always returns zero discount
     def get_reseller_discount(user_id: int, product_type: str) -> Decimal:
         return Decimal('0.0')
+    def get_reseller_discounts(user_id: int, product_types) -> dict:
+        return {}
 # -----------------------------
 
 # --- Import Unreserve Helper ---
@@ -67,44 +80,323 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# Single-thread executor for the un-reserve writes: it does a multi-row UPDATE + COMMIT, so running
+# these one at a time avoids SQLITE_BUSY between them without tying up the default pool.
+_DB_WRITE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db_write")
+
+# --- JSON Helpers for NOWPayments ---
+# Request bodies are serialized with orjson when installed. Responses always go through stdlib json with
+# parse_float=Decimal: orjson has no Decimal mode, and pay_amount / estimated_amount must not pass through a float.
+if orjson is not None:
+    _json_dumps = orjson.dumps
+else:
+    def _json_dumps(obj): return json.dumps(obj).encode()
+
+def _json_loads(data): return json.loads(data, parse_float=Decimal)
+
+def _as_decimal(value) -> Decimal:
+    """Returns value as a Decimal, only going through str() when it isn't one already."""
+    return value if isinstance(value, Decimal) else Decimal(str(value))
+
+_CRYPTO_QUANT = Decimal('0.00000001')
+
+def _fmt_crypto(amount: Decimal) -> str:
+    """Formats a crypto amount with up to 8 decimals and no trailing zeros."""
+    return format(amount.quantize(_CRYPTO_QUANT).normalize(), 'f')
+
+# --- Shared HTTP Session for NOWPayments ---
+# One keep-alive session for all NOWPayments calls instead of a thread + fresh TLS connection per request.
+_http_session: aiohttp.ClientSession | None = None
+# Caps concurrent NOWPayments calls to the per-host pool size so a slow API can't exhaust the connector
+_NOWPAYMENTS_SEMA = asyncio.Semaphore(20)
+
+def _get_session() -> aiohttp.ClientSession:
+    """Returns the shared aiohttp session, creating it on first use (must be called inside the event loop)."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300, enable_cleanup_closed=True)
+        _http_session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=20, connect=10))
+    return _http_session
+
+async def close_session():
+    """Closes the shared aiohttp session. Called from the bot's post_shutdown hook."""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+        logger.info("Closed NOWPayments HTTP session.")
+    _http_session = None
+
+
+# --- Telegram Send Pacing ---
+# Purchase deliveries fire many sends at one chat. They go out concurrently under the bot-wide 30 msg/s limit;
+# a chat is only slowed down once Telegram answers 429 (RetryAfter), for as long as Telegram asks.
+TELEGRAM_GLOBAL_SENDS_PER_SECOND = 30
+PACED_SEND_MAX_ATTEMPTS = 3
+CHAT_BACKOFF_MAX_ENTRIES = 1024 # Chats currently backing off; expired entries are dropped on the next lookup
+_chat_backoff_until: OrderedDict[int, float] = OrderedDict()
+_global_send_sema = asyncio.Semaphore(TELEGRAM_GLOBAL_SENDS_PER_SECOND)
+
+def _chat_backoff_remaining(chat_id: int) -> float:
+    """Seconds left on the chat's 429 backoff (0.0 if none); forgets the chat once it has expired."""
+    until = _chat_backoff_until.get(chat_id)
+    if until is None: return 0.0
+    remaining = until - time.monotonic()
+    if remaining <= 0:
+        _chat_backoff_until.pop(chat_id, None)
+        return 0.0
+    return remaining
+
+def _note_chat_backoff(chat_id: int, seconds: float):
+    _chat_backoff_until[chat_id] = max(_chat_backoff_until.get(chat_id, 0.0), time.monotonic() + seconds)
+    _chat_backoff_until.move_to_end(chat_id)
+    while len(_chat_backoff_until) > CHAT_BACKOFF_MAX_ENTRIES: _chat_backoff_until.popitem(last=False)
+
+async def paced_send(chat_id: int, coro_factory):
+    """Awaits coro_factory() once a global send slot is free (each slot is held for a full second after its send starts).
+    On RetryAfter the chat backs off for the requested time and the send is retried, up to PACED_SEND_MAX_ATTEMPTS."""
+    for attempt in range(PACED_SEND_MAX_ATTEMPTS):
+        wait = _chat_backoff_remaining(chat_id)
+        if wait > 0: await asyncio.sleep(wait)
+        await _global_send_sema.acquire()
+        started = time.monotonic()
+        try:
+            return await coro_factory()
+        except telegram_error.RetryAfter as e:
+            if attempt == PACED_SEND_MAX_ATTEMPTS - 1: raise
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            logger.warning(f"Telegram rate limit for chat {chat_id}: backing off {retry_after}s (attempt {attempt + 1}).")
+            _note_chat_backoff(chat_id, retry_after)
+        finally:
+            asyncio.get_running_loop().call_later(max(0.0, 1.0 - (time.monotonic() - started)), _global_send_sema.release)
+
+
+# --- Batched Pending Deposit Writer ---
+# Invoices queue their pending_deposits row here; one background task commits them in batches
+# (up to PENDING_DEPOSIT_MAX_BATCH rows or PENDING_DEPOSIT_BATCH_TIMEOUT seconds) with a single thread hop.
+PENDING_DEPOSIT_MAX_BATCH = 32
+PENDING_DEPOSIT_BATCH_TIMEOUT = 0.2
+_pending_deposit_queue: asyncio.Queue | None = None
+_pending_deposit_writer_task: asyncio.Task | None = None
+_PENDING_DEPOSIT_STOP = object() # Queued by stop_pending_deposit_writer; the writer flushes what it holds and returns
+
+async def _write_pending_deposit_batch(batch: list):
+    """Writes one batch of (deposit_kwargs, future) items and resolves each future with its success flag."""
+    try:
+        results = await asyncio.to_thread(add_pending_deposits_batch, [deposit for deposit, _ in batch])
+    except Exception as e:
+        logger.error(f"Pending deposit writer failed to store batch of {len(batch)}: {e}", exc_info=True)
+        results = [False] * len(batch)
+    for (_, future), success in zip(batch, results):
+        if not future.done(): future.set_result(success)
+
+async def _pending_deposit_writer():
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await _pending_deposit_queue.get()
+        if item is _PENDING_DEPOSIT_STOP: return
+        batch = [item]
+        deadline = loop.time() + PENDING_DEPOSIT_BATCH_TIMEOUT
+        stop = False
+        while len(batch) < PENDING_DEPOSIT_MAX_BATCH:
+            remaining = deadline - loop.time()
+            if remaining <= 0: break
+            try: item = await asyncio.wait_for(_pending_deposit_queue.get(), remaining)
+            except asyncio.TimeoutError: break
+            if item is _PENDING_DEPOSIT_STOP: stop = True; break
+            batch.append(item)
+        await _write_pending_deposit_batch(batch)
+        if stop: return
+
+def start_pending_deposit_writer():
+    """Starts the background pending deposit writer. Called from the bot's post_init hook."""
+    global _pending_deposit_queue, _pending_deposit_writer_task
+    if _pending_deposit_writer_task is None or _pending_deposit_writer_task.done():
+        _pending_deposit_queue = asyncio.Queue()
+        _pending_deposit_writer_task = asyncio.create_task(_pending_deposit_writer())
+        logger.info("Started pending deposit writer.")
+
+async def stop_pending_deposit_writer():
+    """Stops the writer after it has stored everything queued so far. Called from the bot's post_shutdown hook."""
+    global _pending_deposit_writer_task
+    task, _pending_deposit_writer_task = _pending_deposit_writer_task, None
+    if task is None: return
+    # A sentinel rather than cancel(): a batch already taken off the queue is still written and its futures resolved
+    _pending_deposit_queue.put_nowait(_PENDING_DEPOSIT_STOP)
+    try: await task
+    except asyncio.CancelledError: pass
+    except Exception as e: logger.error(f"Pending deposit writer exited with an error: {e}", exc_info=True)
+    # Only non-empty if the writer had already died, in which case the sentinel is still queued too
+    leftover = []
+    while not _pending_deposit_queue.empty():
+        item = _pending_deposit_queue.get_nowait()
+        if item is not _PENDING_DEPOSIT_STOP: leftover.append(item)
+    if leftover: await _write_pending_deposit_batch(leftover)
+    logger.info("Stopped pending deposit writer.")
+
+async def _store_pending_deposit(**deposit) -> bool:
+    """Queues a pending deposit for the batched writer; writes directly if the writer isn't running."""
+    if _pending_deposit_writer_task is None or _pending_deposit_writer_task.done():
+        return await asyncio.to_thread(add_pending_deposit, **deposit)
+    future = asyncio.get_running_loop().create_future()
+    await _pending_deposit_queue.put((deposit, future))
+    return await future
+
+
+# --- Batched Un-reserve Writer ---
+# Failed/cancelled payments queue their basket snapshot here; one background task drains up to UNRESERVE_MAX_BATCH
+# snapshots (or whatever arrives within UNRESERVE_BATCH_TIMEOUT seconds) and releases them all with one
+# _unreserve_basket_items call, i.e. one UPDATE in one transaction, on the serialized DB write executor.
+UNRESERVE_MAX_BATCH = 64
+UNRESERVE_BATCH_TIMEOUT = 0.2
+_unreserve_queue: asyncio.Queue | None = None
+_unreserve_writer_task: asyncio.Task | None = None
+_UNRESERVE_STOP = object() # Queued by stop_unreserve_writer; the writer releases what it holds and returns
+
+async def _write_unreserve_batch(batch: list):
+    items = [item for snapshot in batch for item in snapshot]
+    try:
+        await asyncio.get_running_loop().run_in_executor(_DB_WRITE_EXECUTOR, _unreserve_basket_items, items)
+    except Exception as e:
+        logger.error(f"Un-reserve writer failed to release {len(batch)} basket(s): {e}", exc_info=True)
+
+async def _unreserve_writer():
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await _unreserve_queue.get()
+        if item is _UNRESERVE_STOP: return
+        batch = [item]
+        deadline = loop.time() + UNRESERVE_BATCH_TIMEOUT
+        stop = False
+        while len(batch) < UNRESERVE_MAX_BATCH:
+            remaining = deadline - loop.time()
+            if remaining <= 0: break
+            try: item = await asyncio.wait_for(_unreserve_queue.get(), remaining)
+            except asyncio.TimeoutError: break
+            if item is _UNRESERVE_STOP: stop = True; break
+            batch.append(item)
+        await _write_unreserve_batch(batch)
+        if stop: return
+
+def start_unreserve_writer():
+    """Starts the background un-reserve writer. Called from the bot's post_init hook."""
+    global _unreserve_queue, _unreserve_writer_task
+    if _unreserve_writer_task is None or _unreserve_writer_task.done():
+        _unreserve_queue = asyncio.Queue()
+        _unreserve_writer_task = asyncio.create_task(_unreserve_writer())
+        logger.info("Started un-reserve writer.")
+
+async def stop_unreserve_writer():
+    """Stops the writer after it has released everything queued so far. Called from the bot's post_shutdown hook."""
+    global _unreserve_writer_task
+    task, _unreserve_writer_task = _unreserve_writer_task, None
+    if task is None: return
+    # A sentinel rather than cancel(), so a batch already taken off the queue is still released
+    _unreserve_queue.put_nowait(_UNRESERVE_STOP)
+    try: await task
+    except asyncio.CancelledError: pass
+    except Exception as e: logger.error(f"Un-reserve writer exited with an error: {e}", exc_info=True)
+    # Only non-empty if the writer had already died, in which case the sentinel is still queued too
+    leftover = []
+    while not _unreserve_queue.empty():
+        item = _unreserve_queue.get_nowait()
+        if item is not _UNRESERVE_STOP: leftover.append(item)
+    if leftover: await _write_unreserve_batch(leftover)
+    logger.info("Stopped un-reserve writer.")
+
+async def release_basket_reservations(basket_snapshot: list | None):
+    """Queues a basket snapshot for un-reserving without waiting on the write; releases directly if the writer isn't running."""
+    if not basket_snapshot: return
+    if _unreserve_writer_task is None or _unreserve_writer_task.done():
+        await _write_unreserve_batch([basket_snapshot])
+        return
+    _unreserve_queue.put_nowait(basket_snapshot)
+
+
 # --- NEW: Helper to get NOWPayments Estimate ---
+# Estimate calls currently in flight, keyed by "amount:currency". Identical concurrent requests share one API call.
+_inflight_estimates: dict[str, asyncio.Future] = {}
+
+# Last EUR->crypto rate seen per currency, used to answer repeat estimates locally for a short while
+ESTIMATE_RATE_CACHE_TTL = 30 # seconds
+_estimate_rate_cache: dict[str, tuple[Decimal, float]] = {}
+
+def _get_cached_estimate(target_eur_amount: Decimal, currency_lower: str) -> dict | None:
+    """Builds an estimate from the cached rate, or returns None if there is no fresh rate or the amount is close to the API minimum."""
+    entry = _estimate_rate_cache.get(currency_lower)
+    if entry is None: return None
+    rate, expires_at = entry
+    if time.monotonic() >= expires_at:
+        _estimate_rate_cache.pop(currency_lower, None)
+        return None
+    estimated = (target_eur_amount * rate).quantize(Decimal('0.00000001'), rounding=ROUND_UP)
+    cached_min = min_amount_cache.get(currency_lower)
+    # Near (or unknown) minimum the exact figure matters, so let the API decide
+    if cached_min is None or estimated < cached_min[0] * Decimal('1.1'): return None
+    return {'currency_from': 'eur', 'amount_from': target_eur_amount, 'currency_to': currency_lower, 'estimated_amount': estimated}
+
 async def _get_nowpayments_estimate(target_eur_amount: Decimal, pay_currency_code: str) -> dict:
+    """Gets the estimated crypto amount, from the short-lived rate cache or by coalescing identical in-flight requests into one API call."""
+    currency_lower = pay_currency_code.lower()
+    cached = _get_cached_estimate(target_eur_amount, currency_lower)
+    if cached is not None:
+        logger.debug(f"Using cached NOWPayments rate for {target_eur_amount} EUR to {currency_lower}: {cached['estimated_amount']}")
+        return cached
+
+    key = f"{target_eur_amount:.2f}:{currency_lower}"
+    existing = _inflight_estimates.get(key)
+    if existing is not None:
+        logger.debug(f"Joining in-flight NOWPayments estimate request for {key}")
+        return dict(await asyncio.shield(existing))
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight_estimates[key] = future
+    try:
+        result = await _fetch_nowpayments_estimate(target_eur_amount, pay_currency_code)
+        if 'error' not in result and target_eur_amount > 0:
+            rate = _as_decimal(result['estimated_amount']) / target_eur_amount
+            _estimate_rate_cache[currency_lower] = (rate, time.monotonic() + ESTIMATE_RATE_CACHE_TTL)
+        future.set_result(result)
+        return result
+    finally:
+        if not future.done(): future.set_result({'error': 'internal_estimate_error', 'details': 'Estimate request cancelled'})
+        _inflight_estimates.pop(key, None)
+
+
+async def _fetch_nowpayments_estimate(target_eur_amount: Decimal, pay_currency_code: str) -> dict:
     """Gets the estimated crypto amount from NOWPayments API."""
     if not NOWPAYMENTS_API_KEY:
         return {'error': 'payment_api_misconfigured'}
 
     estimate_url = f"{NOWPAYMENTS_API_URL}/v1/estimate"
     params = {
-        'amount': float(target_eur_amount),
+        'amount': str(float(target_eur_amount)),
         'currency_from': 'eur',
         'currency_to': pay_currency_code.lower()
     }
     headers = {'x-api-key': NOWPAYMENTS_API_KEY}
 
     try:
-        def make_estimate_request():
-            try:
-                response = requests.get(estimate_url, params=params, headers=headers, timeout=15)
-                logger.debug(f"NOWPayments estimate response status: {response.status_code}, content: {response.text[:200]}")
-                response.raise_for_status()
-                return response.json()
-            except requests.exceptions.Timeout:
-                logger.error(f"NOWPayments estimate request timed out for {target_eur_amount} EUR to {pay_currency_code}.")
-                return {'error': 'estimate_api_timeout'}
-            except requests.exceptions.RequestException as e:
-                logger.error(f"NOWPayments estimate request error for {target_eur_amount} EUR to {pay_currency_code}: {e}")
-                # Try to parse error message if available
-                error_detail = str(e)
-                if e.response is not None:
-                     error_detail = f"Status {e.response.status_code}: {e.response.text[:200]}"
-                     if "currencies not found" in e.response.text.lower():
-                         return {'error': 'estimate_currency_not_found', 'currency': pay_currency_code.upper()}
-                return {'error': 'estimate_api_request_failed', 'details': error_detail}
-            except Exception as e:
-                 logger.error(f"Unexpected error during NOWPayments estimate call: {e}", exc_info=True)
-                 return {'error': 'estimate_api_unexpected_error', 'details': str(e)}
-
-        estimate_data = await asyncio.to_thread(make_estimate_request)
+        session = _get_session()
+        try:
+            async with _NOWPAYMENTS_SEMA, session.get(estimate_url, params=params, headers=headers, timeout=aiohttp.ClientTimeout(total=15)) as response:
+                body = await response.read()
+                if logger.isEnabledFor(logging.DEBUG): logger.debug("NOWPayments estimate response status: %s, content: %r", response.status, body[:200])
+                if response.status >= 400:
+                    response_text = body.decode('utf-8', errors='replace')
+                    logger.error(f"NOWPayments estimate request error for {target_eur_amount} EUR to {pay_currency_code}: Status {response.status}")
+                    if "currencies not found" in response_text.lower():
+                        return {'error': 'estimate_currency_not_found', 'currency': pay_currency_code.upper()}
+                    return {'error': 'estimate_api_request_failed', 'details': f"Status {response.status}: {response_text[:200]}"}
+                estimate_data = _json_loads(body)
+        except asyncio.TimeoutError:
+            logger.error(f"NOWPayments estimate request timed out for {target_eur_amount} EUR to {pay_currency_code}.")
+            return {'error': 'estimate_api_timeout'}
+        except aiohttp.ClientError as e:
+            logger.error(f"NOWPayments estimate request error for {target_eur_amount} EUR to {pay_currency_code}: {e}")
+            return {'error': 'estimate_api_request_failed', 'details': str(e)}
+        except Exception as e:
+             logger.exception(f"Unexpected error during NOWPayments estimate call: {e}")
+             return {'error': 'estimate_api_unexpected_error', 'details': str(e)}
 
         # Validate response structure
         if 'error' not in estimate_data and 'estimated_amount' not in estimate_data:
@@ -139,8 +431,12 @@ async def create_nowpayments_payment(
     log_type = "direct purchase" if is_purchase else "refill"
     logger.info(f"Attempting to create NOWPayments {log_type} invoice for user {user_id}, {target_eur_amount} EUR via {pay_currency_code}")
 
-    # 1. Get Estimate from NOWPayments
-    estimate_result = await _get_nowpayments_estimate(target_eur_amount, pay_currency_code)
+    # 1. Get Estimate and Minimum Payment Amount from NOWPayments (independent, so fetched concurrently)
+    # The minimum is cached in utils; only a cache miss does a (blocking) HTTP call, so it runs in a thread
+    estimate_result, min_amount_api = await asyncio.gather(
+        _get_nowpayments_estimate(target_eur_amount, pay_currency_code),
+        asyncio.to_thread(get_nowpayments_min_amount, pay_currency_code)
+    )
 
     if 'error' in estimate_result:
         logger.error(f"Failed to get estimate for {target_eur_amount} EUR to {pay_currency_code}: {estimate_result}")
@@ -148,11 +444,10 @@ async def create_nowpayments_payment(
              return {'error': 'estimate_currency_not_found', 'currency': estimate_result.get('currency', pay_currency_code.upper())}
         return {'error': 'estimate_failed'} # Generic estimate failure
 
-    estimated_crypto_amount = Decimal(str(estimate_result['estimated_amount']))
+    estimated_crypto_amount = _as_decimal(estimate_result['estimated_amount'])
     logger.info(f"NOWPayments estimated {estimated_crypto_amount} {pay_currency_code} needed for {target_eur_amount} EUR")
 
     # 2. Check Minimum Payment Amount from NOWPayments
-    min_amount_api = get_nowpayments_min_amount(pay_currency_code)
     if min_amount_api is None:
         logger.error(f"Could not fetch minimum payment amount for {pay_currency_code} from NOWPayments API.")
         return {'error': 'min_amount_fetch_error', 'currency': pay_currency_code.upper()}
@@ -163,7 +458,7 @@ async def create_nowpayments_payment(
          return {
              'error': 'basket_pay_too_low',
              'currency': pay_currency_code.upper(),
-             'min_amount': f"{min_amount_api:.8f}".rstrip('0').rstrip('.'), # Format min amount nicely
+             'min_amount': _fmt_crypto(min_amount_api), # Format min amount nicely
              'basket_total': format_currency(target_eur_amount)
          }
 
@@ -175,7 +470,8 @@ async def create_nowpayments_payment(
 
     # 3. Prepare API Request Data
     order_id_prefix = "PURCHASE" if is_purchase else "REFILL"
-    order_id = f"USER{user_id}_{order_id_prefix}_{int(time.time())}_{uuid.uuid4().hex[:6]}"
+    # U<user_id><P|R><12 random hex chars>; the random part alone is collision-safe, NOWPayments records the creation time
+    order_id = f"U{user_id}{order_id_prefix[0]}{uuid.uuid4().hex[:12]}"
     ipn_callback_url = f"{WEBHOOK_URL}/webhook"
     order_desc = f"Basket purchase for user {user_id}" if is_purchase else f"Balance top-up for user {user_id}"
 
@@ -193,37 +489,39 @@ async def create_nowpayments_payment(
 
     # 4. Make Payment Creation API Call
     try:
-        def make_payment_request():
-            try:
-                response = requests.post(payment_url, headers=headers, json=payload, timeout=20)
-                logger.debug(f"NOWPayments create payment response status: {response.status_code}, content: {response.text[:200]}")
-                response.raise_for_status()
-                return response.json()
-            except requests.exceptions.Timeout:
-                 logger.error(f"NOWPayments payment API request timed out for order {order_id}.")
-                 return {'error': 'api_timeout', 'internal': True}
-            except requests.exceptions.RequestException as e:
-                 logger.error(f"NOWPayments payment API request error for order {order_id}: {e}", exc_info=True)
-                 status_code = e.response.status_code if e.response is not None else None
-                 error_content = e.response.text if e.response is not None else "No response content"
-                 if status_code == 401: return {'error': 'api_key_invalid'}
-                 if status_code == 400 and "AMOUNT_MINIMAL_ERROR" in error_content:
-                     logger.warning(f"NOWPayments rejected payment for {order_id} due to amount minimal error (API check).")
-                     min_amount_fallback = f"{min_amount_api:.8f}".rstrip('0').rstrip('.')
-                     # Return specific error information
-                     return {
-                         'error': 'amount_too_low_api',
-                         'currency': pay_currency_code.upper(),
-                         'min_amount': min_amount_fallback,
-                         'crypto_amount': f"{invoice_crypto_amount:.8f}".rstrip('0').rstrip('.'),
-                         'target_eur_amount': target_eur_amount # Pass original EUR target
-                     }
-                 return {'error': 'api_request_failed', 'details': str(e), 'status': status_code, 'content': error_content[:200]}
-            except Exception as e:
-                 logger.error(f"Unexpected error during NOWPayments payment API call for order {order_id}: {e}", exc_info=True)
-                 return {'error': 'api_unexpected_error', 'details': str(e)}
-
-        payment_data = await asyncio.to_thread(make_payment_request)
+        session = _get_session()
+        try:
+            async with _NOWPAYMENTS_SEMA, session.post(payment_url, headers=headers, data=_json_dumps(payload), timeout=aiohttp.ClientTimeout(total=20)) as response:
+                body = await response.read()
+                if logger.isEnabledFor(logging.DEBUG): logger.debug("NOWPayments create payment response status: %s, content: %r", response.status, body[:200])
+                if response.status >= 400:
+                    response_text = body.decode('utf-8', errors='replace')
+                    logger.error(f"NOWPayments payment API request error for order {order_id}: Status {response.status}")
+                    if response.status == 401: payment_data = {'error': 'api_key_invalid'}
+                    elif response.status == 400 and "AMOUNT_MINIMAL_ERROR" in response_text:
+                        logger.warning(f"NOWPayments rejected payment for {order_id} due to amount minimal error (API check).")
+                        min_amount_fallback = _fmt_crypto(min_amount_api)
+                        # Return specific error information
+                        payment_data = {
+                            'error': 'amount_too_low_api',
+                            'currency': pay_currency_code.upper(),
+                            'min_amount': min_amount_fallback,
+                            'crypto_amount': _fmt_crypto(invoice_crypto_amount),
+                            'target_eur_amount': target_eur_amount # Pass original EUR target
+                        }
+                    else: payment_data = {'error': 'api_request_failed', 'details': f"HTTP {response.status}", 'status': response.status, 'content': response_text[:200]}
+                else:
+                    payment_data = _json_loads(body)
+        except asyncio.TimeoutError:
+             logger.error(f"NOWPayments payment API request timed out for order {order_id}.")
+             payment_data = {'error': 'api_timeout', 'internal': True}
+        except aiohttp.ClientError as e:
+             logger.error(f"NOWPayments payment API request error for order {order_id}: {e}") # Expected network failure, no traceback
+             payment_data = {'error': 'api_request_failed', 'details': str(e), 'status': None, 'content': "No response content"}
+        except Exception as e:
+             logger.exception(f"Unexpected error during NOWPayments payment API call for order {order_id}: {e}")
+             payment_data = {'error': 'api_unexpected_error', 'details': str(e)}
+
         if 'error' in payment_data:
              if payment_data['error'] == 'api_key_invalid': logger.critical("NOWPayments API Key seems invalid!")
              elif payment_data.get('internal'): logger.error("Internal error during API request (e.g., timeout).")
@@ -238,16 +536,15 @@ async def create_nowpayments_payment(
              return {'error': 'invalid_api_response'}
 
         # Store the *actual* crypto amount required by the invoice
-        expected_crypto_amount_from_invoice = Decimal(str(payment_data['pay_amount']))
-        payment_data['target_eur_amount_orig'] = float(target_eur_amount) # Store the FINAL EUR amount requested
-        payment_data['pay_amount'] = f"{expected_crypto_amount_from_invoice:.8f}".rstrip('0').rstrip('.') # Store formatted crypto amount
+        expected_crypto_amount_from_invoice = _as_decimal(payment_data['pay_amount'])
+        payment_data['target_eur_amount_orig'] = target_eur_amount # Store the FINAL EUR amount requested (Decimal)
+        payment_data['pay_amount'] = _fmt_crypto(expected_crypto_amount_from_invoice) # Store formatted crypto amount
         payment_data['is_purchase'] = is_purchase # Pass flag through response for display logic
 
         # 6. Store Pending Deposit Info
-        add_success = await asyncio.to_thread(
-            add_pending_deposit,
-            payment_data['payment_id'], user_id, payment_data['pay_currency'],
-            float(target_eur_amount), float(expected_crypto_amount_from_invoice), # Store the actual invoice amount
+        add_success = await _store_pending_deposit(
+            payment_id=payment_data['payment_id'], user_id=user_id, currency=payment_data['pay_currency'],
+            target_eur_amount=float(target_eur_amount), expected_crypto_amount=float(expected_crypto_amount_from_invoice), # Store the actual invoice amount
             is_purchase=is_purchase,
             basket_snapshot=basket_snapshot, # Store the snapshot
             discount_code=discount_code      # Store general discount code used
@@ -265,6 +562,71 @@ async def create_nowpayments_payment(
         return {'error': 'internal_server_error', 'details': str(e)}
 
 
+# --- Cached Strings for the Crypto Selection Handlers ---
+@lru_cache(maxsize=len(LANGUAGES) + 1)
+def _get_payment_strings(lang: str) -> SimpleNamespace:
+    """Resolves the invoice/error strings used by the crypto selection handlers once per language."""
+    lang_data = get_lang_view(lang)
+    return SimpleNamespace(
+        preparing_invoice=lang_data["preparing_invoice"],
+        failed_invoice_creation=lang_data["failed_invoice_creation"],
+        error_nowpayments_api=lang_data["error_nowpayments_api"],
+        error_invalid_response=lang_data["error_invalid_nowpayments_response"],
+        error_api_key=lang_data["error_nowpayments_api_key"],
+        error_pending_db=lang_data["payment_pending_db_error"],
+        error_amount_too_low_api=lang_data["payment_amount_too_low_api"],
+        error_min_amount_fetch=lang_data["error_min_amount_fetch"],
+        error_estimate_failed=lang_data["error_estimate_failed"],
+        error_estimate_currency_not_found=lang_data["error_estimate_currency_not_found"],
+        error_basket_pay_too_low=lang_data["basket_pay_too_low"]
+    )
+
+# Back buttons for the handlers' error messages, built once per language at import
+_BACK_PROFILE_MARKUPS: dict[str, InlineKeyboardMarkup] = {
+    code: InlineKeyboardMarkup([[InlineKeyboardButton(f"⬅️ {data.get('back_profile_button', 'Back to Profile')}", callback_data="profile")]])
+    for code, data in LANGUAGES.items()
+}
+_BACK_BASKET_MARKUPS: dict[str, InlineKeyboardMarkup] = {
+    code: InlineKeyboardMarkup([[InlineKeyboardButton(f"⬅️ {data.get('back_basket_button', 'Back to Basket')}", callback_data="view_basket")]])
+    for code, data in LANGUAGES.items()
+}
+
+
+# --- Invoice Error Messages ---
+# Maps create_nowpayments_payment error codes to the user-facing message. Formatters take
+# (strings, payment_result, asset_code, target_eur_amount); unknown codes fall back to failed_invoice_creation.
+def _format_amount_too_low_api(s, pr, asset_code, target_eur_amount):
+    return s.error_amount_too_low_api.format(
+        target_eur_amount=format_currency(pr.get('target_eur_amount', target_eur_amount)),
+        currency=pr.get('currency', asset_code.upper()),
+        crypto_amount=pr.get('crypto_amount', 'N/A'), min_amount=pr.get('min_amount', 'N/A'))
+
+def _format_api_error(s, pr, asset_code, target_eur_amount):
+    return s.error_nowpayments_api
+
+_ERROR_FORMATTERS = {
+    'basket_pay_too_low': lambda s, pr, asset_code, eur: s.error_basket_pay_too_low.format(basket_total=pr.get('basket_total', 'N/A'), currency=pr.get('currency', asset_code.upper())),
+    'estimate_failed': lambda s, pr, asset_code, eur: s.error_estimate_failed,
+    'estimate_currency_not_found': lambda s, pr, asset_code, eur: s.error_estimate_currency_not_found.format(currency=pr.get('currency', asset_code.upper())),
+    'min_amount_fetch_error': lambda s, pr, asset_code, eur: s.error_min_amount_fetch.format(currency=pr.get('currency', asset_code.upper())),
+    'api_key_invalid': lambda s, pr, asset_code, eur: s.error_api_key,
+    'invalid_api_response': lambda s, pr, asset_code, eur: s.error_invalid_response,
+    'pending_db_error': lambda s, pr, asset_code, eur: s.error_pending_db,
+    'amount_too_low_api': _format_amount_too_low_api,
+    'api_timeout': _format_api_error,
+    'api_request_failed': _format_api_error,
+    'api_unexpected_error': _format_api_error,
+    'internal_server_error': _format_api_error,
+    'internal_estimate_error': _format_api_error,
+}
+
+def _format_invoice_error(strings: SimpleNamespace, payment_result: dict, asset_code: str, target_eur_amount: Decimal) -> str:
+    """Returns the localized message for a failed invoice creation result."""
+    formatter = _ERROR_FORMATTERS.get(payment_result.get('error'))
+    if formatter is None: return strings.failed_invoice_creation
+    return formatter(strings, payment_result, asset_code, target_eur_amount)
+
+
 # --- Callback Handler for Crypto Selection during Refill ---
 async def handle_select_refill_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles the user selecting the crypto asset for refill, creates NOWPayments invoice."""
@@ -272,7 +634,7 @@ async def handle_select_refill_crypto(update: Update, context: ContextTypes.DEFA
     user_id = query.from_user.id
     chat_id = query.message.chat_id
     lang = context.user_data.get("lang", "en") # Get language
-    lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
+    strings = _get_payment_strings(lang)
 
     if not params:
         logger.warning(f"handle_select_refill_crypto called without asset parameter for user {user_id}")
@@ -282,30 +644,19 @@ async def handle_select_refill_crypto(update: Update, context: ContextTypes.DEFA
     selected_asset_code = params[0].lower()
     logger.info(f"User {user_id} selected {selected_asset_code} for refill.")
 
-    refill_eur_amount_float = context.user_data.get('refill_eur_amount')
-    if not refill_eur_amount_float or refill_eur_amount_float <= 0:
+    refill_eur_amount = context.user_data.get('refill_eur_amount') # Stored as Decimal by user.py
+    if not refill_eur_amount or refill_eur_amount <= 0:
         logger.error(f"Refill amount context lost before asset selection for user {user_id}.")
         await query.edit_message_text("❌ Error: Refill amount context lost. Please start the top up again.", parse_mode=None)
         context.user_data.pop('state', None)
         return
 
-    refill_eur_amount_decimal = Decimal(str(refill_eur_amount_float))
-
-    preparing_invoice_msg = lang_data.get("preparing_invoice", "⏳ Preparing your payment invoice...")
-    failed_invoice_creation_msg = lang_data.get("failed_invoice_creation", "❌ Failed to create payment invoice. Please try again later or contact support.")
-    error_nowpayments_api_msg = lang_data.get("error_nowpayments_api", "❌ Payment API Error: Could not create payment. Please try again later or contact support.")
-    error_invalid_response_msg = lang_data.get("error_invalid_nowpayments_response", "❌ Payment API Error: Invalid response received. Please contact support.")
-    error_api_key_msg = lang_data.get("error_nowpayments_api_key", "❌ Payment API Error: Invalid API key. Please contact support.")
-    error_pending_db_msg = lang_data.get("payment_pending_db_error", "❌ Database Error: Could not record pending payment. Please contact support.")
-    error_amount_too_low_api_msg = lang_data.get("payment_amount_too_low_api", "❌ Payment Amount Too Low: The equivalent of {target_eur_amount} EUR in {currency} ({crypto_amount}) is below the minimum required by the payment provider ({min_amount} {currency}). Please try a higher EUR amount.")
-    error_min_amount_fetch_msg = lang_data.get("error_min_amount_fetch", "❌ Error: Could not retrieve minimum payment amount for {currency}. Please try again later or select a different currency.")
-    error_estimate_failed_msg = lang_data.get("error_estimate_failed", "❌ Error: Could not estimate crypto amount. Please try again or select a different currency.")
-    error_estimate_currency_not_found_msg = lang_data.get("error_estimate_currency_not_found", "❌ Error: Currency {currency} not supported for estimation. Please select a different currency.")
-    back_to_profile_button = lang_data.get("back_profile_button", "Back to Profile")
-    back_button_markup = InlineKeyboardMarkup([[InlineKeyboardButton(f"⬅️ {back_to_profile_button}", callback_data="profile")]])
+    refill_eur_amount_decimal = _as_decimal(refill_eur_amount)
+
+    back_button_markup = _BACK_PROFILE_MARKUPS.get(lang, _BACK_PROFILE_MARKUPS['en'])
 
     try:
-        await query.edit_message_text(preparing_invoice_msg, reply_markup=None, parse_mode=None)
+        await query.edit_message_text(strings.preparing_invoice, reply_markup=None, parse_mode=None)
     except telegram_error.BadRequest as e:
         if "message is not modified" not in str(e).lower(): logger.warning(f"Couldn't edit message in handle_select_refill_crypto: {e}")
         await query.answer("Preparing...")
@@ -320,19 +671,7 @@ async def handle_select_refill_crypto(update: Update, context: ContextTypes.DEFA
         error_code = payment_result['error']
         logger.error(f"Failed to create NOWPayments refill invoice for user {user_id}: {error_code} - Details: {payment_result}")
 
-        error_message_to_user = failed_invoice_creation_msg # Default error
-        if error_code == 'estimate_failed': error_message_to_user = error_estimate_failed_msg
-        elif error_code == 'estimate_currency_not_found': error_message_to_user = error_estimate_currency_not_found_msg.format(currency=payment_result.get('currency', selected_asset_code.upper()))
-        elif error_code == 'min_amount_fetch_error': error_message_to_user = error_min_amount_fetch_msg.format(currency=payment_result.get('currency', selected_asset_code.upper()))
-        elif error_code == 'api_key_invalid': error_message_to_user = error_api_key_msg
-        elif error_code == 'invalid_api_response': error_message_to_user = error_invalid_response_msg
-        elif error_code == 'pending_db_error': error_message_to_user = error_pending_db_msg
-        elif error_code == 'amount_too_low_api': # Handle specific error with details
-             min_amount_val = payment_result.get('min_amount', 'N/A'); crypto_amount_val = payment_result.get('crypto_amount', 'N/A')
-             target_eur_val = payment_result.get('target_eur_amount', refill_eur_amount_decimal)
-             error_message_to_user = error_amount_too_low_api_msg.format(target_eur_amount=format_currency(target_eur_val), currency=payment_result.get('currency', selected_asset_code.upper()), crypto_amount=crypto_amount_val, min_amount=min_amount_val)
-        elif error_code in ['api_timeout', 'api_request_failed', 'api_unexpected_error', 'internal_server_error', 'internal_estimate_error']:
-            error_message_to_user = error_nowpayments_api_msg
+        error_message_to_user = _format_invoice_error(strings, payment_result, selected_asset_code, refill_eur_amount_decimal)
 
         try: await query.edit_message_text(error_message_to_user, reply_markup=back_button_markup, parse_mode=None)
         except Exception as edit_e: logger.error(f"Failed to edit message with invoice creation error: {edit_e}"); await send_message_with_retry(context.bot, chat_id, error_message_to_user, reply_markup=back_button_markup, parse_mode=None)
@@ -352,7 +691,7 @@ async def handle_select_basket_crypto(update: Update, context: ContextTypes.DEFA
     user_id = query.from_user.id
     chat_id = query.message.chat_id
     lang = context.user_data.get("lang", "en")
-    lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
+    strings = _get_payment_strings(lang)
 
     if not params:
         logger.warning(f"handle_select_basket_crypto called without asset parameter for user {user_id}")
@@ -362,38 +701,25 @@ async def handle_select_basket_crypto(update: Update, context: ContextTypes.DEFA
     selected_asset_code = params[0].lower()
     logger.info(f"User {user_id} selected {selected_asset_code} for basket payment.")
 
-    # Retrieve stored basket context
-    basket_snapshot = context.user_data.get('basket_pay_snapshot')
-    final_total_eur_float = context.user_data.get('basket_pay_total_eur') # This should be the FINAL total after ALL discounts
-    discount_code_used = context.user_data.get('basket_pay_discount_code') # General discount code used
+    # Take the stored basket context out of user_data in one go (cleared whatever the outcome)
+    ud = context.user_data
+    basket_snapshot = ud.pop('basket_pay_snapshot', None)
+    final_total_eur_float = ud.pop('basket_pay_total_eur', None) # This should be the FINAL total after ALL discounts
+    discount_code_used = ud.pop('basket_pay_discount_code', None) # General discount code used
+    ud.pop('state', None)
 
     if basket_snapshot is None or final_total_eur_float is None:
         logger.error(f"Basket payment context lost before crypto selection for user {user_id}.")
         await query.edit_message_text("❌ Error: Payment context lost. Please go back to your basket.",
                                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ View Basket", callback_data="view_basket")]]) ,parse_mode=None)
-        context.user_data.pop('state', None)
-        context.user_data.pop('basket_pay_snapshot', None); context.user_data.pop('basket_pay_total_eur', None); context.user_data.pop('basket_pay_discount_code', None)
         return
 
-    final_total_eur_decimal = Decimal(str(final_total_eur_float))
-
-    # Get language strings
-    preparing_invoice_msg = lang_data.get("preparing_invoice", "⏳ Preparing your payment invoice...")
-    failed_invoice_creation_msg = lang_data.get("failed_invoice_creation", "❌ Failed to create payment invoice. Please try again later or contact support.")
-    error_nowpayments_api_msg = lang_data.get("error_nowpayments_api", "❌ Payment API Error: Could not create payment. Please try again later or contact support.")
-    error_invalid_response_msg = lang_data.get("error_invalid_nowpayments_response", "❌ Payment API Error: Invalid response received. Please contact support.")
-    error_api_key_msg = lang_data.get("error_nowpayments_api_key", "❌ Payment API Error: Invalid API key. Please contact support.")
-    error_pending_db_msg = lang_data.get("payment_pending_db_error", "❌ Database Error: Could not record pending payment. Please contact support.")
-    error_amount_too_low_api_msg = lang_data.get("payment_amount_too_low_api", "❌ Payment Amount Too Low: The equivalent of {target_eur_amount} EUR in {currency} ({crypto_amount}) is below the minimum required by the payment provider ({min_amount} {currency}). Please try a higher EUR amount.")
-    error_min_amount_fetch_msg = lang_data.get("error_min_amount_fetch", "❌ Error: Could not retrieve minimum payment amount for {currency}. Please try again later or select a different currency.")
-    error_estimate_failed_msg = lang_data.get("error_estimate_failed", "❌ Error: Could not estimate crypto amount. Please try again or select a different currency.")
-    error_estimate_currency_not_found_msg = lang_data.get("error_estimate_currency_not_found", "❌ Error: Currency {currency} not supported for estimation. Please select a different currency.")
-    error_basket_pay_too_low_msg = lang_data.get("basket_pay_too_low", "❌ Basket total {basket_total} EUR is below the minimum required for {currency}.")
-    back_to_basket_button = lang_data.get("back_basket_button", "Back to Basket")
-    back_button_markup = InlineKeyboardMarkup([[InlineKeyboardButton(f"⬅️ {back_to_basket_button}", callback_data="view_basket")]])
+    final_total_eur_decimal = _as_decimal(final_total_eur_float)
+
+    back_button_markup = _BACK_BASKET_MARKUPS.get(lang, _BACK_BASKET_MARKUPS['en'])
 
     try:
-        await query.edit_message_text(preparing_invoice_msg, reply_markup=None, parse_mode=None)
+        await query.edit_message_text(strings.preparing_invoice, reply_markup=None, parse_mode=None)
     except telegram_error.BadRequest as e:
         if "message is not modified" not in str(e).lower(): logger.warning(f"Couldn't edit message in handle_select_basket_crypto: {e}")
         await query.answer("Preparing...")
@@ -406,15 +732,6 @@ async def handle_select_basket_crypto(update: Update, context: ContextTypes.DEFA
         discount_code=discount_code_used
     )
 
-    # Store snapshot temporarily BEFORE clearing context, in case we need it for un-reserving
-    snapshot_before_clear = context.user_data.get('basket_pay_snapshot')
-
-    # Clear context *after* attempting payment creation
-    context.user_data.pop('basket_pay_snapshot', None)
-    context.user_data.pop('basket_pay_total_eur', None)
-    context.user_data.pop('basket_pay_discount_code', None)
-    context.user_data.pop('state', None) # Ensure state is cleared
-
     if 'error' in payment_result:
         error_code = payment_result['error']
         logger.error(f"Failed to create NOWPayments basket payment invoice for user {user_id}: {error_code} - Details: {payment_result}")
@@ -422,34 +739,10 @@ async def handle_select_basket_crypto(update: Update, context: ContextTypes.DEFA
         # --- Un-reserve items if invoice creation failed early ---
         if error_code in ['basket_pay_too_low', 'amount_too_low_api', 'min_amount_fetch_error', 'estimate_failed', 'estimate_currency_not_found', 'payment_api_misconfigured']:
             logger.info(f"Invoice creation failed ({error_code}) before pending record. Un-reserving items from snapshot.")
-            try:
-                # Use asyncio.to_thread for the synchronous helper
-                await asyncio.to_thread(_unreserve_basket_items, snapshot_before_clear)
-            except NameError:
-                 logger.critical("CRITICAL: _unreserve_basket_items function call failed due to NameError!")
-            except Exception as unreserve_e:
-                 logger.error(f"Error occurred during item un-reservation: {unreserve_e}")
+            await release_basket_reservations(basket_snapshot)
         # --- End Un-reserve Fix ---
 
-        error_message_to_user = failed_invoice_creation_msg # Default error
-        # Handle specific errors for user message
-        if error_code == 'basket_pay_too_low':
-            error_message_to_user = error_basket_pay_too_low_msg.format(
-                basket_total=payment_result.get('basket_total', 'N/A'),
-                currency=payment_result.get('currency', selected_asset_code.upper())
-            )
-        elif error_code == 'estimate_failed': error_message_to_user = error_estimate_failed_msg
-        elif error_code == 'estimate_currency_not_found': error_message_to_user = error_estimate_currency_not_found_msg.format(currency=payment_result.get('currency', selected_asset_code.upper()))
-        elif error_code == 'min_amount_fetch_error': error_message_to_user = error_min_amount_fetch_msg.format(currency=payment_result.get('currency', selected_asset_code.upper()))
-        elif error_code == 'api_key_invalid': error_message_to_user = error_api_key_msg
-        elif error_code == 'invalid_api_response': error_message_to_user = error_invalid_response_msg
-        elif error_code == 'pending_db_error': error_message_to_user = error_pending_db_msg
-        elif error_code == 'amount_too_low_api':
-             min_amount_val = payment_result.get('min_amount', 'N/A'); crypto_amount_val = payment_result.get('crypto_amount', 'N/A')
-             target_eur_val = payment_result.get('target_eur_amount', final_total_eur_decimal)
-             error_message_to_user = error_amount_too_low_api_msg.format(target_eur_amount=format_currency(target_eur_val), currency=payment_result.get('currency', selected_asset_code.upper()), crypto_amount=crypto_amount_val, min_amount=min_amount_val)
-        elif error_code in ['api_timeout', 'api_request_failed', 'api_unexpected_error', 'internal_server_error', 'internal_estimate_error']:
-            error_message_to_user = error_nowpayments_api_msg
+        error_message_to_user = _format_invoice_error(strings, payment_result, selected_asset_code, final_total_eur_decimal)
 
         try: await query.edit_message_text(error_message_to_user, reply_markup=back_button_markup, parse_mode=None)
         except Exception as edit_e: logger.error(f"Failed to edit message with basket payment creation error: {edit_e}"); await send_message_with_retry(context.bot, chat_id, error_message_to_user, reply_markup=back_button_markup, parse_mode=None)
@@ -463,13 +756,70 @@ async def handle_select_basket_crypto(update: Update, context: ContextTypes.DEFA
         # Important: DO NOT clear the user's actual basket here.
 
 
+# --- Cached Invoice Templates ---
+@lru_cache(maxsize=32)
+def _invoice_template(lang: str, is_purchase: bool) -> tuple[str, InlineKeyboardMarkup]:
+    """
+    Builds the MarkdownV2 invoice message for a language as a str.format template with the static labels already in place,
+    plus the cancel button markup. Slots: {target_eur}, {pay_amount}, {currency}, {address}, {expiry} (all pre-escaped by the caller).
+    """
+    lang_data = get_lang_view(lang)
+    def static(text): return text.replace('{', '{{').replace('}', '}}') # Literal braces must survive .format()
+
+    invoice_title_template = lang_data["invoice_title_purchase"] if is_purchase else lang_data["invoice_title_refill"]
+    amount_label = lang_data["amount_label"]
+    payment_address_label = lang_data["payment_address_label"]
+    expires_at_label = lang_data["expires_at_label"]
+    send_warning_template = lang_data["send_warning_template"]
+    confirmation_note = lang_data["confirmation_note"]
+    overpayment_note = lang_data["overpayment_note"]
+    # --- Use a specific "Cancel Payment" text ---
+    cancel_payment_button_text = lang_data["cancel_payment_button"]
+
+    template = f"""{static(invoice_title_template)}
+
+_\\(Amount: {{target_eur}} EUR\\)_
+
+Please send the following amount:
+{static(amount_label)} `{{pay_amount}}` {{currency}}
+
+{static(payment_address_label)}
+`{{address}}`
+
+{static(expires_at_label)} {{expiry}}
+
+"""
+    if is_purchase: template += f"{static(send_warning_template).replace('{{asset}}', '{currency}')}\n"
+    else: template += f"{static(overpayment_note)}\n"
+    template += f"\n{static(confirmation_note)}"
+
+    cancel_markup = InlineKeyboardMarkup([[InlineKeyboardButton(f"❌ {cancel_payment_button_text}", callback_data="cancel_crypto_payment")]])
+    return template.strip(), cancel_markup
+
+
+_MD2_SPECIAL = re.compile(r'[_*\[\]()~`>#+\-=|{}.!\\]')
+
+def fast_escape_md2(text: str) -> str:
+    """helpers.escape_markdown(v2), skipping the substitution when text has no MarkdownV2 special characters."""
+    return helpers.escape_markdown(text, version=2) if _MD2_SPECIAL.search(text) else text
+
+@lru_cache(maxsize=256)
+def _escape_md2(text: str) -> str:
+    """MarkdownV2-escapes a field value; currencies and common amounts repeat across invoices."""
+    return fast_escape_md2(text)
+
+class _EscapedFields(dict):
+    """Raw invoice field values for str.format_map, escaped for MarkdownV2 only when the template reads them."""
+    def __getitem__(self, key): return _escape_md2(super().__getitem__(key))
+
+
 # --- Display NOWPayments Invoice (with Cancel Button fix) ---
 async def display_nowpayments_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE, payment_data: dict):
     """Displays the NOWPayments invoice details with improved formatting and a specific cancel button."""
     query = update.callback_query
     chat_id = query.message.chat_id
     lang = context.user_data.get("lang", "en")
-    lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
+    lang_data = get_lang_view(lang)
     final_msg = "Error displaying invoice."
     is_purchase_invoice = payment_data.get('is_purchase', False)
 
@@ -492,69 +842,36 @@ async def display_nowpayments_invoice(update: Update, context: ContextTypes.DEFA
 
         pay_amount_decimal = Decimal(pay_amount_str)
         pay_amount_display = '{:f}'.format(pay_amount_decimal.normalize())
-        target_eur_display = format_currency(Decimal(str(target_eur_orig))) if target_eur_orig else "N/A"
+        target_eur_display = format_currency(_as_decimal(target_eur_orig)) if target_eur_orig else "N/A"
         expiry_time_display = format_expiration_time(expiration_date_str)
 
-        invoice_title_template = lang_data.get("invoice_title_purchase", "*Payment Invoice Created*") if is_purchase_invoice else lang_data.get("invoice_title_refill", "*Top\\-Up Invoice Created*")
-        amount_label = lang_data.get("amount_label", "*Amount:*")
-        payment_address_label = lang_data.get("payment_address_label", "*Payment Address:*")
-        expires_at_label = lang_data.get("expires_at_label", "*Expires At:*")
-        send_warning_template = lang_data.get("send_warning_template", "⚠️ *Important:* Send *exactly* this amount of {asset} to this address\\.")
-        confirmation_note = lang_data.get("confirmation_note", "✅ Confirmation is automatic via webhook after network confirmation\\.")
-        overpayment_note = lang_data.get("overpayment_note", "ℹ️ _Sending more than this amount is okay\\! Your balance will be credited based on the amount received after network confirmation\\._")
-        # --- Use a specific "Cancel Payment" text ---
-        cancel_payment_button_text = lang_data.get("cancel_payment_button", "Cancel Payment")
-        # --------------------------------------------
-
-        escaped_target_eur = helpers.escape_markdown(target_eur_display, version=2)
-        escaped_pay_amount = helpers.escape_markdown(pay_amount_display, version=2)
-        escaped_currency = helpers.escape_markdown(pay_currency, version=2)
-        escaped_address = helpers.escape_markdown(pay_address, version=2)
-        escaped_expiry = helpers.escape_markdown(expiry_time_display, version=2)
-
-        msg = f"""{invoice_title_template}
-
-_{helpers.escape_markdown(f"(Amount: {target_eur_display} EUR)", version=2)}_
-
-Please send the following amount:
-{amount_label} `{escaped_pay_amount}` {escaped_currency}
-
-{payment_address_label}
-`{escaped_address}`
-
-{expires_at_label} {escaped_expiry}
-
-"""
-        if is_purchase_invoice: msg += f"{send_warning_template.format(asset=escaped_currency)}\n"
-        else: msg += f"{overpayment_note}\n"
-        msg += f"\n{confirmation_note}"
-
-        final_msg = msg.strip()
-
-        # --- Change Cancel Button Callback ---
-        keyboard = [[InlineKeyboardButton(f"❌ {cancel_payment_button_text}", callback_data="cancel_crypto_payment")]] # <<< CHANGED callback_data
-        # -------------------------------------
+        # Static labels come pre-escaped from the cached per-language template; only the dynamic fields are escaped here
+        invoice_template, cancel_markup = _invoice_template(lang, is_purchase_invoice)
+        final_msg = invoice_template.format_map(_EscapedFields(
+            target_eur=target_eur_display, pay_amount=pay_amount_display, currency=pay_currency,
+            address=pay_address, expiry=expiry_time_display
+        ))
 
         await query.edit_message_text(
-            final_msg, reply_markup=InlineKeyboardMarkup(keyboard),
+            final_msg, reply_markup=cancel_markup,
             parse_mode=ParseMode.MARKDOWN_V2, disable_web_page_preview=True
         )
     except (ValueError, KeyError, TypeError) as e:
         logger.error(f"Error formatting or displaying NOWPayments invoice: {e}. Data: {payment_data}", exc_info=True)
-        error_display_msg = lang_data.get("error_preparing_payment", "❌ An error occurred while preparing the payment details. Please try again later.")
+        error_display_msg = lang_data["error_preparing_payment"]
         # Determine correct back button on error too (fallback if cancel fails)
-        back_button_text = lang_data.get("back_basket_button", "Back to Basket") if is_purchase_invoice else lang_data.get("back_profile_button", "Back to Profile")
+        back_button_text = lang_data["back_basket_button"] if is_purchase_invoice else lang_data["back_profile_button"]
         back_callback = "view_basket" if is_purchase_invoice else "profile"
         back_button_markup = InlineKeyboardMarkup([[InlineKeyboardButton(f"⬅️ {back_button_text}", callback_data=back_callback)]])
         try: await query.edit_message_text(error_display_msg, reply_markup=back_button_markup, parse_mode=None)
         except Exception: pass
     except telegram_error.BadRequest as e:
-        if "message is not modified" not in str(e).lower(): logger.error(f"Error editing NOWPayments invoice message: {e}. Attempted message (unescaped for logging): {msg.strip()}")
+        if "message is not modified" not in str(e).lower(): logger.error(f"Error editing NOWPayments invoice message: {e}. Attempted message: {final_msg}")
         else: await query.answer()
     except Exception as e:
          logger.error(f"Unexpected error in display_nowpayments_invoice: {e}", exc_info=True)
-         error_display_msg = lang_data.get("error_preparing_payment", "❌ An unexpected error occurred while preparing the payment details.")
-         back_button_text = lang_data.get("back_basket_button", "Back to Basket") if is_purchase_invoice else lang_data.get("back_profile_button", "Back to Profile")
+         error_display_msg = lang_data["error_preparing_payment"]
+         back_button_text = lang_data["back_basket_button"] if is_purchase_invoice else lang_data["back_profile_button"]
          back_callback = "view_basket" if is_purchase_invoice else "profile"
          back_button_markup = InlineKeyboardMarkup([[InlineKeyboardButton(f"⬅️ {back_button_text}", callback_data=back_callback)]])
          try: await query.edit_message_text(error_display_msg, reply_markup=back_button_markup, parse_mode=None)
@@ -563,400 +880,494 @@ Please send the following amount:
 
 # --- Process Successful Refill ---
 async def process_successful_refill(user_id: int, amount_to_add_eur: Decimal, payment_id: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    bot = context.bot
-    user_lang = 'en'
-    conn_lang = None
-    try:
-        conn_lang = get_db_connection()
-        c_lang = conn_lang.cursor()
-        c_lang.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        lang_res = c_lang.fetchone()
-        if lang_res and lang_res['language'] in LANGUAGES:
-            user_lang = lang_res['language']
-    except sqlite3.Error as e:
-        logger.error(f"DB error fetching language for user {user_id} during refill confirmation: {e}")
-    finally:
-        if conn_lang: conn_lang.close()
-
-    lang_data = LANGUAGES.get(user_lang, LANGUAGES['en'])
-
     if not isinstance(amount_to_add_eur, Decimal) or amount_to_add_eur <= Decimal('0.0'):
         logger.error(f"Invalid amount_to_add_eur in process_successful_refill: {amount_to_add_eur}")
         return False
 
     # Use the separate crediting function
-    return await credit_user_balance(user_id, amount_to_add_eur, f"Refill payment {payment_id}", context)
+    return await credit_user_balance(user_id, amount_to_add_eur, f"Refill payment {payment_id}", context, payment_id=payment_id, kind=CreditKind.REFILL)
+
+
+# --- Payment Intents (Balance Purchases) ---
+# Each balance purchase is a row in payment_intents moving pending -> balance_held -> fulfilled | refunded | failed.
+# Every transition is a conditional UPDATE on the current state, so retries and the sweeper can't apply one twice.
+PAYMENT_INTENT_STALE_SECONDS = 600 # balance_held intents older than this are refunded by the sweeper
+
+class RefundResult(IntEnum):
+    """Outcome of _refund_payment_intent; only REFUNDED means this call credited the balance back."""
+    FAILED = 0 # Not refunded (DB error, missing intent, or it is in another final state)
+    REFUNDED = 1 # This call moved it balance_held -> refunded; its reservations are still held
+    ALREADY_REFUNDED = 2 # Refunded earlier (finalization or the sweeper), which also released the reservations
+
+def _refund_payment_intent(intent_id: str) -> RefundResult:
+    """Moves a balance_held intent to refunded and credits the amount back in one transaction."""
+    try:
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            # Claim the transition first; RETURNING hands back what to refund, so the common case needs no SELECT
+            row = c.execute("UPDATE payment_intents SET state = 'refunded', updated_at = ? WHERE id = ? AND state = 'balance_held' RETURNING user_id, amount", (datetime.now(timezone.utc).isoformat(), intent_id)).fetchone()
+            if not row:
+                state_row = c.execute("SELECT state FROM payment_intents WHERE id = ?", (intent_id,)).fetchone()
+                if not state_row: logger.error(f"Payment intent {intent_id} not found for refund."); return RefundResult.FAILED
+                if state_row['state'] == 'refunded': return RefundResult.ALREADY_REFUNDED
+                logger.warning(f"Payment intent {intent_id} is '{state_row['state']}', not refunding."); return RefundResult.FAILED
+            c.execute("UPDATE users SET balance_cents = balance_cents + ? WHERE user_id = ?", (to_cents(row['amount']), row['user_id']))
+            conn.commit()
+            logger.info(f"Refunded payment intent {intent_id}: {row['amount']:.2f} EUR back to user {row['user_id']}.")
+            return RefundResult.REFUNDED
+    except sqlite3.Error as e:
+        logger.error(f"DB error refunding payment intent {intent_id}: {e}", exc_info=True)
+        return RefundResult.FAILED
+
+def _fail_pending_payment_intent(intent_id: str):
+    """Closes an intent that never got past pending (no balance was taken), so it doesn't linger in that state."""
+    try:
+        with db_pool.acquire() as conn:
+            conn.execute("UPDATE payment_intents SET state = 'failed', updated_at = ? WHERE id = ? AND state = 'pending'", (datetime.now(timezone.utc).isoformat(), intent_id))
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"DB error failing pending payment intent {intent_id}: {e}", exc_info=True)
+
+def sweep_stuck_payment_intents() -> int:
+    """Refunds balance_held intents left behind by a crash or failed finalization and un-reserves their items,
+    and marks stale pending intents failed. Returns the number of intents refunded."""
+    cutoff_iso = datetime.fromtimestamp(time.time() - PAYMENT_INTENT_STALE_SECONDS, tz=timezone.utc).isoformat()
+    try:
+        with db_read_pool.acquire() as conn:
+            stuck = conn.execute("SELECT id, basket_json FROM payment_intents WHERE state = 'balance_held' AND updated_at < ?", (cutoff_iso,)).fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"DB error reading stuck payment intents: {e}", exc_info=True)
+        return 0
+    # pending intents never had balance deducted (the deduction and balance_held commit together): just close them
+    try:
+        with db_pool.acquire() as conn:
+            expired = conn.execute("UPDATE payment_intents SET state = 'failed', updated_at = ? WHERE state = 'pending' AND updated_at < ?", (datetime.now(timezone.utc).isoformat(), cutoff_iso)).rowcount
+            conn.commit()
+        if expired: logger.warning(f"Payment intent sweeper failed {expired} stale pending balance purchase(s).")
+    except sqlite3.Error as e:
+        logger.error(f"DB error expiring pending payment intents: {e}", exc_info=True)
+    refunded = 0
+    for row in stuck:
+        # Only un-reserve what this pass refunded; an intent refunded elsewhere already had its items released
+        if _refund_payment_intent(row['id']) is not RefundResult.REFUNDED: continue
+        refunded += 1
+        try: _unreserve_basket_items(json.loads(row['basket_json']) if row['basket_json'] else [])
+        except (json.JSONDecodeError, TypeError) as e: logger.error(f"Could not parse basket for payment intent {row['id']}: {e}")
+    if refunded: logger.warning(f"Payment intent sweeper refunded {refunded} stuck balance purchase(s).")
+    return refunded
+
+
+# Purchase-path statements take the id lists as one JSON array parameter (json_each), so each is a single
+# fixed SQL string reused from the connection's statement cache whatever the basket size, with no bound-variable limit.
+_STOCK_DECREMENT_SQL = """WITH qty(id, n) AS (SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?))
+UPDATE products SET available = available - (SELECT n FROM qty WHERE qty.id = products.id)
+WHERE id IN (SELECT id FROM qty) AND available >= (SELECT n FROM qty WHERE qty.id = products.id) RETURNING id"""
+_PURCHASE_MEDIA_SQL = "SELECT product_id, media_type, telegram_file_id, file_path FROM product_media WHERE product_id IN (SELECT value FROM json_each(?))"
+_DELETE_PRODUCTS_SQL = "DELETE FROM products WHERE id IN (SELECT value FROM json_each(?))"
+
+def _existing_paths(paths) -> set:
+    """Returns the subset of paths that exist on disk (one thread hop for a whole delivery)."""
+    return {path for path in paths if os.path.exists(path)}
+
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+PURCHASE_MEDIA_CONCURRENCY = 3 # Products whose media is prepared/uploaded concurrently per delivery
+
+def _pickup_text(item_details: dict) -> str:
+    """Item header plus pickup details for one purchased product."""
+    product_emoji = PRODUCT_TYPES.get(item_details['type'], DEFAULT_PRODUCT_EMOJI)
+    item_original_text = item_details['text'] or "(No specific pickup details provided)"
+    return f"--- Item: {product_emoji} {item_details['name']} {item_details['size']} ---\n\n{item_original_text}"
+
+def _pack_messages(parts: list, limit: int = TELEGRAM_MAX_MESSAGE_LENGTH, sep: str = "\n\n") -> list:
+    """Joins text parts with sep into as few messages as fit under limit (an oversized part is truncated)."""
+    messages, current = [], ""
+    for part in parts:
+        if len(part) > limit: part = part[:limit - 3] + "..."
+        if current and len(current) + len(sep) + len(part) > limit:
+            messages.append(current); current = part
+        else:
+            current = f"{current}{sep}{part}" if current else part
+    if current: messages.append(current)
+    return messages
+
+# --- HELPER: Send One Purchased Product's Media ---
+async def _send_product_media(bot, chat_id: int, user_id: int, prod_id: int, media_items_for_product: list, existing_paths: set):
+    """Sends a purchased product's photo/video group and animations concurrently (paced per chat)."""
+    photo_video_group_details = []
+    animations_to_send_details = []
+
+    logger.info(f"Processing media for P{prod_id} user {user_id}: Found {len(media_items_for_product)} media items")
+
+    # --- Separate Media ---
+    for media_item in media_items_for_product:
+        media_type = media_item.get('media_type')
+        file_id = media_item.get('telegram_file_id')
+        file_path = media_item.get('file_path')
+        logger.debug(f"Processing media item P{prod_id}: Type={media_type}, FileID={'Yes' if file_id else 'No'}, Path={file_path}")
+        if media_type in ['photo', 'video']:
+            photo_video_group_details.append({'type': media_type, 'id': file_id, 'path': file_path})
+        elif media_type == 'gif':
+            animations_to_send_details.append({'type': media_type, 'id': file_id, 'path': file_path})
+        else:
+            logger.warning(f"Unsupported media type '{media_type}' found for P{prod_id}")
+
+    logger.info(f"Media separation P{prod_id}: {len(photo_video_group_details)} photos/videos, {len(animations_to_send_details)} animations")
+
+    sends, send_labels = [], []
+    # --- Photos/Videos Group (No Caption) ---
+    media_group_input = []
+    for item in photo_video_group_details:
+        input_media = None
+        if item['id']:
+            logger.debug(f"Using Telegram file_id for P{prod_id}: {item['type']}")
+            if item['type'] == 'photo': input_media = InputMediaPhoto(media=item['id'])
+            elif item['type'] == 'video': input_media = InputMediaVideo(media=item['id'])
+        elif item['path'] in existing_paths:
+            logger.debug(f"Using file path for P{prod_id}: {item['path']}")
+            # Read the file up front so no descriptor stays open across the upload
+            file_bytes = await asyncio.to_thread(Path(item['path']).read_bytes)
+            if item['type'] == 'photo': input_media = InputMediaPhoto(media=file_bytes)
+            elif item['type'] == 'video': input_media = InputMediaVideo(media=file_bytes)
+        else:
+            logger.warning(f"No valid media source for P{prod_id}: FileID={bool(item['id'])}, Path exists=False ({item['path']})")
+        if input_media: media_group_input.append(input_media)
+        else: logger.warning(f"Could not prepare photo/video InputMedia P{prod_id}: {item}")
+    if media_group_input:
+        sends.append(lambda: bot.send_media_group(chat_id, media=media_group_input, connect_timeout=20, read_timeout=20))
+        send_labels.append(f"photo/video group ({len(media_group_input)})")
+
+    # --- Animations (GIFs) Separately (No Caption) ---
+    for item in animations_to_send_details:
+        media_to_send_ref = None
+        if item['id']:
+            logger.debug(f"Using Telegram file_id for animation P{prod_id}")
+            media_to_send_ref = item['id']
+        elif item['path'] in existing_paths:
+            logger.debug(f"Using file path for animation P{prod_id}: {item['path']}")
+            media_to_send_ref = await asyncio.to_thread(Path(item['path']).read_bytes)
+        else:
+            logger.warning(f"Could not find GIF source for P{prod_id}: ID={bool(item['id'])}, Path exists=False ({item['path']})")
+            continue
+        sends.append(lambda ref=media_to_send_ref: bot.send_animation(chat_id=chat_id, animation=ref)) # NO CAPTION
+        send_labels.append("animation")
+
+    if not sends: return
+    results = await asyncio.gather(*(paced_send(chat_id, send) for send in sends), return_exceptions=True)
+    for label, result in zip(send_labels, results):
+        if isinstance(result, Exception): logger.error(f"❌ Error sending {label} P{prod_id} user {user_id}: {result}", exc_info=result)
+        else: logger.info(f"✅ Successfully sent {label} for P{prod_id} user {user_id}")
+
+
+class _FinalizeAborted(Exception):
+    """Raised inside the finalize transaction when nothing may be handed out (already logged)."""
 
 
 # --- HELPER: Finalize Purchase (Send Caption Separately) ---
-async def _finalize_purchase(user_id: int, basket_snapshot: list, discount_code_used: str | None, context: ContextTypes.DEFAULT_TYPE) -> bool:
+_ALREADY_FINALIZED = object() # Returned by the *_db / *_sync helpers when a payment_id was already claimed
+
+def _finalize_purchase_db(user_id: int, basket_snapshot: list, discount_code_used: str | None, payment_intent_id: str | None, payment_id: str | None):
     """
-    Shared logic to finalize a purchase after payment confirmation (balance or crypto).
-    Decrements stock, adds purchase record, sends media first, then text separately,
-    cleans up product records.
+    Blocking DB half of _finalize_purchase, run in one worker thread hop.
+    Returns (processed_product_ids, pickup_details, media_details) on success,
+    _ALREADY_FINALIZED for a duplicate payment_id, or None if the purchase failed or was aborted.
     """
-    chat_id = context._chat_id or context._user_id or user_id # Try to get chat_id
-    if not chat_id:
-         logger.error(f"Cannot determine chat_id for user {user_id} in _finalize_purchase")
-
-    lang, lang_data = _get_lang_data(context)
-    if not basket_snapshot: logger.error(f"Empty basket_snapshot for user {user_id} purchase finalization."); return False
-
-    conn = None
     processed_product_ids = []
     purchases_to_insert = []
-    final_pickup_details = defaultdict(list)
-    db_update_successful = False
-    total_price_paid_decimal = Decimal('0.0')
+    final_pickup_details: dict[int, dict] = {}
+    media_details = defaultdict(list)
+    total_price_paid_cents = 0
 
-    # --- Database Operations (Reservation Decrement, Purchase Record) ---
-    try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("BEGIN EXCLUSIVE")
-        purchase_time_iso = datetime.now(timezone.utc).isoformat()
-
-        for item_snapshot in basket_snapshot: # Iterate directly over the rich snapshot
-            product_id = item_snapshot['product_id']
-            
-            # Attempt to decrement stock. This is the main check for product existence/availability.
-            avail_update = c.execute("UPDATE products SET available = available - 1 WHERE id = ? AND available > 0", (product_id,))
-            
-            if avail_update.rowcount == 0:
-                logger.error(f"CRITICAL: Failed to fulfill/decrement product {product_id} for user {user_id}. Product record may be gone or no available stock. Skipping item. Snapshot item: {item_snapshot}")
-                continue # Skip this item
-
-            # Product stock successfully decremented. Proceed to record purchase using snapshot data.
-            # Details from snapshot:
-            item_original_price_decimal = Decimal(str(item_snapshot['price'])) # 'price' in snapshot is original price
-            item_product_type = item_snapshot['product_type']
-            item_name = item_snapshot['name']
-            item_size = item_snapshot['size']
-            item_city = item_snapshot['city'] 
-            item_district = item_snapshot['district'] 
-            item_original_text_pickup = item_snapshot.get('original_text')
-
-            # Calculate reseller discount based on snapshot's original price and type
-            item_reseller_discount_percent = await asyncio.to_thread(get_reseller_discount, user_id, item_product_type)
-            item_reseller_discount_amount = (item_original_price_decimal * item_reseller_discount_percent / Decimal('100')).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
-            item_price_paid_decimal = item_original_price_decimal - item_reseller_discount_amount
-            total_price_paid_decimal += item_price_paid_decimal
-            item_price_paid_float = float(item_price_paid_decimal)
-
-            purchases_to_insert.append((
-                user_id, product_id, item_name, item_product_type, item_size,
-                item_price_paid_float, item_city, item_district, purchase_time_iso
-            ))
-            processed_product_ids.append(product_id)
-            # For pickup details message, use snapshot's original_text and other details
-            final_pickup_details[product_id].append({'name': item_name, 'size': item_size, 'text': item_original_text_pickup, 'type': item_product_type}) # Store type for emoji
-
-        if not purchases_to_insert:
-            logger.warning(f"No items processed during finalization for user {user_id}. Rolling back.")
-            conn.rollback()
-            if chat_id: await send_message_with_retry(context.bot, chat_id, lang_data.get("error_processing_purchase_contact_support", "❌ Error processing purchase."), parse_mode=None)
-            return False
-
-        c.executemany("INSERT INTO purchases (user_id, product_id, product_name, product_type, product_size, price_paid, city, district, purchase_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", purchases_to_insert)
-        c.execute("UPDATE users SET total_purchases = total_purchases + ? WHERE user_id = ?", (len(purchases_to_insert), user_id))
-        if discount_code_used:
-            c.execute("UPDATE discount_codes SET uses_count = uses_count + 1 WHERE code = ?", (discount_code_used,))
-        c.execute("UPDATE users SET basket = '' WHERE user_id = ?", (user_id,))
-        conn.commit()
-        db_update_successful = True
-        logger.info(f"Finalized purchase DB update user {user_id}. Processed {len(purchases_to_insert)} items. General Discount: {discount_code_used or 'None'}. Total Paid (after reseller disc): {total_price_paid_decimal:.2f} EUR")
+    # Reseller discounts for every product type in the basket, fetched in one query before the exclusive transaction,
+    # as integer basis points so the per-item math below stays in integer cents
+    reseller_discounts = get_reseller_discounts(user_id, {item['product_type'] for item in basket_snapshot})
+    reseller_discount_bp = {ptype: int(pct * 100) for ptype, pct in reseller_discounts.items()}
 
+    # --- Database Operations (Stock Decrement, Purchase Record, Media Fetch, Product Cleanup) ---
+    # All in one transaction, so media is read before anything else can remove the products
+    try:
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
+            c.execute("BEGIN EXCLUSIVE")
+            purchase_time_iso = datetime.now(timezone.utc).isoformat()
+
+            # Claim the provider payment_id first; a duplicate webhook finds it taken and stops here
+            if payment_id:
+                claim_res = c.execute("INSERT OR IGNORE INTO processed_payments (payment_id, user_id, processed_at) VALUES (?, ?, ?)", (payment_id, user_id, purchase_time_iso))
+                if claim_res.rowcount == 0:
+                    logger.info(f"Payment {payment_id} for user {user_id} was already finalized. Ignoring duplicate.")
+                    conn.rollback()
+                    return _ALREADY_FINALIZED
+
+            # The intent must still be balance_held (not already refunded by the sweeper) before any item is handed out
+            if payment_intent_id:
+                intent_row = c.execute("SELECT amount, state FROM payment_intents WHERE id = ?", (payment_intent_id,)).fetchone()
+                if not intent_row or intent_row['state'] != 'balance_held':
+                    logger.error(f"Payment intent {payment_intent_id} for user {user_id} is {intent_row['state'] if intent_row else 'missing'}, not balance_held. Aborting finalization.")
+                    conn.rollback()
+                    raise _FinalizeAborted()
+
+            # Decrement stock for the whole basket in one statement. This is the main check for product existence/availability.
+            # Duplicate product_ids are grouped so each row is decremented by its quantity (all-or-nothing per product).
+            qty_by_product = Counter(item['product_id'] for item in basket_snapshot)
+            c.execute(_STOCK_DECREMENT_SQL, (json.dumps(list(qty_by_product.items())),))
+            decremented_ids = {row['id'] for row in c.fetchall()}
+
+            for item_snapshot in basket_snapshot: # Iterate directly over the rich snapshot
+                product_id = item_snapshot['product_id']
+
+                if product_id not in decremented_ids:
+                    logger.error(f"CRITICAL: Failed to fulfill/decrement product {product_id} for user {user_id}. Product record may be gone or no available stock. Skipping item. Snapshot item: {item_snapshot}")
+                    continue # Skip this item
+
+                # Product stock successfully decremented. Proceed to record purchase using snapshot data.
+                # Details from snapshot:
+                item_original_price_cents = round(float(item_snapshot['price']) * 100) # 'price' in snapshot is original price
+                item_product_type = item_snapshot['product_type']
+                item_name = item_snapshot['name']
+                item_size = item_snapshot['size']
+                item_city = item_snapshot['city'] 
+                item_district = item_snapshot['district'] 
+                item_original_text_pickup = item_snapshot.get('original_text')
+
+                # Calculate reseller discount based on snapshot's original price and type
+                # (floor division keeps the old ROUND_DOWN-to-the-cent behaviour)
+                item_reseller_discount_cents = item_original_price_cents * reseller_discount_bp.get(item_product_type, 0) // 10000
+                item_price_paid_cents = item_original_price_cents - item_reseller_discount_cents
+                total_price_paid_cents += item_price_paid_cents
+                item_price_paid_float = item_price_paid_cents / 100
+
+                purchases_to_insert.append((
+                    user_id, product_id, item_name, item_product_type, item_size,
+                    item_price_paid_float, item_city, item_district, purchase_time_iso
+                ))
+                processed_product_ids.append(product_id)
+                # For pickup details message, use snapshot's original_text and other details
+                final_pickup_details[product_id] = {'name': item_name, 'size': item_size, 'text': item_original_text_pickup, 'type': item_product_type} # Store type for emoji
+
+            if not purchases_to_insert:
+                if payment_intent_id:
+                    # Nothing could be fulfilled: credit the held balance back and close the intent in this same transaction
+                    logger.warning(f"No items processed during finalization for user {user_id}. Refunding payment intent {payment_intent_id}.")
+                    c.execute("UPDATE users SET balance_cents = balance_cents + ? WHERE user_id = ?", (to_cents(intent_row['amount']), user_id))
+                    c.execute("UPDATE payment_intents SET state = 'refunded', updated_at = ? WHERE id = ?", (purchase_time_iso, payment_intent_id))
+                    # Release the basket's reservations with the refund, so a refunded intent never still holds any
+                    release_counts = Counter(item['product_id'] for item in basket_snapshot if 'product_id' in item)
+                    c.execute(_UNRESERVE_SQL, (json.dumps(list(release_counts.items())),))
+                    conn.commit()
+                else:
+                    logger.warning(f"No items processed during finalization for user {user_id}. Rolling back.")
+                    conn.rollback()
+                raise _FinalizeAborted()
+
+            c.executemany("INSERT INTO purchases (user_id, product_id, product_name, product_type, product_size, price_paid, city, district, purchase_date) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", purchases_to_insert)
+            c.execute("UPDATE users SET total_purchases = total_purchases + ? WHERE user_id = ?", (len(purchases_to_insert), user_id))
+            if discount_code_used:
+                c.execute("UPDATE discount_codes SET uses_count = uses_count + 1 WHERE code = ?", (discount_code_used,))
+            c.execute("UPDATE users SET basket = '' WHERE user_id = ?", (user_id,))
+            if payment_intent_id:
+                c.execute("UPDATE payment_intents SET state = 'fulfilled', updated_at = ? WHERE id = ? AND state = 'balance_held'", (purchase_time_iso, payment_intent_id))
+            if payment_id:
+                c.execute("UPDATE processed_payments SET amount = ? WHERE payment_id = ?", (total_price_paid_cents / 100, payment_id))
+
+            # Fetch media and remove the sold product records in the same transaction
+            # (product_media rows cascade with the products, so they are buffered first)
+            processed_ids_json = json.dumps(list(dict.fromkeys(processed_product_ids)))
+            media_rows = c.execute(_PURCHASE_MEDIA_SQL, (processed_ids_json,)).fetchall()
+            logger.info(f"Fetched {len(media_rows)} media records for products {processed_product_ids} for user {user_id}")
+            for row in media_rows:
+                media_details[row['product_id']].append(dict(row))
+                logger.debug(f"Media for P{row['product_id']}: {row['media_type']} - FileID: {'Yes' if row['telegram_file_id'] else 'No'}, Path: {row['file_path']}")
+            deleted_count = c.execute(_DELETE_PRODUCTS_SQL, (processed_ids_json,)).rowcount
+            conn.commit()
+            logger.info(f"Finalized purchase DB update user {user_id}. Processed {len(purchases_to_insert)} items, deleted {deleted_count} product records. General Discount: {discount_code_used or 'None'}. Total Paid (after reseller disc): {total_price_paid_cents / 100:.2f} EUR")
+
+    except _FinalizeAborted:
+        return None # Already logged and rolled back / refunded above
     except sqlite3.Error as e:
-        logger.error(f"DB error during purchase finalization user {user_id}: {e}", exc_info=True); db_update_successful = False
-        if conn and conn.in_transaction: conn.rollback()
+        # The pool rolls back any open transaction when the connection is released
+        logger.error(f"DB error during purchase finalization user {user_id}: {e}", exc_info=True); return None
     except Exception as e:
-        logger.error(f"Unexpected error during purchase finalization user {user_id}: {e}", exc_info=True); db_update_successful = False
-        if conn and conn.in_transaction: conn.rollback()
-    finally:
-        if conn: conn.close()
-
-    # --- Post-Transaction Cleanup & Message Sending (If DB success) ---
-    if db_update_successful:
-        context.user_data['basket'] = []
-        context.user_data.pop('applied_discount', None)
-
-        # Fetch Media
-        media_details = defaultdict(list)
-        if processed_product_ids:
-            conn_media = None
-            try:
-                conn_media = get_db_connection()
-                c_media = conn_media.cursor()
-                media_placeholders = ','.join('?' * len(processed_product_ids))
-                c_media.execute(f"SELECT product_id, media_type, telegram_file_id, file_path FROM product_media WHERE product_id IN ({media_placeholders})", processed_product_ids)
-                media_rows = c_media.fetchall()
-                logger.info(f"Fetched {len(media_rows)} media records for products {processed_product_ids} for user {user_id}")
-                for row in media_rows: 
-                    media_details[row['product_id']].append(dict(row))
-                    logger.debug(f"Media for P{row['product_id']}: {row['media_type']} - FileID: {'Yes' if row['telegram_file_id'] else 'No'}, Path: {row['file_path']}")
-            except sqlite3.Error as e: 
-                logger.error(f"DB error fetching media post-purchase: {e}")
-            finally:
-                if conn_media: conn_media.close()
-
-        # Send Pickup Details
-        if chat_id:
-            success_title = lang_data.get("purchase_success", "🎉 Purchase Complete! Pickup details below:")
-            await send_message_with_retry(context.bot, chat_id, success_title, parse_mode=None)
-
-            for prod_id in processed_product_ids:
-                item_details_list = final_pickup_details.get(prod_id)
-                if not item_details_list: continue
-                item_details = item_details_list[0] # First (and likely only) entry for this prod_id
-                item_name, item_size = item_details['name'], item_details['size']
-                item_original_text = item_details['text'] or "(No specific pickup details provided)"
-                product_type = item_details['type'] # <<< USE TYPE FROM SNAPSHOT DATA
-                product_emoji = PRODUCT_TYPES.get(product_type, DEFAULT_PRODUCT_EMOJI)
-                item_header = f"--- Item: {product_emoji} {item_name} {item_size} ---"
-
-
-                # Prepare combined text caption
-                combined_caption = f"{item_header}\n\n{item_original_text}"
-                if len(combined_caption) > 4090: combined_caption = combined_caption[:4090] + "..." # Adjust for send_message limit
-
-                media_items_for_product = media_details.get(prod_id, [])
-                photo_video_group_details = []
-                animations_to_send_details = []
-                opened_files = []
-
-                logger.info(f"Processing media for P{prod_id} user {user_id}: Found {len(media_items_for_product)} media items")
-
-                # --- Separate Media ---
-                for media_item in media_items_for_product:
-                    media_type = media_item.get('media_type')
-                    file_id = media_item.get('telegram_file_id')
-                    file_path = media_item.get('file_path')
-                    logger.debug(f"Processing media item P{prod_id}: Type={media_type}, FileID={'Yes' if file_id else 'No'}, Path={file_path}")
-                    if media_type in ['photo', 'video']:
-                        photo_video_group_details.append({'type': media_type, 'id': file_id, 'path': file_path})
-                    elif media_type == 'gif':
-                        animations_to_send_details.append({'type': media_type, 'id': file_id, 'path': file_path})
-                    else:
-                        logger.warning(f"Unsupported media type '{media_type}' found for P{prod_id}")
-
-                logger.info(f"Media separation P{prod_id}: {len(photo_video_group_details)} photos/videos, {len(animations_to_send_details)} animations")
-
-                # --- Send Photos/Videos Group (No Caption) ---
-                if photo_video_group_details:
-                    media_group_input = []
-                    files_for_this_group = []
-                    logger.info(f"Attempting to send {len(photo_video_group_details)} photos/videos for P{prod_id} user {user_id}")
-                    try:
-                        for item in photo_video_group_details:
-                            input_media = None; file_handle = None
-                            if item['id']:
-                                logger.debug(f"Using Telegram file_id for P{prod_id}: {item['type']}")
-                                if item['type'] == 'photo': input_media = InputMediaPhoto(media=item['id'])
-                                elif item['type'] == 'video': input_media = InputMediaVideo(media=item['id'])
-                            elif item['path'] and await asyncio.to_thread(os.path.exists, item['path']):
-                                logger.debug(f"Using file path for P{prod_id}: {item['path']}")
-                                file_handle = await asyncio.to_thread(open, item['path'], 'rb')
-                                opened_files.append(file_handle)
-                                files_for_this_group.append(file_handle)
-                                if item['type'] == 'photo': input_media = InputMediaPhoto(media=file_handle)
-                                elif item['type'] == 'video': input_media = InputMediaVideo(media=file_handle)
-                            else:
-                                logger.warning(f"No valid media source for P{prod_id}: FileID={bool(item['id'])}, Path exists={await asyncio.to_thread(os.path.exists, item['path']) if item['path'] else False}")
-                            if input_media: 
-                                media_group_input.append(input_media)
-                                logger.debug(f"Added media to group for P{prod_id}: {item['type']}")
-                            else: 
-                                logger.warning(f"Could not prepare photo/video InputMedia P{prod_id}: {item}")
-
-                        if media_group_input:
-                            logger.info(f"Sending media group with {len(media_group_input)} items for P{prod_id} user {user_id}")
-                            await context.bot.send_media_group(chat_id, media=media_group_input, connect_timeout=20, read_timeout=20)
-                            logger.info(f"✅ Successfully sent photo/video group ({len(media_group_input)}) for P{prod_id} user {user_id}")
-                        else:
-                            logger.warning(f"No media items prepared for sending P{prod_id} user {user_id}")
-                    except Exception as group_e:
-                        logger.error(f"❌ Error sending photo/video group P{prod_id} user {user_id}: {group_e}", exc_info=True)
-                    finally:
-                        for f in files_for_this_group:
-                             try:
-                                 if not f.closed: await asyncio.to_thread(f.close); opened_files.remove(f)
-                             except Exception: pass
-
-                # --- Send Animations (GIFs) Separately (No Caption) ---
-                if animations_to_send_details:
-                    logger.info(f"Attempting to send {len(animations_to_send_details)} animations for P{prod_id} user {user_id}")
-                    for item in animations_to_send_details:
-                        anim_file_handle = None
-                        try:
-                            media_to_send_ref = None
-                            if item['id']:
-                                logger.debug(f"Using Telegram file_id for animation P{prod_id}")
-                                media_to_send_ref = item['id']
-                            elif item['path'] and await asyncio.to_thread(os.path.exists, item['path']):
-                                logger.debug(f"Using file path for animation P{prod_id}: {item['path']}")
-                                anim_file_handle = await asyncio.to_thread(open, item['path'], 'rb')
-                                opened_files.append(anim_file_handle)
-                                media_to_send_ref = anim_file_handle
-                            else:
-                                logger.warning(f"Could not find GIF source for P{prod_id}: ID={bool(item['id'])}, Path exists={await asyncio.to_thread(os.path.exists, item['path']) if item['path'] else False}")
-                                continue
-
-                            await context.bot.send_animation(chat_id=chat_id, animation=media_to_send_ref) # NO CAPTION
-                            logger.info(f"✅ Successfully sent animation for P{prod_id} user {user_id}")
-                        except Exception as anim_e:
-                            logger.error(f"❌ Error sending animation P{prod_id} user {user_id}: {anim_e}", exc_info=True)
-                        finally:
-                            if anim_file_handle and anim_file_handle in opened_files:
-                                try: await asyncio.to_thread(anim_file_handle.close); opened_files.remove(anim_file_handle)
-                                except Exception: pass
-
-                # --- Always Send Combined Text Separately ---
-                if combined_caption:
-                    logger.debug(f"Sending text details for P{prod_id} user {user_id}: {len(combined_caption)} characters")
-                    await send_message_with_retry(context.bot, chat_id, combined_caption, parse_mode=None)
-                    logger.info(f"✅ Successfully sent text details for P{prod_id} user {user_id}")
-                else:
-                     # Create a fallback message if both original text and header are missing somehow
-                    fallback_text = f"(No details provided for Product ID {prod_id})"
-                    await send_message_with_retry(context.bot, chat_id, fallback_text, parse_mode=None)
-                    logger.warning(f"No combined caption text to send for P{prod_id} user {user_id}. Sent fallback.")
-
-            # --- Close any remaining opened file handles ---
-            for f in opened_files:
-                try:
-                    if not f.closed: await asyncio.to_thread(f.close)
-                except Exception as close_e: logger.warning(f"Error closing file handle during final cleanup: {close_e}")
-
-            # --- Product Record Deletion ---
-            conn_del = None
-            try:
-                conn_del = get_db_connection()
-                c_del = conn_del.cursor()
-                ids_tuple_list = [(pid,) for pid in processed_product_ids]
-                logger.info(f"Purchase Finalization: Attempting to delete product records for user {user_id}. IDs: {processed_product_ids}")
-                delete_result = c_del.executemany("DELETE FROM products WHERE id = ?", ids_tuple_list)
-                conn_del.commit()
-                deleted_count = delete_result.rowcount
-                logger.info(f"Deleted {deleted_count} purchased product records for user {user_id}. IDs: {processed_product_ids}")
-            except sqlite3.Error as e: logger.error(f"DB error deleting purchased products: {e}", exc_info=True); conn_del.rollback() if conn_del and conn_del.in_transaction else None
-            except Exception as e: logger.error(f"Unexpected error deleting purchased products: {e}", exc_info=True)
-            finally:
-                if conn_del: conn_del.close()
-
-            # --- Final Message to User ---
-            leave_review_button = lang_data.get("leave_review_button", "Leave a Review")
-            keyboard = [[InlineKeyboardButton(f"✍️ {leave_review_button}", callback_data="leave_review_now")]]
-            await send_message_with_retry(context.bot, chat_id, "Thank you for your purchase!", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+        logger.error(f"Unexpected error during purchase finalization user {user_id}: {e}", exc_info=True); return None
+
+    return processed_product_ids, final_pickup_details, media_details
+
+
+async def _finalize_purchase(user_id: int, chat_id: int, basket_snapshot: list, discount_code_used: str | None, context: ContextTypes.DEFAULT_TYPE, payment_intent_id: str | None = None, payment_id: str | None = None) -> bool:
+    """
+    Shared logic to finalize a purchase after payment confirmation (balance or crypto).
+    Decrements stock, adds purchase record, sends media first, then text separately,
+    cleans up product records.
+    With a payment_intent_id (balance purchases) the intent moves to fulfilled in the same
+    transaction, or to refunded with the balance credited back if no item can be fulfilled.
+    With a payment_id (crypto purchases) a repeated webhook for an already finalized payment is a no-op.
+    chat_id is resolved once by the caller and is required.
+    """
+    lang, lang_data = _get_lang_data(context)
+    if not basket_snapshot: logger.error(f"Empty basket_snapshot for user {user_id} purchase finalization."); return False
+
+    # The whole DB transaction runs in a single worker thread, so the event loop is never blocked on sqlite
+    db_result = await asyncio.to_thread(_finalize_purchase_db, user_id, basket_snapshot, discount_code_used, payment_intent_id, payment_id)
+    if db_result is _ALREADY_FINALIZED: return True
+
+    # --- Post-Transaction Cleanup & Message Sending ---
+    # The basket is spent either way (the DB copy was cleared in the transaction on success)
+    context.user_data['basket'] = []
+    context.user_data.pop('applied_discount', None)
+
+    if db_result:
+        processed_product_ids, final_pickup_details, media_details = db_result
+        # Send Pickup Details: media goes out first, concurrently per product
+        products_to_deliver = [pid for pid in processed_product_ids if pid in final_pickup_details]
+        # Stat every local media file (those without a file_id) in one thread hop
+        local_media_paths = [m['file_path'] for pid in products_to_deliver for m in media_details.get(pid, []) if m['file_path'] and not m['telegram_file_id']]
+        existing_media_paths = await asyncio.to_thread(_existing_paths, local_media_paths) if local_media_paths else set()
+        # At most PURCHASE_MEDIA_CONCURRENCY products upload at once, so uploads overlap without flooding the chat
+        media_sema = asyncio.Semaphore(PURCHASE_MEDIA_CONCURRENCY)
+        async def send_one(prod_id):
+            async with media_sema:
+                await _send_product_media(context.bot, chat_id, user_id, prod_id, media_details.get(prod_id, []), existing_media_paths)
+        delivery_results = await asyncio.gather(*(send_one(prod_id) for prod_id in products_to_deliver), return_exceptions=True)
+        for prod_id, result in zip(products_to_deliver, delivery_results):
+            if isinstance(result, Exception): logger.error(f"❌ Error delivering media P{prod_id} to user {user_id}: {result}", exc_info=result)
+
+        # Then title + every product's pickup details + thank-you as one text message
+        # (split at Telegram's length limit only when needed), with the review button on the last part
+        success_title = lang_data["purchase_success"]
+        leave_review_button = lang_data["leave_review_button"]
+        review_markup = InlineKeyboardMarkup([[InlineKeyboardButton(f"✍️ {leave_review_button}", callback_data="leave_review_now")]])
+        text_messages = _pack_messages([success_title, *(_pickup_text(final_pickup_details[pid]) for pid in products_to_deliver), "Thank you for your purchase!"])
+        for i, text in enumerate(text_messages):
+            markup = review_markup if i == len(text_messages) - 1 else None
+            await paced_send(chat_id, lambda: send_message_with_retry(context.bot, chat_id, text, reply_markup=markup, parse_mode=None))
+        logger.info(f"✅ Sent pickup details for {len(products_to_deliver)} product(s) to user {user_id} in {len(text_messages)} message(s)")
 
         return True # Indicate success
-    else: # Purchase failed at DB level
-        context.user_data['basket'] = []
-        context.user_data.pop('applied_discount', None)
-        if chat_id: await send_message_with_retry(context.bot, chat_id, lang_data.get("error_processing_purchase_contact_support", "❌ Error processing purchase."), parse_mode=None)
-        return False
+
+    # Purchase failed or was aborted at DB level. Balance purchases send their one message from
+    # process_purchase_with_balance instead, once the refund outcome is known.
+    if not payment_intent_id:
+        await send_message_with_retry(context.bot, chat_id, lang_data["error_processing_purchase_contact_support"], parse_mode=None)
+    return False
 
 
 # --- Process Purchase with Balance (Uses Helper) ---
-async def process_purchase_with_balance(user_id: int, amount_to_deduct: Decimal, basket_snapshot: list, discount_code_used: str | None, context: ContextTypes.DEFAULT_TYPE) -> bool:
+async def process_purchase_with_balance(user_id: int, chat_id: int, amount_to_deduct: Decimal, basket_snapshot: list, discount_code_used: str | None, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Handles DB updates when paying with internal balance."""
-    chat_id = context._chat_id or context._user_id or user_id
+    if not chat_id: raise ValueError(f"process_purchase_with_balance needs a chat_id (user {user_id})")
     lang = context.user_data.get("lang", "en")
-    lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
+    lang_data = get_lang_view(lang)
 
     if not basket_snapshot: logger.error(f"Empty basket_snapshot for user {user_id} balance purchase."); return False
     if not isinstance(amount_to_deduct, Decimal) or amount_to_deduct < Decimal('0.0'): logger.error(f"Invalid amount_to_deduct {amount_to_deduct}."); return False
 
-    conn = None
-    db_balance_deducted = False
-    balance_changed_error = lang_data.get("balance_changed_error", "❌ Transaction failed: Balance changed.")
-    error_processing_purchase_contact_support = lang_data.get("error_processing_purchase_contact_support", "❌ Error processing purchase. Contact support.")
+    balance_changed_error = lang_data["balance_changed_error"]
+    error_processing_purchase_contact_support = lang_data["error_processing_purchase_contact_support"]
 
+    intent_id = uuid.uuid4().hex
+    intent_state = 'pending'
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("BEGIN EXCLUSIVE")
-        # 1. Verify balance
-        c.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-        current_balance_result = c.fetchone()
-        if not current_balance_result or Decimal(str(current_balance_result['balance'])) < amount_to_deduct:
-             logger.warning(f"Insufficient balance user {user_id}. Needed: {amount_to_deduct:.2f}")
-             conn.rollback()
-             # --- Unreserve items if balance check fails ---
-             logger.info(f"Un-reserving items for user {user_id} due to insufficient balance during payment.")
-             # Use asyncio.to_thread for synchronous helper
-             await asyncio.to_thread(_unreserve_basket_items, basket_snapshot)
-             # --- End Unreserve ---
-             if chat_id: await send_message_with_retry(context.bot, chat_id, balance_changed_error, parse_mode=None)
-             return False
-        # 2. Deduct balance
-        amount_float_to_deduct = float(amount_to_deduct)
-        update_res = c.execute("UPDATE users SET balance = balance - ? WHERE user_id = ?", (amount_float_to_deduct, user_id))
-        if update_res.rowcount == 0: logger.error(f"Failed to deduct balance user {user_id}."); conn.rollback(); return False
-
-        conn.commit() # Commit balance deduction *before* finalizing items
-        db_balance_deducted = True
-        logger.info(f"Deducted {amount_to_deduct:.2f} EUR from balance for user {user_id}.")
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
+            now_iso = datetime.now(timezone.utc).isoformat()
+            c.execute("INSERT INTO payment_intents (id, user_id, amount, state, basket_json, discount_code, created_at, updated_at) VALUES (?, ?, ?, 'pending', ?, ?, ?, ?)",
+                      (intent_id, user_id, float(amount_to_deduct), json.dumps(basket_snapshot, default=str), discount_code_used, now_iso, now_iso))
+            conn.commit()
+
+            # 1. Deduct only if the balance covers it: one atomic conditional UPDATE, no exclusive lock or prior SELECT
+            cents_to_deduct = to_cents(amount_to_deduct)
+            deduct_res = c.execute("UPDATE users SET balance_cents = balance_cents - ? WHERE user_id = ? AND balance_cents >= ?", (cents_to_deduct, user_id, cents_to_deduct))
+            if deduct_res.rowcount == 0:
+                # Only now tell "insufficient balance" apart from "user missing"
+                user_exists = c.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone()
+                logger.warning(f"Insufficient balance user {user_id}. Needed: {amount_to_deduct:.2f}" if user_exists else f"User {user_id} not found during balance purchase.")
+                c.execute("UPDATE payment_intents SET state = 'failed', updated_at = ? WHERE id = ? AND state = 'pending'", (now_iso, intent_id))
+                conn.commit()
+                intent_state = 'failed'
+            else:
+                # 2. Hold the deducted amount on the intent in the same transaction
+                c.execute("UPDATE payment_intents SET state = 'balance_held', updated_at = ? WHERE id = ? AND state = 'pending'", (now_iso, intent_id))
+                conn.commit() # Commit balance deduction *before* finalizing items
+                intent_state = 'balance_held'
+                logger.info(f"Deducted {amount_to_deduct:.2f} EUR from balance for user {user_id} (payment intent {intent_id}).")
 
     except sqlite3.Error as e:
-        logger.error(f"DB error deducting balance user {user_id}: {e}", exc_info=True); db_balance_deducted = False
-        if conn and conn.in_transaction: conn.rollback()
-    finally:
-        if conn: conn.close()
+        logger.error(f"DB error deducting balance user {user_id}: {e}", exc_info=True)
 
-    # 3. Finalize purchase ONLY if balance was successfully deducted
-    if db_balance_deducted:
+    if intent_state == 'failed':
+        # --- Unreserve items if balance check fails ---
+        logger.info(f"Un-reserving items for user {user_id} due to insufficient balance during payment.")
+        await release_basket_reservations(basket_snapshot)
+        # --- End Unreserve ---
+        await send_message_with_retry(context.bot, chat_id, balance_changed_error, parse_mode=None)
+        return False
+
+    # 3. Finalize purchase ONLY if the balance is held on the intent
+    if intent_state == 'balance_held':
         logger.info(f"Calling _finalize_purchase for user {user_id} after balance deduction.")
-        # Now call the shared finalization logic
-        finalize_success = await _finalize_purchase(user_id, basket_snapshot, discount_code_used, context)
+        # Now call the shared finalization logic; it moves the intent to fulfilled (or refunded) atomically
+        finalize_success = await _finalize_purchase(user_id, chat_id, basket_snapshot, discount_code_used, context, payment_intent_id=intent_id)
         if not finalize_success:
-            # Critical issue: Balance deducted but finalization failed.
-            logger.critical(f"CRITICAL: Balance deducted for user {user_id} but _finalize_purchase FAILED! Attempting to refund.")
-            refund_conn = None
-            try:
-                refund_conn = get_db_connection()
-                refund_c = refund_conn.cursor()
-                refund_c.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount_float_to_deduct, user_id))
-                refund_conn.commit()
-                logger.info(f"Successfully refunded {amount_float_to_deduct} EUR to user {user_id} after finalization failure.")
-                if chat_id: await send_message_with_retry(context.bot, chat_id, error_processing_purchase_contact_support + " Balance refunded.", parse_mode=None)
-            except Exception as refund_e:
-                logger.critical(f"CRITICAL REFUND FAILED for user {user_id}: {refund_e}. Manual balance correction required.")
-                if ADMIN_ID and chat_id: # Notify admin if refund fails
-                    await send_message_with_retry(context.bot, ADMIN_ID, f"⚠️ CRITICAL REFUND FAILED for user {user_id} after purchase finalization error. Amount: {amount_to_deduct}. MANUAL CORRECTION NEEDED!", parse_mode=None)
-                if chat_id: await send_message_with_retry(context.bot, chat_id, error_processing_purchase_contact_support, parse_mode=None)
-            finally:
-                if refund_conn: refund_conn.close()
+            # Refund it now unless finalization (nothing in stock) or the sweeper already did; either way, one message
+            refund_result = await asyncio.to_thread(_refund_payment_intent, intent_id)
+            if refund_result is not RefundResult.FAILED:
+                # Whoever refunded earlier released the reservations in the same step
+                if refund_result is RefundResult.REFUNDED: await release_basket_reservations(basket_snapshot)
+                await send_message_with_retry(context.bot, chat_id, error_processing_purchase_contact_support + " Balance refunded.", parse_mode=None)
+            else:
+                logger.critical(f"CRITICAL: Refund of payment intent {intent_id} for user {user_id} failed; the payment intent sweeper will retry.")
+                await notify_admin(context.bot, "refund_failed", intent_id=intent_id, user_id=user_id, amount=f"{amount_to_deduct:.2f}")
+                await send_message_with_retry(context.bot, chat_id, error_processing_purchase_contact_support, parse_mode=None)
         return finalize_success
     else:
         logger.error(f"Skipping purchase finalization for user {user_id} due to balance deduction failure.")
+        await asyncio.to_thread(_fail_pending_payment_intent, intent_id)
         # --- Unreserve items if balance deduction failed ---
         logger.info(f"Un-reserving items for user {user_id} due to balance deduction failure.")
-        # Use asyncio.to_thread for synchronous helper
-        await asyncio.to_thread(_unreserve_basket_items, basket_snapshot)
+        await release_basket_reservations(basket_snapshot)
         # --- End Unreserve ---
-        if chat_id: await send_message_with_retry(context.bot, chat_id, error_processing_purchase_contact_support, parse_mode=None)
+        await send_message_with_retry(context.bot, chat_id, error_processing_purchase_contact_support, parse_mode=None)
         return False
 
+# --- Admin Alerts ---
+# Resolved once at import: with no ADMIN_ID configured, notify_admin is a no-op and callers need no guard.
+_ADMIN_ALERT_TEMPLATES = {
+    "missing_basket": "⚠️ Critical Issue: Crypto payment {payment_id} success for user {user_id}, but basket data missing! Manual check needed.",
+    "finalize_failed": "⚠️ Critical Issue: Crypto payment {payment_id} success for user {user_id}, but finalization FAILED! Check logs! MANUAL INTERVENTION REQUIRED.",
+    "refund_failed": "⚠️ CRITICAL REFUND FAILED for user {user_id} after purchase finalization error (payment intent {intent_id}). Amount: {amount} EUR. MANUAL CORRECTION NEEDED!",
+}
+
+async def _send_admin_alert(bot, kind: str, **fields):
+    """Sends the admin alert template `kind` filled with fields; failures are logged, never raised."""
+    try:
+        await send_message_with_retry(bot, ADMIN_ID, _ADMIN_ALERT_TEMPLATES[kind].format(**fields), parse_mode=None)
+    except Exception as admin_notify_e:
+        logger.error(f"Failed to notify admin ({kind}) for {fields}: {admin_notify_e}")
+
+async def _skip_admin_alert(bot, kind: str, **fields):
+    return None
+
+notify_admin = _send_admin_alert if ADMIN_ID else _skip_admin_alert
+
+
+async def handle_missing_basket_snapshot(bot, payment_id: str, user_id: int):
+    """Webhook path for a paid purchase whose pending record has no basket: nothing to finalize, alert the admin."""
+    logger.error(f"CRITICAL: Successful crypto payment {payment_id} for user {user_id} received, but basket snapshot was empty/missing in pending record.")
+    await notify_admin(bot, "missing_basket", payment_id=payment_id, user_id=user_id)
+
+
 # --- Process Successful Crypto Purchase (Uses Helper) ---
-async def process_successful_crypto_purchase(user_id: int, basket_snapshot: list, discount_code_used: str | None, payment_id: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Handles finalizing a purchase paid via crypto webhook."""
-    chat_id = context._chat_id or context._user_id or user_id # Try to get chat_id
+async def process_successful_crypto_purchase(user_id: int, chat_id: int, basket_snapshot: list, discount_code_used: str | None, payment_id: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Handles finalizing a purchase paid via crypto webhook.
+    The webhook checks basket_snapshot is non-empty before calling (see handle_missing_basket_snapshot)."""
+    if not chat_id: raise ValueError(f"process_successful_crypto_purchase needs a chat_id (user {user_id}, payment {payment_id})")
     lang = context.user_data.get("lang", "en")
-    lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
+    lang_data = get_lang_view(lang)
 
-    logger.info(f"Processing successful crypto purchase for user {user_id}, payment {payment_id}. Basket items: {len(basket_snapshot) if basket_snapshot else 0}")
-
-    if not basket_snapshot:
-        logger.error(f"CRITICAL: Successful crypto payment {payment_id} for user {user_id} received, but basket snapshot was empty/missing in pending record.")
-        if ADMIN_ID and chat_id:
-            try:
-                await send_message_with_retry(context.bot, ADMIN_ID, f"⚠️ Critical Issue: Crypto payment {payment_id} success for user {user_id}, but basket data missing! Manual check needed.", parse_mode=None)
-            except Exception as admin_notify_e:
-                logger.error(f"Failed to notify admin about critical missing basket data: {admin_notify_e}")
-        return False # Cannot proceed
+    logger.info(f"Processing successful crypto purchase for user {user_id}, payment {payment_id}. Basket items: {len(basket_snapshot)}")
 
     # Call the shared finalization logic
-    finalize_success = await _finalize_purchase(user_id, basket_snapshot, discount_code_used, context)
+    finalize_success = await _finalize_purchase(user_id, chat_id, basket_snapshot, discount_code_used, context, payment_id=payment_id)
 
     if finalize_success:
         # _finalize_purchase now handles the user-facing confirmation messages
@@ -964,119 +1375,117 @@ async def process_successful_crypto_purchase(user_id: int, basket_snapshot: list
     else:
         # Finalization failed even after payment confirmed. This is bad.
         logger.error(f"CRITICAL: Crypto payment {payment_id} success for user {user_id}, but _finalize_purchase failed! Items paid for but not processed in DB correctly.")
-        if ADMIN_ID and chat_id:
-            try:
-                await send_message_with_retry(context.bot, ADMIN_ID, f"⚠️ Critical Issue: Crypto payment {payment_id} success for user {user_id}, but finalization FAILED! Check logs! MANUAL INTERVENTION REQUIRED.", parse_mode=None)
-            except Exception as admin_notify_e:
-                 logger.error(f"Failed to notify admin about critical finalization failure: {admin_notify_e}")
-        if chat_id:
-            await send_message_with_retry(context.bot, chat_id, lang_data.get("error_processing_purchase_contact_support", "❌ Error processing purchase. Contact support."), parse_mode=None)
+        # Admin alert and user error go out together over the bot's shared keep-alive connection pool
+        await asyncio.gather(
+            notify_admin(context.bot, "finalize_failed", payment_id=payment_id, user_id=user_id),
+            send_message_with_retry(context.bot, chat_id, lang_data["error_processing_purchase_contact_support"], parse_mode=None),
+            return_exceptions=True
+        )
 
     return finalize_success
 
 
-# --- NEW: Helper Function to Credit User Balance (Moved from Previous Response) ---
-async def credit_user_balance(user_id: int, amount_eur: Decimal, reason: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Adds funds to a user's balance and notifies them."""
-    if not isinstance(amount_eur, Decimal) or amount_eur <= Decimal('0.0'):
-        logger.error(f"Invalid amount provided to credit_user_balance for user {user_id}: {amount_eur}")
-        return False
+# --- Credit Notification Templates ---
+class CreditKind(IntEnum):
+    """Why a balance credit happens; the caller knows it and it picks the notification template."""
+    OVERPAYMENT = 1 # Crypto purchase paid more than needed, surplus credited
+    UNDERPAYMENT = 2 # Crypto purchase paid too little, received amount credited instead
+    REFILL = 3 # Generic credit (like Refill)
 
-    conn = None
-    db_update_successful = False
-    amount_float = float(amount_eur)
-    new_balance_decimal = Decimal('0.0')
+# (language, credit kind) -> template, resolved once at import from the language views
+_CREDIT_TEMPLATE_KEYS = {
+    CreditKind.OVERPAYMENT: "credit_overpayment_purchase",
+    CreditKind.UNDERPAYMENT: "credit_underpayment_purchase",
+    CreditKind.REFILL: "credit_refill",
+}
+CREDIT_TEMPLATES = {(lang, kind): get_lang_view(lang)[key] for lang in LANGUAGES for kind, key in _CREDIT_TEMPLATE_KEYS.items()}
 
-    try:
-        conn = get_db_connection()
+
+# --- NEW: Helper Function to Credit User Balance (Moved from Previous Response) ---
+def _credit_user_balance_sync(user_id: int, amount_cents: int, reason: str, payment_id: str | None):
+    """
+    Blocking DB half of credit_user_balance, run in one worker thread hop.
+    Returns (old_balance_cents, new_balance_cents, language) after crediting, _ALREADY_FINALIZED if payment_id was
+    already applied, or None if the user is missing. sqlite errors propagate to the caller.
+    """
+    # The inner `with conn:` commits when the block completes and rolls back if it raises
+    with db_pool.acquire() as conn, conn:
         c = conn.cursor()
-        c.execute("BEGIN")
-        logger.info(f"Attempting to credit balance for user {user_id} by {amount_float:.2f} EUR. Reason: {reason}")
+        c.execute("BEGIN IMMEDIATE") # Take the write lock up front instead of upgrading mid-transaction
+        logger.info(f"Attempting to credit balance for user {user_id} by {format_cents(amount_cents)} EUR. Reason: {reason}")
+
+        # Claim the dedup key in the same transaction as the credit, so a repeated webhook can't credit twice
+        if payment_id:
+            claim_res = c.execute("INSERT OR IGNORE INTO processed_payments (payment_id, user_id, amount, processed_at) VALUES (?, ?, ?, ?)", (payment_id, user_id, amount_cents / 100, datetime.now(timezone.utc).isoformat()))
+            if claim_res.rowcount == 0:
+                logger.info(f"Credit for payment {payment_id} user {user_id} was already applied. Ignoring duplicate.")
+                return _ALREADY_FINALIZED # Nothing was written
+
+        # One round trip: credit and read back the new balance and the language for the notification
+        credit_row = c.execute(
+            "UPDATE users SET balance_cents = balance_cents + ? WHERE user_id = ? RETURNING balance_cents AS new_balance_cents, language",
+            (amount_cents, user_id)
+        ).fetchone()
+        if not credit_row:
+            logger.error(f"User {user_id} not found during balance credit update. Reason: {reason}")
+            conn.rollback() # Release the payment_id claim too, so a later retry can still credit
+            return None
+
+    new_balance_cents, user_db_lang = credit_row['new_balance_cents'], credit_row['language']
+    old_balance_cents = new_balance_cents - amount_cents # Exact in integer cents, so no read before the UPDATE
+    if user_db_lang in LANGUAGES: set_user_lang_cache(user_id, user_db_lang) # Fresh from the row, keep the cache warm
+    logger.info(f"Successfully credited balance for user {user_id}. Added: {format_cents(amount_cents)} EUR. New Balance: {format_cents(new_balance_cents)} EUR. Reason: {reason}")
+
+    # Log this as an automatic system action (or maybe under ADMIN_ID if preferred)
+    log_admin_action(
+         admin_id=0, # Or ADMIN_ID if you want admin to "own" these logs
+         action="BALANCE_CREDIT_AUTO",
+         target_user_id=user_id,
+         reason=reason,
+         amount_change=amount_cents / 100,
+         old_value=old_balance_cents / 100,
+         new_value=new_balance_cents / 100
+    )
+    return old_balance_cents, new_balance_cents, user_db_lang
 
-        # Get old balance for logging
-        c.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-        old_balance_res = c.fetchone(); old_balance_float = old_balance_res['balance'] if old_balance_res else 0.0
 
-        update_result = c.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount_float, user_id))
-        if update_result.rowcount == 0:
-            logger.error(f"User {user_id} not found during balance credit update. Reason: {reason}")
-            conn.rollback()
-            return False
+async def credit_user_balance(user_id: int, amount_eur: Decimal, reason: str, context: ContextTypes.DEFAULT_TYPE, payment_id: str | None = None, kind: CreditKind = CreditKind.REFILL) -> bool:
+    """Adds funds to a user's balance and notifies them.
+    payment_id is an idempotency key: a credit already applied under the same key is skipped (returns True).
+    kind selects the notification template; reason is free text for the logs."""
+    if not isinstance(amount_eur, Decimal) or amount_eur <= Decimal('0.0'):
+        logger.error(f"Invalid amount provided to credit_user_balance for user {user_id}: {amount_eur}")
+        return False
 
-        c.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-        new_balance_result = c.fetchone()
-        if new_balance_result:
-             new_balance_decimal = Decimal(str(new_balance_result['balance']))
-        else:
-             logger.error(f"Could not fetch new balance for {user_id} after credit update."); conn.rollback(); return False
-
-        conn.commit()
-        db_update_successful = True
-        logger.info(f"Successfully credited balance for user {user_id}. Added: {amount_eur:.2f} EUR. New Balance: {new_balance_decimal:.2f} EUR. Reason: {reason}")
-
-        # Log this as an automatic system action (or maybe under ADMIN_ID if preferred)
-        log_admin_action(
-             admin_id=0, # Or ADMIN_ID if you want admin to "own" these logs
-             action="BALANCE_CREDIT_AUTO",
-             target_user_id=user_id,
-             reason=reason,
-             amount_change=amount_float,
-             old_value=old_balance_float,
-             new_value=float(new_balance_decimal)
+    try:
+        # All DB work (credit, dedup claim, admin log) in a single thread hop; only the notification runs on the loop
+        credit_result = await asyncio.to_thread(_credit_user_balance_sync, user_id, to_cents(amount_eur), reason, payment_id)
+        if credit_result is _ALREADY_FINALIZED: return True
+        if credit_result is None: return False
+        _, new_balance_cents, user_db_lang = credit_result
+
+        # Notify User (callers always pass a CallbackContext, so context.bot is there)
+        # Language for notification: from context if available, else the one returned by the credit UPDATE
+        lang = context.user_data.get("lang") or user_db_lang
+        notify_msg_template = CREDIT_TEMPLATES.get((lang, kind)) or CREDIT_TEMPLATES[('en', kind)]
+
+        notify_msg = notify_msg_template.format(
+            amount=format_currency(amount_eur),
+            new_balance=format_cents(new_balance_cents),
+            reason=reason # Include reason for generic credits
         )
 
-        # Notify User
-        bot_instance = context.bot if hasattr(context, 'bot') else None
-        if bot_instance:
-            # Get user language for notification
-            lang = context.user_data.get("lang", "en") # Get from context if available
-            if not lang: # Fallback: Get from DB if not in context
-                conn_lang = None
-                try:
-                    conn_lang = get_db_connection()
-                    c_lang = conn_lang.cursor()
-                    c_lang.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-                    lang_res = c_lang.fetchone()
-                    if lang_res and lang_res['language'] in LANGUAGES: lang = lang_res['language']
-                except Exception as lang_e: logger.warning(f"Could not fetch user lang for credit msg: {lang_e}")
-                finally:
-                     if conn_lang: conn_lang.close()
-            lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
-
-
-            # <<< TODO: Add these messages to LANGUAGES dictionary >>>
-            if "Overpayment" in reason:
-                # Example message key: "credit_overpayment_purchase"
-                notify_msg_template = lang_data.get("credit_overpayment_purchase", "✅ Your purchase was successful! Additionally, an overpayment of {amount} EUR has been credited to your balance. Your new balance is {new_balance} EUR.")
-            elif "Underpayment" in reason:
-                # Example message key: "credit_underpayment_purchase"
-                 notify_msg_template = lang_data.get("credit_underpayment_purchase", "ℹ️ Your purchase failed due to underpayment, but the received amount ({amount} EUR) has been credited to your balance. Your new balance is {new_balance} EUR.")
-            else: # Generic credit (like Refill)
-                # Example message key: "credit_refill"
-                notify_msg_template = lang_data.get("credit_refill", "✅ Your balance has been credited by {amount} EUR. Reason: {reason}. New balance: {new_balance} EUR.")
-
-            notify_msg = notify_msg_template.format(
-                amount=format_currency(amount_eur),
-                new_balance=format_currency(new_balance_decimal),
-                reason=reason # Include reason for generic credits
-            )
-
-            await send_message_with_retry(bot_instance, user_id, notify_msg, parse_mode=None)
-        else:
-             logger.error(f"Could not get bot instance to notify user {user_id} about balance credit.")
+        await send_message_with_retry(context.bot, user_id, notify_msg, parse_mode=None)
 
         return True
 
     except sqlite3.Error as e:
+        # The pool rolls back any open transaction when the connection is released
         logger.error(f"DB error during credit_user_balance user {user_id}: {e}", exc_info=True)
-        if conn and conn.in_transaction: conn.rollback()
         return False
     except Exception as e:
          logger.error(f"Unexpected error during credit_user_balance user {user_id}: {e}", exc_info=True)
-         if conn and conn.in_transaction: conn.rollback()
          return False
-    finally:
-        if conn: conn.close()
 # --- END credit_user_balance ---
 
 
@@ -1102,14 +1511,15 @@ async def handle_cancel_crypto_payment(update: Update, context: ContextTypes.DEF
 
     if payment_id:
         logger.info(f"User {user_id} cancelled pending crypto payment {payment_id}.")
+        # Answer the callback first so the button responds immediately; the DB work follows
+        await query.answer(lang_data["payment_cancelled_user"])
         # Call remove_pending_deposit, which will handle un-reserving if needed
         # Run the synchronous DB operation in a separate thread
-        await asyncio.to_thread(remove_pending_deposit, payment_id, trigger='user_cancel')
-        cancel_confirm_msg = lang_data.get("payment_cancelled_user", "Payment cancelled. Reserved items (if any) have been released.")
-        await query.answer(cancel_confirm_msg)
+        try: await asyncio.to_thread(remove_pending_deposit, payment_id, trigger='user_cancel')
+        except Exception as e: logger.error(f"Error removing pending deposit {payment_id} on user cancel: {e}", exc_info=True) # Basket view below still reads the real state
     else:
         logger.warning(f"User {user_id} clicked cancel_crypto_payment, but no pending_payment_id found in context.")
-        cancel_error_msg = lang_data.get("payment_cancel_error", "Could not cancel payment (already processed or context lost).")
+        cancel_error_msg = lang_data["payment_cancel_error"]
         await query.answer(cancel_error_msg, show_alert=True)
 
     # Always attempt to refresh the basket view
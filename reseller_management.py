@@ -14,7 +14,7 @@ import telegram.error as telegram_error
 # Import shared elements from utils
 from utils import (
     ADMIN_ID, LANGUAGES, get_db_connection, send_message_with_retry,
-    PRODUCT_TYPES, format_currency, log_admin_action, load_all_data,
+    PRODUCT_TYPES, get_sorted_product_types, format_currency, log_admin_action,
     DEFAULT_PRODUCT_EMOJI,
     # Import action constants for logging
     ACTION_RESELLER_ENABLED, ACTION_RESELLER_DISABLED,
@@ -57,6 +57,33 @@ def get_reseller_discount(user_id: int, product_type: str) -> Decimal:
     return discount
 
 
+# --- Helper Function to Get All Reseller Discounts for a Basket ---
+def get_reseller_discounts(user_id: int, product_types) -> dict:
+    """Fetches the reseller discount percentages for several product types in one query. Missing types map to nothing (0%)."""
+    discounts = {}
+    product_types = list(set(product_types))
+    if not product_types: return discounts
+    conn = None
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        placeholders = ','.join('?' * len(product_types))
+        c.execute(f"""
+            SELECT rd.product_type, rd.discount_percentage FROM reseller_discounts rd
+            JOIN users u ON u.user_id = rd.reseller_user_id
+            WHERE rd.reseller_user_id = ? AND u.is_reseller = 1 AND rd.product_type IN ({placeholders})
+        """, [user_id] + product_types)
+        for row in c.fetchall():
+            discounts[row['product_type']] = Decimal(str(row['discount_percentage']))
+        if discounts: logger.debug(f"Found reseller discounts for user {user_id}: {discounts}")
+    except sqlite3.Error as e:
+        logger.error(f"DB error fetching reseller discounts for user {user_id}, types {product_types}: {e}")
+    except Exception as e:
+        logger.error(f"Unexpected error fetching reseller discounts: {e}", exc_info=True)
+    finally:
+        if conn: conn.close()
+    return discounts
+
 # ==================================
 # --- Admin: Manage Reseller Status --- (REVISED FLOW)
 # ==================================
@@ -347,14 +374,12 @@ async def handle_reseller_add_discount_select_type(update: Update, context: Cont
     # <<< STORE the target ID in context >>>
     context.user_data['reseller_mgmt_target_id'] = target_reseller_id
 
-    load_all_data() # Ensure PRODUCT_TYPES is fresh
-
     if not PRODUCT_TYPES:
         await query.edit_message_text("❌ No product types configured. Please add types via 'Manage Product Types'.", parse_mode=None)
         return
 
     keyboard = []
-    for type_name, emoji in sorted(PRODUCT_TYPES.items()):
+    for type_name, emoji in get_sorted_product_types():
         # <<< MODIFIED callback_data: Only command and type_name >>>
         callback_data_short = f"reseller_add_discount_enter_percent|{type_name}"
         # <<< ADDED length check >>>
@@ -18,7 +18,7 @@ import telegram.error as telegram_error
 # Import from utils
 from utils import (
     CITIES, DISTRICTS, PRODUCT_TYPES, THEMES, LANGUAGES, BOT_MEDIA, ADMIN_ID, BASKET_TIMEOUT, MIN_DEPOSIT_EUR,
-    format_currency, get_progress_bar, send_message_with_retry, format_discount_value,
+    format_currency, cents_to_eur, get_progress_bar, send_message_with_retry, format_discount_value,
     clear_expired_basket, fetch_last_purchases, get_user_status, fetch_reviews,
     NOWPAYMENTS_API_KEY, # Check if NOWPayments is configured
     get_db_connection, MEDIA_DIR, # Import helper and MEDIA_DIR
@@ -26,7 +26,8 @@ from utils import (
     load_active_welcome_message, # <<< Import welcome message loader (though we'll modify its usage)
     DEFAULT_WELCOME_MESSAGE, # <<< Import default welcome message fallback
     _get_lang_data, # <<< IMPORT THE HELPER FROM UTILS >>>
-    _unreserve_basket_items # <<< IMPORT UNRESERVE HELPER >>>
+    _unreserve_basket_items, # <<< IMPORT UNRESERVE HELPER >>>
+    set_user_lang_cache, get_sorted_city_ids, get_sorted_district_ids
 )
 import json # <<< Make sure json is imported
 import payment # <<< Make sure payment module is imported
@@ -101,10 +102,10 @@ def _build_start_menu_content(user_id: int, username: str, lang_data: dict, cont
         conn = get_db_connection()
         c = conn.cursor()
         # Get user stats
-        c.execute("SELECT balance, total_purchases FROM users WHERE user_id = ?", (user_id,))
+        c.execute("SELECT balance_cents, total_purchases FROM users WHERE user_id = ?", (user_id,))
         result = c.fetchone()
         if result:
-            balance = Decimal(str(result['balance']))
+            balance = cents_to_eur(result['balance_cents'])
             purchases = result['total_purchases']
 
         # Get active welcome template name setting
@@ -315,12 +316,8 @@ async def handle_shop(update: Update, context: ContextTypes.DEFAULT_TYPE, params
         return
 
     try:
-        sorted_city_ids = sorted(CITIES.keys(), key=lambda city_id: CITIES.get(city_id, ''))
-        keyboard = []
-        for c_id in sorted_city_ids:
-             city_name = CITIES.get(c_id)
-             if city_name: keyboard.append([InlineKeyboardButton(f"{EMOJI_CITY} {city_name}", callback_data=f"city|{c_id}")])
-             else: logger.warning(f"handle_shop: City name missing for ID {c_id}.")
+        sorted_city_ids = get_sorted_city_ids()
+        keyboard = [[InlineKeyboardButton(f"{EMOJI_CITY} {CITIES[c_id]}", callback_data=f"city|{c_id}")] for c_id in sorted_city_ids if c_id in CITIES]
         keyboard.append([InlineKeyboardButton(f"{EMOJI_HOME} {home_button_text}", callback_data="back_start")])
         reply_markup = InlineKeyboardMarkup(keyboard)
         message_text = f"{EMOJI_CITY} {choose_city_title}\n\n{select_location_prompt}"
@@ -362,7 +359,6 @@ async def handle_city_selection(update: Update, context: ContextTypes.DEFAULT_TY
     error_loading_districts = lang_data.get("error_loading_districts", "Error loading districts. Please try again.")
     available_label_short = lang_data.get("available_label_short", "Av") # Get short available label
 
-    keyboard = []
     message_text_parts = [f"{EMOJI_CITY} {city_name}\n\n"] # Start message
     districts_with_products_info = [] # Store tuples: (d_id, dist_name)
 
@@ -373,7 +369,7 @@ async def handle_city_selection(update: Update, context: ContextTypes.DEFAULT_TY
         return
     else:
         # If districts are configured, check each one for products
-        sorted_district_ids = sorted(districts_in_city.keys(), key=lambda dist_id: districts_in_city.get(dist_id, ''))
+        sorted_district_ids = get_sorted_district_ids(city_id)
         conn = None
         try:
             conn = get_db_connection()
@@ -441,8 +437,7 @@ async def handle_city_selection(update: Update, context: ContextTypes.DEFAULT_TY
             final_message = "".join(message_text_parts)
 
             # Create buttons ONLY for districts with products
-            for d_id, dist_name in districts_with_products_info:
-                 keyboard.append([InlineKeyboardButton(f"{EMOJI_DISTRICT} {dist_name}", callback_data=f"dist|{city_id}|{d_id}")])
+            keyboard = [[InlineKeyboardButton(f"{EMOJI_DISTRICT} {dist_name}", callback_data=f"dist|{city_id}|{d_id}")] for d_id, dist_name in districts_with_products_info]
 
             keyboard.append([InlineKeyboardButton(f"{EMOJI_BACK} {back_cities_button}", callback_data="shop"), InlineKeyboardButton(f"{EMOJI_HOME} {home_button}", callback_data="back_start")])
 
@@ -502,10 +497,7 @@ async def handle_district_selection(update: Update, context: ContextTypes.DEFAUL
             keyboard = [[InlineKeyboardButton(f"{EMOJI_BACK} {back_districts_button}", callback_data=f"city|{city_id}"), InlineKeyboardButton(f"{EMOJI_HOME} {home_button}", callback_data="back_start")]]
             await query.edit_message_text(f"{EMOJI_CITY} {city}\n{EMOJI_DISTRICT} {district}\n\n{no_types_msg}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
         else:
-            keyboard = []
-            for pt in available_types:
-                emoji = PRODUCT_TYPES.get(pt, DEFAULT_PRODUCT_EMOJI)
-                keyboard.append([InlineKeyboardButton(f"{emoji} {pt}", callback_data=f"type|{city_id}|{dist_id}|{pt}")])
+            keyboard = [[InlineKeyboardButton(f"{PRODUCT_TYPES.get(pt, DEFAULT_PRODUCT_EMOJI)} {pt}", callback_data=f"type|{city_id}|{dist_id}|{pt}")] for pt in available_types]
             # Go back to city selection (which now shows the product list)
             keyboard.append([InlineKeyboardButton(f"{EMOJI_BACK} {back_districts_button}", callback_data=f"city|{city_id}"), InlineKeyboardButton(f"{EMOJI_HOME} {home_button}", callback_data="back_start")])
             await query.edit_message_text(f"{EMOJI_CITY} {city}\n{EMOJI_DISTRICT} {district}\n\n{select_type_prompt}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
@@ -824,10 +816,10 @@ async def handle_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, par
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("SELECT balance, total_purchases FROM users WHERE user_id = ?", (user_id,))
+        c.execute("SELECT balance_cents, total_purchases FROM users WHERE user_id = ?", (user_id,))
         result = c.fetchone()
         if not result: logger.error(f"User {user_id} not found in DB for profile."); await query.edit_message_text("❌ Error: Could not load profile.", parse_mode=None); return
-        balance, purchases = Decimal(str(result['balance'])), result['total_purchases']
+        balance, purchases = cents_to_eur(result['balance_cents']), result['total_purchases']
 
         # Call synchronous clear_expired_basket (no await needed)
         clear_expired_basket(context, user_id) # Assuming clear_expired_basket is synchronous
@@ -1400,9 +1392,9 @@ async def handle_confirm_pay(update: Update, context: ContextTypes.DEFAULT_TYPE,
                 await query.answer("Applied discount code became invalid.", show_alert=True)
 
         if final_total < Decimal('0.0'): final_total = Decimal('0.0')
-        c.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+        c.execute("SELECT balance_cents FROM users WHERE user_id = ?", (user_id,))
         balance_result = c.fetchone()
-        user_balance = Decimal(str(balance_result['balance'])) if balance_result else Decimal('0.0')
+        user_balance = cents_to_eur(balance_result['balance_cents']) if balance_result else Decimal('0.0')
     except (sqlite3.Error, Exception) as e:
         logger.error(f"Error during payment confirm data processing user {user_id}: {e}", exc_info=True)
         error_occurred = True
@@ -1422,7 +1414,7 @@ async def handle_confirm_pay(update: Update, context: ContextTypes.DEFAULT_TYPE,
             if query.message: await query.edit_message_text("⏳ Processing payment with balance...", reply_markup=None, parse_mode=None)
             else: await send_message_with_retry(context.bot, chat_id, "⏳ Processing payment with balance...", parse_mode=None)
         except telegram_error.BadRequest: await query.answer("Processing...")
-        success = await payment.process_purchase_with_balance(user_id, final_total, valid_basket_items_snapshot, discount_code_to_use, context)
+        success = await payment.process_purchase_with_balance(user_id, chat_id, final_total, valid_basket_items_snapshot, discount_code_to_use, context)
         if success:
             try: pass # User notification handled in process_purchase_with_balance
             except telegram_error.BadRequest: pass
@@ -1771,6 +1763,7 @@ async def handle_language_selection(update: Update, context: ContextTypes.DEFAUL
                 logger.info(f"User {user_id} DB language updated to {new_lang}")
 
                 context.user_data["lang"] = new_lang
+                set_user_lang_cache(user_id, new_lang)
                 logger.info(f"User {user_id} context language updated to {new_lang}")
 
                 # Use the just loaded LANGUAGES dict
@@ -1837,7 +1830,7 @@ async def handle_price_list(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
     if not CITIES: no_cities_msg = lang_data.get("no_cities_for_prices", "No cities available."); keyboard = [[InlineKeyboardButton(f"{EMOJI_HOME} {lang_data.get('home_button', 'Home')}", callback_data="back_start")]]; await query.edit_message_text(f"{EMOJI_CITY} {no_cities_msg}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None); return
 
-    sorted_city_ids = sorted(CITIES.keys(), key=lambda city_id: CITIES.get(city_id, ''))
+    sorted_city_ids = get_sorted_city_ids()
     home_button_text = lang_data.get("home_button", "Home")
     keyboard = [[InlineKeyboardButton(f"{EMOJI_CITY} {CITIES.get(c, 'N/A')}", callback_data=f"price_list_city|{c}")] for c in sorted_city_ids if CITIES.get(c)]
     keyboard.append([InlineKeyboardButton(f"{EMOJI_HOME} {home_button_text}", callback_data="back_start")])
@@ -1869,7 +1862,7 @@ async def handle_price_list_city(update: Update, context: ContextTypes.DEFAULT_T
             for row in results: price_size_key = (Decimal(str(row['price'])), row['size']); grouped_data[row['product_type']][price_size_key].append((row['district'], row['quantity']))
 
             for p_type in sorted(grouped_data.keys()):
-                type_data = grouped_data[p_type]; sorted_price_size = sorted(type_data.keys(), key=lambda x: (x[0], x[1]))
+                type_data = grouped_data[p_type]; sorted_price_size = sorted(type_data)
                 prod_emoji = PRODUCT_TYPES.get(p_type, DEFAULT_PRODUCT_EMOJI)
                 for price, size in sorted_price_size:
                     districts_list = type_data[(price, size)]; price_str = format_currency(price)
@@ -2104,7 +2097,7 @@ async def handle_refill_amount_message(update: Update, context: ContextTypes.DEF
             await send_message_with_retry(context.bot, chat_id, f"❌ {amount_too_high_msg}", parse_mode=None)
             return
 
-        context.user_data['refill_eur_amount'] = float(refill_amount_decimal)
+        context.user_data['refill_eur_amount'] = refill_amount_decimal # Kept as Decimal, payment.py uses it directly
         context.user_data['state'] = 'awaiting_refill_crypto_choice' # State remains specific to refill
         logger.info(f"User {user_id} entered refill EUR: {refill_amount_decimal:.2f}. State -> awaiting_refill_crypto_choice")
 
@@ -2204,9 +2197,9 @@ async def handle_single_item_discount_code_message(update: Update, context: Cont
     try:
         conn_balance = get_db_connection()
         c_balance = conn_balance.cursor()
-        c_balance.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+        c_balance.execute("SELECT balance_cents FROM users WHERE user_id = ?", (user_id,))
         balance_result = c_balance.fetchone()
-        user_balance = Decimal(str(balance_result['balance'])) if balance_result else Decimal('0.0')
+        user_balance = cents_to_eur(balance_result['balance_cents']) if balance_result else Decimal('0.0')
     except sqlite3.Error as e:
         logger.error(f"DB error fetching balance after single item discount: {e}")
         await asyncio.to_thread(_unreserve_basket_items, snapshot)
@@ -2225,7 +2218,7 @@ async def handle_single_item_discount_code_message(update: Update, context: Cont
     if user_balance >= final_total_decimal:
         await send_message_with_retry(context.bot, chat_id, "⏳ Processing payment with balance...", parse_mode=None)
         success = await payment.process_purchase_with_balance(
-            user_id, final_total_decimal, snapshot, discount_code_to_use, context
+            user_id, chat_id, final_total_decimal, snapshot, discount_code_to_use, context
         )
         context.user_data.pop('single_item_pay_snapshot', None)
         context.user_data.pop('single_item_pay_final_eur', None)
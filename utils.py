@@ -6,10 +6,15 @@ import json
 import shutil
 import tempfile
 import asyncio
+import threading
+import queue
+from contextlib import contextmanager
+from types import MappingProxyType
 from datetime import datetime, timedelta, timezone
-from decimal import Decimal, ROUND_DOWN, ROUND_UP
+from decimal import Decimal, ROUND_DOWN, ROUND_UP, ROUND_HALF_UP
 import requests
-from collections import Counter, defaultdict # Moved higher up
+import aiohttp
+from collections import Counter, defaultdict, OrderedDict # Moved higher up
 
 # --- Telegram Imports ---
 from telegram import Update, Bot
@@ -881,6 +886,14 @@ LANGUAGES = {
 # ===== ^ ^ ^ ^ ^      LANGUAGE DICTIONARY     ^ ^ ^ ^ ^ ======
 # ==============================================================
 
+# Read-only per-language views with the English strings already merged in underneath, built once.
+# A handler resolves its language with one lookup instead of LANGUAGES.get(lang, LANGUAGES['en']) each time.
+LANGUAGE_VIEWS = {code: MappingProxyType({**LANGUAGES['en'], **strings}) for code, strings in LANGUAGES.items()}
+
+def get_lang_view(lang: str | None):
+    """Returns the merged language view for lang, or English for unknown/missing codes."""
+    return LANGUAGE_VIEWS.get(lang) or LANGUAGE_VIEWS['en']
+
 # <<< Default Welcome Message (Fallback) >>>
 DEFAULT_WELCOME_MESSAGE = LANGUAGES['en']['welcome']
 
@@ -898,6 +911,7 @@ SIZES = ["2g", "5g"]
 BOT_MEDIA = {'type': None, 'path': None}
 currency_price_cache = {}
 min_amount_cache = {}
+min_amount_cache_lock = threading.Lock() # get_nowpayments_min_amount runs in worker threads
 CACHE_EXPIRY_SECONDS = 900
 
 # --- Database Connection Helper ---
@@ -908,8 +922,11 @@ def get_db_connection():
         if db_dir:
             try: os.makedirs(db_dir, exist_ok=True)
             except OSError as e: logger.warning(f"Could not create DB dir {db_dir}: {e}")
-        conn = sqlite3.connect(DATABASE_PATH, timeout=10)
+        conn = sqlite3.connect(DATABASE_PATH, timeout=10, cached_statements=256)
         conn.execute("PRAGMA foreign_keys = ON;")
+        conn.execute("PRAGMA synchronous = NORMAL;") # Per-connection; in WAL mode this fsyncs on checkpoint, not on every commit
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        conn.execute("PRAGMA cache_size = -64000;")
         conn.row_factory = sqlite3.Row
         return conn
     except sqlite3.Error as e:
@@ -917,6 +934,112 @@ def get_db_connection():
         raise SystemExit(f"Failed to connect to database: {e}")
 
 
+
+# --- Database Connection Pool ---
+DB_POOL_SIZE = 8
+DB_MMAP_SIZE = 256 * 1024 * 1024 # 256 MB
+SQLITE_DEFAULT_WAL_AUTOCHECKPOINT = 1000 # pages
+
+class DBConnectionPool:
+    """
+    Small pool of reusable SQLite connections for hot paths (purchase finalization, balance updates).
+    Connections are shareable across threads and opened in WAL mode so readers don't block the writer.
+    Use as: `with db_pool.acquire() as conn: ...` - an open transaction is rolled back on release.
+    readonly=True opens the connections with mode=ro, for the read pool (db_read_pool).
+    """
+    def __init__(self, size: int = DB_POOL_SIZE, readonly: bool = False):
+        self._size = size
+        self._readonly = readonly
+        self._wal_autocheckpoint = SQLITE_DEFAULT_WAL_AUTOCHECKPOINT
+        self._pool = queue.LifoQueue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Pooled connections live long, so a larger statement cache keeps the hot-path statements compiled
+        if self._readonly:
+            conn = sqlite3.connect(f"file:{DATABASE_PATH}?mode=ro", uri=True, timeout=10, check_same_thread=False, cached_statements=256)
+        else:
+            conn = sqlite3.connect(DATABASE_PATH, timeout=10, check_same_thread=False, cached_statements=256)
+            journal_mode = conn.execute("PRAGMA journal_mode = WAL;").fetchone()[0]
+            if journal_mode.lower() != "wal": # e.g. a filesystem without shared-memory support keeps the rollback journal
+                logger.warning(f"SQLite refused WAL mode for {DATABASE_PATH} (journal_mode={journal_mode}); writes will fsync per commit and block readers.")
+            conn.execute("PRAGMA synchronous = NORMAL;")
+            conn.execute(f"PRAGMA wal_autocheckpoint = {self._wal_autocheckpoint};")
+        conn.execute("PRAGMA foreign_keys = ON;")
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        conn.execute("PRAGMA cache_size = -64000;") # ~64 MB page cache per connection, kept warm across calls
+        conn.execute("PRAGMA busy_timeout = 5000;")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE};") # Page reads served from the mapping instead of read() syscalls
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def set_wal_autocheckpoint(self, pages: int):
+        """Sets wal_autocheckpoint for connections opened from now on and for the idle ones in the pool.
+        Call it before connections are handed out (e.g. at startup); checked-out ones keep their setting."""
+        self._wal_autocheckpoint = pages
+        idle = []
+        while True:
+            try: idle.append(self._pool.get_nowait())
+            except queue.Empty: break
+        for conn in idle:
+            try: conn.execute(f"PRAGMA wal_autocheckpoint = {pages};")
+            except sqlite3.Error as e: logger.warning(f"Could not set wal_autocheckpoint on a pooled connection: {e}")
+            self._pool.put(conn)
+
+    @contextmanager
+    def acquire(self):
+        conn = None
+        try: conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self._size
+                if can_create: self._created += 1
+            if can_create:
+                try: conn = self._connect()
+                except sqlite3.Error:
+                    with self._lock: self._created -= 1
+                    raise
+            else: conn = self._pool.get(timeout=30)
+        healthy = True
+        try:
+            yield conn
+        except sqlite3.ProgrammingError:
+            healthy = False # e.g. connection closed by the caller
+            raise
+        finally:
+            try:
+                if healthy and conn.in_transaction: conn.rollback()
+            except sqlite3.Error: healthy = False
+            if healthy: self._pool.put(conn)
+            else:
+                try: conn.close()
+                except sqlite3.Error: pass
+                with self._lock: self._created -= 1
+
+# Writes go through db_pool and take the write lock up front with BEGIN IMMEDIATE; plain lookups go through
+# db_read_pool, whose read-only connections run in parallel with the writer under WAL.
+# (db_pool stays DB_POOL_SIZE wide rather than a single connection: acquire() blocks, and it is called from the event loop.)
+db_pool = DBConnectionPool()
+db_read_pool = DBConnectionPool(size=os.cpu_count() or 4, readonly=True)
+
+WAL_CHECKPOINT_INTERVAL = 30 # seconds
+
+def disable_wal_autocheckpoint():
+    """Stops db_pool connections checkpointing inside committing transactions. Only call this once the checkpoint_wal
+    job is scheduled, otherwise nothing would checkpoint the WAL and it would grow without bound."""
+    db_pool.set_wal_autocheckpoint(0)
+    logger.info(f"WAL autocheckpoint disabled on the write pool; checkpoint_wal runs every {WAL_CHECKPOINT_INTERVAL}s instead.")
+
+def checkpoint_wal():
+    """Runs a PASSIVE WAL checkpoint (never waits on readers or the writer). Scheduled from main.py."""
+    try:
+        with db_pool.acquire() as conn:
+            busy, wal_pages, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE);").fetchone()
+        logger.debug(f"WAL checkpoint: {checkpointed}/{wal_pages} pages checkpointed (busy={busy}).")
+    except sqlite3.Error as e:
+        logger.error(f"WAL checkpoint failed: {e}", exc_info=True)
+
 # --- Database Initialization ---
 def init_db():
     """Initializes the database schema."""
@@ -925,7 +1048,7 @@ def init_db():
             c = conn.cursor()
             # --- users table ---
             c.execute('''CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY, username TEXT, balance REAL DEFAULT 0.0,
+                user_id INTEGER PRIMARY KEY, username TEXT, balance_cents INTEGER NOT NULL DEFAULT 0,
                 total_purchases INTEGER DEFAULT 0, basket TEXT DEFAULT '',
                 language TEXT DEFAULT 'en', theme TEXT DEFAULT 'default',
                 is_banned INTEGER DEFAULT 0,
@@ -942,6 +1065,26 @@ def init_db():
                  if "duplicate column name: is_reseller" in str(alter_e): pass # Ignore if already exists
                  else: raise # Reraise other errors
             # <<< END ADDED >>>
+            # Migrate balance REAL (EUR) to balance_cents INTEGER. Keyed on the legacy column still holding values, and run
+            # in its own committed transaction, so a failure anywhere else in init_db can't leave the column added but empty.
+            user_cols = {col[1] for col in c.execute("PRAGMA table_info(users)").fetchall()}
+            if 'balance' in user_cols:
+                if conn.in_transaction: conn.commit()
+                c.execute("BEGIN IMMEDIATE")
+                try:
+                    if 'balance_cents' not in user_cols:
+                        c.execute("ALTER TABLE users ADD COLUMN balance_cents INTEGER NOT NULL DEFAULT 0")
+                    migrated = c.execute("UPDATE users SET balance_cents = CAST(ROUND(balance * 100) AS INTEGER) WHERE balance IS NOT NULL").rowcount
+                    try: c.execute("ALTER TABLE users DROP COLUMN balance")
+                    except sqlite3.OperationalError as drop_e:
+                        # Kept, but emptied, so the next start doesn't copy the stale values over balance_cents again
+                        c.execute("UPDATE users SET balance = NULL")
+                        logger.warning(f"Could not drop legacy users.balance column (kept, unused): {drop_e}")
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    raise
+                if migrated: logger.info(f"Migrated users.balance to integer users.balance_cents ({migrated} rows).")
 
             # cities table
             c.execute('''CREATE TABLE IF NOT EXISTS cities (
@@ -1009,6 +1152,19 @@ def init_db():
                 discount_code_used TEXT DEFAULT NULL,
                 FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE
             )''')
+            # payment_intents table (balance purchases: pending -> balance_held -> fulfilled | refunded | failed)
+            c.execute('''CREATE TABLE IF NOT EXISTS payment_intents (
+                id TEXT PRIMARY KEY NOT NULL, user_id INTEGER NOT NULL, amount REAL NOT NULL,
+                state TEXT NOT NULL CHECK(state IN ('pending','balance_held','items_reserved','fulfilled','refunded','failed')),
+                basket_json TEXT, discount_code TEXT,
+                created_at TEXT NOT NULL, updated_at TEXT NOT NULL,
+                FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE
+            )''')
+            # processed_payments table (dedup key for at-least-once NOWPayments webhooks)
+            c.execute('''CREATE TABLE IF NOT EXISTS processed_payments (
+                payment_id TEXT PRIMARY KEY NOT NULL, user_id INTEGER NOT NULL,
+                amount REAL, processed_at TEXT NOT NULL
+            )''')
             # Add columns to pending_deposits if missing
             pending_cols = [col[1] for col in c.execute("PRAGMA table_info(pending_deposits)").fetchall()]
             if 'is_purchase' not in pending_cols: c.execute("ALTER TABLE pending_deposits ADD COLUMN is_purchase INTEGER DEFAULT 0")
@@ -1095,6 +1251,7 @@ def init_db():
             c.execute("CREATE INDEX IF NOT EXISTS idx_admin_log_timestamp ON admin_log(timestamp)")
             c.execute("CREATE INDEX IF NOT EXISTS idx_users_banned ON users(is_banned)")
             c.execute("CREATE INDEX IF NOT EXISTS idx_pending_deposits_is_purchase ON pending_deposits(is_purchase)")
+            c.execute("CREATE INDEX IF NOT EXISTS idx_payment_intents_state ON payment_intents(state, updated_at)")
             c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_welcome_message_name ON welcome_messages(name)")
             # <<< ADDED Indices for reseller >>>
             c.execute("CREATE INDEX IF NOT EXISTS idx_users_is_reseller ON users(is_reseller)")
@@ -1114,18 +1271,20 @@ def init_db():
 
 
 # --- Pending Deposit DB Helpers (Synchronous - Modified) ---
+_PENDING_DEPOSIT_INSERT_SQL = """
+    INSERT INTO pending_deposits (
+        payment_id, user_id, currency, target_eur_amount,
+        expected_crypto_amount, created_at, is_purchase,
+        basket_snapshot_json, discount_code_used
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
 def add_pending_deposit(payment_id: str, user_id: int, currency: str, target_eur_amount: float, expected_crypto_amount: float, is_purchase: bool = False, basket_snapshot: list | None = None, discount_code: str | None = None):
     basket_json = json.dumps(basket_snapshot) if basket_snapshot else None
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
-            c.execute("""
-                INSERT INTO pending_deposits (
-                    payment_id, user_id, currency, target_eur_amount,
-                    expected_crypto_amount, created_at, is_purchase,
-                    basket_snapshot_json, discount_code_used
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
+            c.execute(_PENDING_DEPOSIT_INSERT_SQL, (
                 payment_id, user_id, currency.lower(), target_eur_amount,
                 expected_crypto_amount, datetime.now(timezone.utc).isoformat(),
                 1 if is_purchase else 0, basket_json, discount_code
@@ -1141,6 +1300,37 @@ def add_pending_deposit(payment_id: str, user_id: int, currency: str, target_eur
         logger.error(f"DB error adding pending deposit {payment_id} for user {user_id}: {e}", exc_info=True)
         return False
 
+def add_pending_deposits_batch(deposits: list[dict]) -> list[bool]:
+    """
+    Inserts several pending deposits in a single transaction. Each dict holds add_pending_deposit's keyword arguments.
+    If the batch hits a constraint error it is rolled back and retried row by row, so one duplicate doesn't fail the rest.
+    """
+    if not deposits: return []
+    now_iso = datetime.now(timezone.utc).isoformat()
+    rows = [(
+        d['payment_id'], d['user_id'], d['currency'].lower(), d['target_eur_amount'],
+        d['expected_crypto_amount'], now_iso, 1 if d.get('is_purchase') else 0,
+        json.dumps(d['basket_snapshot']) if d.get('basket_snapshot') else None, d.get('discount_code')
+    ) for d in deposits]
+    conn = None
+    try:
+        conn = get_db_connection()
+        conn.execute("BEGIN")
+        conn.executemany(_PENDING_DEPOSIT_INSERT_SQL, rows)
+        conn.commit()
+        logger.info(f"Added {len(rows)} pending deposit(s) in one batch: {', '.join(str(d['payment_id']) for d in deposits)}")
+        return [True] * len(rows)
+    except sqlite3.IntegrityError:
+        if conn and conn.in_transaction: conn.rollback()
+        logger.warning(f"Constraint error in pending deposit batch of {len(rows)}. Retrying row by row.")
+    except sqlite3.Error as e:
+        if conn and conn.in_transaction: conn.rollback()
+        logger.error(f"DB error adding pending deposit batch of {len(rows)}: {e}", exc_info=True)
+        return [False] * len(rows)
+    finally:
+        if conn: conn.close()
+    return [add_pending_deposit(**d) for d in deposits]
+
 def get_pending_deposit(payment_id: str):
     try:
         with get_db_connection() as conn:
@@ -1175,6 +1365,10 @@ def get_pending_deposit(payment_id: str):
         return None
 
 # --- HELPER TO UNRESERVE ITEMS (Synchronous) ---
+_UNRESERVE_SQL = """WITH qty(id, n) AS (SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?))
+UPDATE products SET reserved = MAX(0, reserved - (SELECT n FROM qty WHERE qty.id = products.id))
+WHERE id IN (SELECT id FROM qty)"""
+
 def _unreserve_basket_items(basket_snapshot: list | None):
     """Helper to decrement reserved counts for items in a snapshot."""
     if not basket_snapshot:
@@ -1184,21 +1378,18 @@ def _unreserve_basket_items(basket_snapshot: list | None):
     if not product_ids_to_release_counts:
         return
 
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("BEGIN")
-        decrement_data = [(count, pid) for pid, count in product_ids_to_release_counts.items()]
-        c.executemany("UPDATE products SET reserved = MAX(0, reserved - ?) WHERE id = ?", decrement_data)
-        conn.commit()
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            # Whole basket in one statement: (product_id, count) pairs go in as a single JSON parameter
+            c.execute(_UNRESERVE_SQL, (json.dumps(list(product_ids_to_release_counts.items())),))
+            conn.commit()
         total_released = sum(product_ids_to_release_counts.values())
         logger.info(f"Un-reserved {total_released} items due to failed/expired/cancelled payment.") # General log message
     except sqlite3.Error as e:
+        # The pool rolls back any open transaction when the connection is released
         logger.error(f"DB error un-reserving items: {e}", exc_info=True)
-        if conn and conn.in_transaction: conn.rollback()
-    finally:
-        if conn: conn.close()
 
 # --- REMOVE PENDING DEPOSIT (Modified Trigger Logic) ---
 def remove_pending_deposit(payment_id: str, trigger: str = "unknown"): # Added trigger for logging
@@ -1260,6 +1451,56 @@ def load_product_types():
         logger.error(f"Failed to load product types and emojis: {e}")
     return product_types_dict
 
+# Menu order of city / district ids (by name) and of (type, emoji) pairs, rebuilt by load_all_data,
+# the only place CITIES/DISTRICTS/PRODUCT_TYPES change. Menus iterate these instead of sorting on every button press.
+_sorted_city_ids: tuple = ()
+_sorted_district_ids: dict[str, tuple] = {}
+_sorted_product_types: tuple = ()
+
+# Flat district name lookup plus worker menu button labels and callback_data strings, rebuilt alongside the sorted ids. Filled in place so
+# `from utils import CITY_DIST_CALLBACK` keeps seeing the current entries after a reload.
+CITY_LABELS: dict[str, str] = {}          # city_id -> "🏙️ <name>"
+CITY_DIST_CALLBACK: dict[str, str] = {}   # city_id -> "worker_dist|<city_id>"
+CITY_BULK_DIST_CALLBACK: dict[str, str] = {}  # city_id -> "worker_bulk_dist|<city_id>"
+DISTRICT_NAMES: dict[tuple, str] = {}     # (city_id, dist_id) -> name, one lookup instead of DISTRICTS.get(city_id, {}).get(dist_id)
+DIST_LABELS: dict[tuple, str] = {}        # (city_id, dist_id) -> "🏘️ <name>"
+DIST_TYPE_CALLBACK: dict[tuple, str] = {} # (city_id, dist_id) -> "worker_type|<city_id>|<dist_id>"
+DIST_BULK_TYPE_CALLBACK: dict[tuple, str] = {}  # (city_id, dist_id) -> "worker_bulk_type|<city_id>|<dist_id>"
+
+def get_sorted_city_ids() -> tuple:
+    return _sorted_city_ids
+
+def get_sorted_district_ids(city_id: str) -> tuple:
+    return _sorted_district_ids.get(city_id, ())
+
+def get_sorted_product_types() -> tuple:
+    return _sorted_product_types
+
+# Bumped on every rebuild, so callers can key their own caches (e.g. prebuilt keyboards) on it
+_menu_generation = 0
+
+def get_menu_generation() -> int:
+    return _menu_generation
+
+def _rebuild_sorted_ids():
+    global _sorted_city_ids, _sorted_district_ids, _sorted_product_types, _menu_generation
+    _menu_generation += 1
+    _sorted_city_ids = tuple(sorted(CITIES, key=CITIES.__getitem__))
+    _sorted_district_ids = {city_id: tuple(sorted(districts, key=districts.__getitem__)) for city_id, districts in DISTRICTS.items()}
+    _sorted_product_types = tuple(sorted(PRODUCT_TYPES.items()))
+    for cache in (CITY_LABELS, CITY_DIST_CALLBACK, CITY_BULK_DIST_CALLBACK, DISTRICT_NAMES, DIST_LABELS, DIST_TYPE_CALLBACK, DIST_BULK_TYPE_CALLBACK): cache.clear()
+    for city_id, city_name in CITIES.items():
+        CITY_LABELS[city_id] = f"🏙️ {city_name}"
+        CITY_DIST_CALLBACK[city_id] = f"worker_dist|{city_id}"
+        CITY_BULK_DIST_CALLBACK[city_id] = f"worker_bulk_dist|{city_id}"
+    for city_id, districts in DISTRICTS.items():
+        for dist_id, dist_name in districts.items():
+            key = (city_id, dist_id)
+            DISTRICT_NAMES[key] = dist_name
+            DIST_LABELS[key] = f"🏘️ {dist_name}"
+            DIST_TYPE_CALLBACK[key] = f"worker_type|{city_id}|{dist_id}"
+            DIST_BULK_TYPE_CALLBACK[key] = f"worker_bulk_type|{city_id}|{dist_id}"
+
 def load_all_data():
     """Loads all dynamic data, modifying global variables IN PLACE."""
     global CITIES, DISTRICTS, PRODUCT_TYPES
@@ -1272,11 +1513,14 @@ def load_all_data():
         CITIES.clear(); CITIES.update(cities_data)
         DISTRICTS.clear(); DISTRICTS.update(districts_data)
         PRODUCT_TYPES.clear(); PRODUCT_TYPES.update(product_types_dict)
+        _rebuild_sorted_ids()
 
         logger.info(f"Loaded (in-place) {len(CITIES)} cities, {sum(len(d) for d in DISTRICTS.values())} districts, {len(PRODUCT_TYPES)} product types.")
+        _load_worker_ids() # Warms the worker set at startup (no-op once loaded), so the first worker press doesn't hit the DB
     except Exception as e:
         logger.error(f"Error during load_all_data (in-place): {e}", exc_info=True)
         CITIES.clear(); DISTRICTS.clear(); PRODUCT_TYPES.clear()
+        _rebuild_sorted_ids()
 
 
 # --- Bot Media Loading (from specified path on disk) ---
@@ -1295,9 +1539,8 @@ else: logger.info(f"{BOT_MEDIA_JSON_PATH} not found. Bot starting without defaul
 def _get_lang_data(context: ContextTypes.DEFAULT_TYPE) -> tuple[str, dict]:
     """Gets the current language code and corresponding language data dictionary."""
     lang = context.user_data.get("lang", "en")
-    # Uses LANGUAGES dict defined above in this file
-    lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
-    if lang not in LANGUAGES:
+    lang_data = get_lang_view(lang)
+    if lang not in LANGUAGE_VIEWS:
         logger.warning(f"_get_lang_data: Language '{lang}' not found in LANGUAGES dict. Falling back to 'en'.")
         lang = 'en' # Ensure lang variable reflects the fallback
     return lang, lang_data
@@ -1306,6 +1549,18 @@ def format_currency(value):
     try: return f"{Decimal(str(value)):.2f}"
     except (ValueError, TypeError): logger.warning(f"Could format currency {value}"); return "0.00"
 
+# Balances are stored as integer cents (users.balance_cents); Decimal only appears at these boundaries
+def to_cents(amount) -> int:
+    """EUR amount (Decimal/float/str) to integer cents, rounded half up."""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+def cents_to_eur(cents) -> Decimal:
+    """Integer cents to an exact EUR Decimal."""
+    return Decimal(int(cents or 0)).scaleb(-2)
+
+def format_cents(cents):
+    return f"{cents_to_eur(cents):.2f}"
+
 def format_discount_value(dtype, value):
     try:
         if dtype == 'percentage': return f"{Decimal(str(value)):.1f}%"
@@ -1382,6 +1637,82 @@ def get_user_status(purchases):
         else: return "New 🌱"
     except (ValueError, TypeError): return "New 🌱"
 
+# --- Streamed Media Downloads ---
+# File.download_to_drive reads the whole file into memory before writing it, so concurrent drop uploads
+# (videos in particular) each held a full copy. Bot API files are streamed to disk in chunks instead.
+MEDIA_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+MEDIA_WRITE_BUFFER_SIZE = 1024 * 1024 # Chunks are collected up to this size and written from a worker thread
+MEDIA_DOWNLOAD_CONNECTIONS = 16
+_download_session: aiohttp.ClientSession | None = None
+
+def _get_download_session() -> aiohttp.ClientSession:
+    """Shared keep-alive session for Bot API file downloads (created on first use, inside the event loop)."""
+    global _download_session
+    if _download_session is None or _download_session.closed:
+        _download_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=MEDIA_DOWNLOAD_CONNECTIONS, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=None, connect=10, sock_read=60))
+    return _download_session
+
+# getFile is a Bot API round trip of its own before every download. Its download link stays valid for at least
+# an hour, so resolved File objects are reused for the same file_id within FILE_INFO_TTL_SECONDS.
+FILE_INFO_TTL_SECONDS = 50 * 60
+FILE_INFO_CACHE_MAX = 1024
+_file_info_cache: OrderedDict = OrderedDict() # file_id -> (expires_at, File); only touched from the event loop
+
+async def get_file_cached(bot, file_id: str):
+    """bot.get_file with a short-lived cache, for media that is downloaded more than once (bulk adds, retries)."""
+    now = time.monotonic()
+    cached = _file_info_cache.get(file_id)
+    if cached and cached[0] > now:
+        _file_info_cache.move_to_end(file_id)
+        return cached[1]
+    file_obj = await bot.get_file(file_id)
+    _file_info_cache[file_id] = (now + FILE_INFO_TTL_SECONDS, file_obj)
+    _file_info_cache.move_to_end(file_id)
+    if len(_file_info_cache) > FILE_INFO_CACHE_MAX: _file_info_cache.popitem(last=False)
+    return file_obj
+
+async def close_download_session():
+    """Closes the media download session. Called from the bot's post_shutdown hook."""
+    global _download_session
+    if _download_session is not None and not _download_session.closed:
+        await _download_session.close()
+    _download_session = None
+
+async def download_file_streamed(file_obj, dest_path: str):
+    """
+    Writes a telegram File to dest_path MEDIA_DOWNLOAD_CHUNK_SIZE bytes at a time, so memory per download stays
+    bounded. The chunks are written in MEDIA_WRITE_BUFFER_SIZE batches from a worker thread, so a slow disk doesn't
+    stall the event loop. One batch is written behind while the next is read, so at most two buffers are held per
+    download. Falls back to download_to_drive for local (non-HTTP) file paths.
+    """
+    file_url = file_obj.file_path or ""
+    if not file_url.startswith(("http://", "https://")):
+        await file_obj.download_to_drive(custom_path=dest_path)
+        return
+    try:
+        async with _get_download_session().get(file_url) as resp:
+            resp.raise_for_status()
+            f = await asyncio.to_thread(open, dest_path, 'wb')
+            write_task = None
+            try:
+                pending = bytearray()
+                async for chunk in resp.content.iter_chunked(MEDIA_DOWNLOAD_CHUNK_SIZE):
+                    pending += chunk
+                    if len(pending) >= MEDIA_WRITE_BUFFER_SIZE:
+                        if write_task: await write_task
+                        write_task = asyncio.ensure_future(asyncio.to_thread(f.write, pending)); pending = bytearray()
+                if write_task: await write_task
+                write_task = None
+                if pending: await asyncio.to_thread(f.write, pending)
+            finally:
+                if write_task: await asyncio.gather(write_task, return_exceptions=True)
+                await asyncio.to_thread(f.close)
+    except aiohttp.ClientError as e:
+        # The URL embeds the bot token, so only the error type and status go to the log / callers
+        raise IOError(f"Download of {file_obj.file_unique_id} failed: {type(e).__name__} {getattr(e, 'status', '')}".strip()) from None
+
 # --- Modified clear_expired_basket (Individual user focus) ---
 def clear_expired_basket(context: ContextTypes.DEFAULT_TYPE, user_id: int):
     if 'basket' not in context.user_data: context.user_data['basket'] = []
@@ -1525,35 +1856,29 @@ def clear_all_expired_baskets():
         # time.sleep(0.01) # Using time.sleep in sync function is fine
 
     # 3. Perform batch updates outside the user loop
-    conn_update = None
+    # The inner `with conn_update:` commits on success and rolls back on any exception
     try:
-        conn_update = get_db_connection()
-        c_update = conn_update.cursor()
-        c_update.execute("BEGIN") # Start transaction for batch updates
-
-        # Update user basket strings
-        if user_basket_updates:
-            c_update.executemany("UPDATE users SET basket = ? WHERE user_id = ?", user_basket_updates)
-            logger.info(f"Scheduled clear: Updated basket strings for {len(user_basket_updates)} users.")
-
-        # Decrement reservations
-        if all_expired_product_counts:
-            decrement_data = [(count, pid) for pid, count in all_expired_product_counts.items()]
-            if decrement_data:
-                c_update.executemany("UPDATE products SET reserved = MAX(0, reserved - ?) WHERE id = ?", decrement_data)
-                total_released = sum(all_expired_product_counts.values())
-                logger.info(f"Scheduled clear: Released {total_released} expired product reservations.")
-
-        conn_update.commit() # Commit all updates together
+        with db_pool.acquire() as conn_update, conn_update:
+            c_update = conn_update.cursor()
+            c_update.execute("BEGIN IMMEDIATE") # Start transaction for batch updates
+
+            # Update user basket strings
+            if user_basket_updates:
+                c_update.executemany("UPDATE users SET basket = ? WHERE user_id = ?", user_basket_updates)
+                logger.info(f"Scheduled clear: Updated basket strings for {len(user_basket_updates)} users.")
+
+            # Decrement reservations
+            if all_expired_product_counts:
+                decrement_data = [(count, pid) for pid, count in all_expired_product_counts.items()]
+                if decrement_data:
+                    c_update.executemany("UPDATE products SET reserved = MAX(0, reserved - ?) WHERE id = ?", decrement_data)
+                    total_released = sum(all_expired_product_counts.values())
+                    logger.info(f"Scheduled clear: Released {total_released} expired product reservations.")
 
     except sqlite3.Error as e:
         logger.error(f"SQLite error during batch updates in clear_all_expired_baskets: {e}", exc_info=True)
-        if conn_update and conn_update.in_transaction: conn_update.rollback()
     except Exception as e:
         logger.error(f"Unexpected error during batch updates in clear_all_expired_baskets: {e}", exc_info=True)
-        if conn_update and conn_update.in_transaction: conn_update.rollback()
-    finally:
-        if conn_update: conn_update.close()
 
     logger.info(f"Scheduled job clear_all_expired_baskets finished. Processed: {processed_user_count}, Users with errors: {failed_user_count}, Total items un-reserved: {sum(all_expired_product_counts.values())}")
 
@@ -1577,20 +1902,23 @@ def fetch_reviews(offset=0, limit=5):
 def get_nowpayments_min_amount(currency_code: str) -> Decimal | None:
     currency_code_lower = currency_code.lower()
     now = time.time()
-    if currency_code_lower in min_amount_cache:
-        min_amount, timestamp = min_amount_cache[currency_code_lower]
+    with min_amount_cache_lock:
+        cached = min_amount_cache.get(currency_code_lower)
+    if cached is not None:
+        min_amount, timestamp = cached
         if now - timestamp < CACHE_EXPIRY_SECONDS * 2: logger.debug(f"Cache hit for {currency_code_lower} min amount: {min_amount}"); return min_amount
     if not NOWPAYMENTS_API_KEY: logger.error("NOWPayments API key is missing, cannot fetch minimum amount."); return None
     try:
         url = f"{NOWPAYMENTS_API_URL}/v1/min-amount"; params = {'currency_from': currency_code_lower}; headers = {'x-api-key': NOWPAYMENTS_API_KEY}
         logger.debug(f"Fetching min amount for {currency_code_lower} from {url} with params {params}")
         response = requests.get(url, params=params, headers=headers, timeout=10)
-        logger.debug(f"NOWPayments min-amount response status: {response.status_code}, content: {response.text[:200]}")
+        if logger.isEnabledFor(logging.DEBUG): logger.debug("NOWPayments min-amount response status: %s, content: %s", response.status_code, response.text[:200])
         response.raise_for_status()
         data = response.json()
         min_amount_key = 'min_amount'
         if min_amount_key in data and data[min_amount_key] is not None:
-            min_amount = Decimal(str(data[min_amount_key])); min_amount_cache[currency_code_lower] = (min_amount, now)
+            min_amount = Decimal(str(data[min_amount_key]))
+            with min_amount_cache_lock: min_amount_cache[currency_code_lower] = (min_amount, now)
             logger.info(f"Fetched minimum amount for {currency_code_lower}: {min_amount} from NOWPayments.")
             return min_amount
         else: logger.warning(f"Could not find '{min_amount_key}' key or it was null for {currency_code_lower} in NOWPayments response: {data}"); return None
@@ -1601,6 +1929,40 @@ def get_nowpayments_min_amount(currency_code: str) -> Decimal | None:
         return None
     except (KeyError, ValueError, json.JSONDecodeError) as e: logger.error(f"Error parsing NOWPayments min amount response for {currency_code_lower}: {e}"); return None
 
+def invalidate_min_amount(currency_code: str | None = None):
+    """Drops the cached NOWPayments minimum for one currency, or the whole cache if no code is given."""
+    with min_amount_cache_lock:
+        if currency_code is None: min_amount_cache.clear()
+        else: min_amount_cache.pop(currency_code.lower(), None)
+
+# --- User Language Cache ---
+# user_id -> (language, fetched_at). Languages rarely change, so webhook-driven notifications
+# read them from here instead of opening a connection per confirmation.
+USER_LANG_CACHE_TTL = 300
+_user_lang_cache: dict[int, tuple[str, float]] = {}
+
+def _fetch_user_lang(user_id: int) -> str:
+    """Reads a user's language from the DB, falling back to 'en'."""
+    try:
+        with db_read_pool.acquire() as conn:
+            res = conn.execute("SELECT language FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if res and res['language'] in LANGUAGES: return res['language']
+    except sqlite3.Error as e:
+        logger.error(f"DB error fetching language for user {user_id}: {e}")
+    return 'en'
+
+async def get_user_lang(user_id: int) -> str:
+    """Returns the user's language from the TTL cache, querying the DB on a miss."""
+    cached = _user_lang_cache.get(user_id)
+    if cached and time.monotonic() - cached[1] < USER_LANG_CACHE_TTL: return cached[0]
+    lang = await asyncio.to_thread(_fetch_user_lang, user_id)
+    _user_lang_cache[user_id] = (lang, time.monotonic())
+    return lang
+
+def set_user_lang_cache(user_id: int, lang: str):
+    """Updates the cached language after a user changes it."""
+    _user_lang_cache[user_id] = (lang, time.monotonic())
+
 def format_expiration_time(expiration_date_str: str | None) -> str:
     if not expiration_date_str: return "N/A"
     try:
@@ -1754,28 +2116,78 @@ ACTION_RESELLER_DISCOUNT_DELETE = "RESELLER_DISCOUNT_DELETE"
 ACTION_PRODUCT_TYPE_REASSIGN = "PRODUCT_TYPE_REASSIGN"
 # <<< END Define >>>
 
-def log_admin_action(admin_id: int, action: str, target_user_id: int | None = None, reason: str | None = None, amount_change: float | None = None, old_value=None, new_value=None):
-    """Logs an administrative action to the admin_log table."""
+# --- Batched Admin Log Writer ---
+# log_admin_action is called from handlers on the event loop and from worker threads (balance credits),
+# so rows go through a thread-safe queue to one writer thread, which inserts them in batches
+# (up to ADMIN_LOG_MAX_BATCH rows or ADMIN_LOG_BATCH_TIMEOUT seconds) with a single executemany.
+ADMIN_LOG_MAX_BATCH = 100
+ADMIN_LOG_BATCH_TIMEOUT = 0.5
+_ADMIN_LOG_INSERT_SQL = "INSERT INTO admin_log (timestamp, admin_id, target_user_id, action, reason, amount_change, old_value, new_value) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+_admin_log_queue: queue.Queue = queue.Queue()
+_admin_log_writer_thread: threading.Thread | None = None
+_ADMIN_LOG_STOP = object() # Sentinel that makes the writer thread flush and exit
+
+def _insert_admin_log_rows(rows: list):
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("""
-                INSERT INTO admin_log (timestamp, admin_id, target_user_id, action, reason, amount_change, old_value, new_value)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                datetime.now(timezone.utc).isoformat(),
-                admin_id,
-                target_user_id,
-                action, # Ensure action string is passed correctly
-                reason,
-                amount_change,
-                str(old_value) if old_value is not None else None,
-                str(new_value) if new_value is not None else None
-            ))
+        with db_pool.acquire() as conn:
+            conn.executemany(_ADMIN_LOG_INSERT_SQL, rows)
             conn.commit()
-            logger.info(f"Admin Action Logged: Admin={admin_id}, Action='{action}', Target={target_user_id}, Reason='{reason}', Amount={amount_change}, Old='{old_value}', New='{new_value}'")
     except sqlite3.Error as e:
-        logger.error(f"Failed to log admin action: {e}", exc_info=True)
+        logger.error(f"Failed to write {len(rows)} admin log row(s): {e}", exc_info=True)
+
+def _admin_log_writer():
+    while True:
+        item = _admin_log_queue.get()
+        if item is _ADMIN_LOG_STOP: return
+        batch = [item]
+        deadline = time.monotonic() + ADMIN_LOG_BATCH_TIMEOUT
+        stop = False
+        while len(batch) < ADMIN_LOG_MAX_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            try: item = _admin_log_queue.get(timeout=remaining)
+            except queue.Empty: break
+            if item is _ADMIN_LOG_STOP: stop = True; break
+            batch.append(item)
+        _insert_admin_log_rows(batch)
+        if stop: return
+
+def start_admin_log_writer():
+    """Starts the background admin log writer thread. Called from the bot's post_init hook."""
+    global _admin_log_writer_thread
+    if _admin_log_writer_thread is None or not _admin_log_writer_thread.is_alive():
+        _admin_log_writer_thread = threading.Thread(target=_admin_log_writer, name="admin_log_writer", daemon=True)
+        _admin_log_writer_thread.start()
+        logger.info("Started admin log writer.")
+
+def stop_admin_log_writer(timeout: float = 5.0):
+    """Flushes queued admin log rows and stops the writer. Called from the bot's post_shutdown hook."""
+    global _admin_log_writer_thread
+    thread, _admin_log_writer_thread = _admin_log_writer_thread, None
+    if thread is None: return
+    _admin_log_queue.put(_ADMIN_LOG_STOP)
+    thread.join(timeout)
+    logger.info("Stopped admin log writer.")
+
+def log_admin_action(admin_id: int, action: str, target_user_id: int | None = None, reason: str | None = None, amount_change: float | None = None, old_value=None, new_value=None):
+    """Logs an administrative action to the admin_log table.
+    Queued for the batched writer when it is running; written directly otherwise."""
+    row = (
+        datetime.now(timezone.utc).isoformat(),
+        admin_id,
+        target_user_id,
+        action, # Ensure action string is passed correctly
+        reason,
+        amount_change,
+        str(old_value) if old_value is not None else None,
+        str(new_value) if new_value is not None else None
+    )
+    try:
+        if _admin_log_writer_thread is not None and _admin_log_writer_thread.is_alive():
+            _admin_log_queue.put_nowait(row)
+        else:
+            _insert_admin_log_rows([row])
+        logger.info(f"Admin Action Logged: Admin={admin_id}, Action='{action}', Target={target_user_id}, Reason='{reason}', Amount={amount_change}, Old='{old_value}', New='{new_value}'")
     except Exception as e:
         logger.error(f"Unexpected error logging admin action: {e}", exc_info=True)
 
@@ -2083,7 +2495,7 @@ def clean_expired_pending_payments():
 def get_workers():
     """Get all workers with their details."""
     try:
-        with get_db_connection() as conn:
+        with db_read_pool.acquire() as conn:
             c = conn.cursor()
             c.execute("""
                 SELECT w.user_id, w.username, w.added_by, w.added_date,
@@ -2100,15 +2512,14 @@ def get_workers():
 def add_worker(user_id: int, username: str | None, added_by: int) -> bool:
     """Add a new worker."""
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("""
+        with db_pool.acquire() as conn, conn:
+            conn.execute("""
                 INSERT INTO workers (user_id, username, added_by, added_date)
                 VALUES (?, ?, ?, ?)
             """, (user_id, username, added_by, datetime.now(timezone.utc).isoformat()))
-            conn.commit()
-            logger.info(f"Added worker {user_id} (@{username}) by admin {added_by}")
-            return True
+        if _worker_ids is not None: _worker_ids.add(user_id) # Only after the commit
+        logger.info(f"Added worker {user_id} (@{username}) by admin {added_by}")
+        return True
     except sqlite3.IntegrityError:
         logger.warning(f"Worker {user_id} already exists")
         return False
@@ -2119,27 +2530,37 @@ def add_worker(user_id: int, username: str | None, added_by: int) -> bool:
 def remove_worker(user_id: int) -> bool:
     """Remove a worker."""
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            result = c.execute("DELETE FROM workers WHERE user_id = ?", (user_id,))
-            conn.commit()
-            if result.rowcount > 0:
-                logger.info(f"Removed worker {user_id}")
-                return True
-            else:
-                logger.warning(f"Worker {user_id} not found for removal")
-                return False
+        with db_pool.acquire() as conn, conn:
+            removed = conn.execute("DELETE FROM workers WHERE user_id = ?", (user_id,)).rowcount
+        if _worker_ids is not None: _worker_ids.discard(user_id)
+        if removed > 0:
+            logger.info(f"Removed worker {user_id}")
+            return True
+        else:
+            logger.warning(f"Worker {user_id} not found for removal")
+            return False
     except sqlite3.Error as e:
         logger.error(f"Database error removing worker {user_id}: {e}", exc_info=True)
         return False
 
+# Worker ids kept in memory: loaded from the workers table on first use, then kept in step by
+# add_worker / remove_worker (the only writers), so is_worker is a set lookup instead of a query per callback.
+_worker_ids: set[int] | None = None
+_worker_ids_lock = threading.Lock()
+
+def _load_worker_ids() -> set[int]:
+    global _worker_ids
+    with _worker_ids_lock:
+        if _worker_ids is None:
+            try:
+                with db_read_pool.acquire() as conn:
+                    _worker_ids = {row['user_id'] for row in conn.execute("SELECT user_id FROM workers").fetchall()}
+            except sqlite3.Error as e:
+                logger.error(f"Database error loading worker ids: {e}", exc_info=True)
+                return set() # Not cached, retried on the next check
+        return _worker_ids
+
 def is_worker(user_id: int) -> bool:
     """Check if a user is a worker."""
-    try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("SELECT 1 FROM workers WHERE user_id = ?", (user_id,))
-            return c.fetchone() is not None
-    except sqlite3.Error as e:
-        logger.error(f"Database error checking worker status for {user_id}: {e}", exc_info=True)
-        return False
+    worker_ids = _worker_ids if _worker_ids is not None else _load_worker_ids()
+    return user_id in worker_ids
@@ -23,7 +23,7 @@ import telegram.error as telegram_error
 
 # Import shared elements from utils
 from utils import (
-    ADMIN_ID, LANGUAGES, format_currency, send_message_with_retry,
+    ADMIN_ID, LANGUAGES, format_currency, format_cents, to_cents, cents_to_eur, send_message_with_retry,
     SECONDARY_ADMIN_IDS, fetch_reviews,
     get_db_connection, MEDIA_DIR, # Import helper and MEDIA_DIR
     get_user_status, get_progress_bar, # Import user status helpers
@@ -419,7 +419,7 @@ async def _display_user_list(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
         # Fetch users, excluding the primary admin themselves
         c.execute("""
-            SELECT user_id, username, balance, total_purchases, is_banned
+            SELECT user_id, username, balance_cents, total_purchases, is_banned
             FROM users
             WHERE user_id != ?
             ORDER BY user_id DESC LIMIT ? OFFSET ?
@@ -447,7 +447,7 @@ async def _display_user_list(update: Update, context: ContextTypes.DEFAULT_TYPE,
         for user in users:
             user_id_target = user['user_id']
             username = user['username'] or f"ID_{user_id_target}"
-            balance_str = format_currency(user['balance'])
+            balance_str = format_cents(user['balance_cents'])
             status = get_user_status(user['total_purchases'])
             banned_status = "🚫" if user['is_banned'] else "✅"
             item_msg = f"\n👤 @{username} (ID: {user_id_target})\n  💰 {balance_str}€ | {status} | {banned_status}"
@@ -494,7 +494,7 @@ async def handle_view_user_profile(update: Update, context: ContextTypes.DEFAULT
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute("SELECT user_id, username, balance, total_purchases, is_banned FROM users WHERE user_id = ?", (target_user_id,))
+        c.execute("SELECT user_id, username, balance_cents, total_purchases, is_banned FROM users WHERE user_id = ?", (target_user_id,))
         user_data = c.fetchone()
 
         if not user_data:
@@ -503,7 +503,7 @@ async def handle_view_user_profile(update: Update, context: ContextTypes.DEFAULT
             return
 
         username = user_data['username'] or f"ID_{target_user_id}"
-        balance = Decimal(str(user_data['balance']))
+        balance = cents_to_eur(user_data['balance_cents'])
         purchases_count = user_data['total_purchases'] # Keep the count variable name
         is_banned = user_data['is_banned'] == 1
 
@@ -696,17 +696,14 @@ async def handle_adjust_balance_reason_message(update: Update, context: ContextT
         conn = get_db_connection()
         c = conn.cursor()
         c.execute("BEGIN")
-        # Get old balance before update for logging
-        c.execute("SELECT balance FROM users WHERE user_id=?", (target_user_id,))
-        old_balance_res = c.fetchone(); old_balance_float = old_balance_res['balance'] if old_balance_res else 0.0
-        # Update balance
-        update_res = c.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount_float, target_user_id))
-        if update_res.rowcount == 0:
+        # Update balance (integer cents) and read back the new one; the old one for logging follows exactly
+        amount_cents = to_cents(amount_float)
+        update_row = c.execute("UPDATE users SET balance_cents = balance_cents + ? WHERE user_id = ? RETURNING balance_cents AS new_balance_cents", (amount_cents, target_user_id)).fetchone()
+        if not update_row:
              logger.error(f"Failed to adjust balance for user {target_user_id} (not found?).")
              conn.rollback(); raise sqlite3.Error("User not found during balance update.")
-        # Fetch new balance
-        c.execute("SELECT balance FROM users WHERE user_id = ?", (target_user_id,))
-        new_balance_res = c.fetchone(); new_balance_float = new_balance_res['balance'] if new_balance_res else old_balance_float + amount_float
+        new_balance_cents = update_row['new_balance_cents']; new_balance_float = new_balance_cents / 100
+        old_balance_float = (new_balance_cents - amount_cents) / 100
         conn.commit()
 
         # Log the action using the synchronous helper
@@ -724,7 +721,7 @@ async def handle_adjust_balance_reason_message(update: Update, context: ContextT
         context.user_data.pop('state', None); context.user_data.pop('adjust_balance_target_user_id', None); context.user_data.pop('adjust_balance_amount', None)
         context.user_data.pop('adjust_balance_offset', None); context.user_data.pop('adjust_balance_username', None)
 
-        success_msg = success_template.format(username=username, new_balance=format_currency(new_balance_float))
+        success_msg = success_template.format(username=username, new_balance=format_cents(new_balance_cents))
         keyboard = [[InlineKeyboardButton("⬅️ Back to User Profile", callback_data=back_callback)]]
         await send_message_with_retry(context.bot, chat_id, success_msg, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
 
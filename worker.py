@@ -5,7 +5,8 @@ import time
 import shutil
 import asyncio
 import sqlite3
-import re
+from collections import OrderedDict
+from functools import lru_cache, wraps
 from datetime import datetime, timezone
 from decimal import Decimal
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -14,9 +15,101 @@ import telegram.error as telegram_error
 
 from utils import (
     get_db_connection, format_currency, send_message_with_retry,
-    is_worker, CITIES, DISTRICTS, PRODUCT_TYPES, DEFAULT_PRODUCT_EMOJI,
-    SIZES, MEDIA_DIR, logger, _get_lang_data
+    is_worker, CITIES, PRODUCT_TYPES, DEFAULT_PRODUCT_EMOJI,
+    SIZES, MEDIA_DIR, logger, _get_lang_data, get_sorted_city_ids, get_sorted_district_ids, get_sorted_product_types,
+    get_menu_generation, DISTRICT_NAMES, CITY_LABELS, CITY_DIST_CALLBACK, CITY_BULK_DIST_CALLBACK, DIST_LABELS, DIST_TYPE_CALLBACK, DIST_BULK_TYPE_CALLBACK
 )
+# admin doesn't import worker, so its handlers can be imported once here rather than inside every call
+from admin import (
+    handle_adm_bulk_execute, handle_adm_bulk_remove_last_message, show_bulk_messages_status,
+    cancel_bulk_add, remove_job_if_exists, _DROP_PENDING_KEYS, _DROP_LOCATION_KEYS, _DROP_MEDIA_GROUP_KEYS
+)
+
+# --- Access Control ---
+# update_ids of recently handled worker callbacks; Telegram re-sends an update whose webhook call stalled,
+# and handling it twice would repeat the DB work and the message edit. Only touched from the event loop.
+_SEEN_UPDATES: OrderedDict = OrderedDict()
+_SEEN_UPDATES_MAX = 2048
+
+def worker_only(min_params: int = 0, missing_msg: str = "Error: Missing data."):
+    """
+    Decorator for worker callback handlers: skips re-delivered updates, answers 'Access denied.' unless the
+    presser is a worker (is_worker is a set lookup) and rejects callbacks carrying fewer than min_params
+    non-empty params.
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
+            update_id = update.update_id
+            if update_id in _SEEN_UPDATES:
+                logger.debug(f"Skipping re-delivered worker update {update_id}")
+                return
+            _SEEN_UPDATES[update_id] = None
+            if len(_SEEN_UPDATES) > _SEEN_UPDATES_MAX: _SEEN_UPDATES.popitem(last=False)
+            query = update.callback_query
+            user = update.effective_user
+            if not user or not is_worker(user.id):
+                if query: await query.answer("Access denied.", show_alert=True)
+                return
+            if min_params and (not params or len(params) < min_params or not all(params[:min_params])):
+                return await query.answer(missing_msg, show_alert=True)
+            return await func(update, context, params)
+        return wrapper
+    return decorator
+
+# --- Message Edits ---
+async def safe_edit(query, text: str, reply_markup=None):
+    """
+    edit_message_text for worker menus. Skips the API call when the message already shows this text and
+    keyboard (re-delivered updates, repeated presses) and ignores Telegram's 'message is not modified'.
+    """
+    message = query.message
+    if message and message.text == text and message.reply_markup == reply_markup: return
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=None)
+    except telegram_error.BadRequest as e:
+        if "message is not modified" not in str(e).lower(): raise
+
+# --- Debounced Menu Edits ---
+# Clicking through city -> district -> type -> size fires an edit per press on the same chat, and Telegram
+# rate-limits edits per chat. Menu renders are delayed briefly, and a newer render for the chat replaces
+# a pending one, so only the latest menu state is sent.
+MENU_EDIT_DEBOUNCE = 0.15 # Seconds
+_pending_edits: dict[int, asyncio.Task] = {}
+
+async def _debounced_edit(query, text: str, reply_markup):
+    await asyncio.sleep(MENU_EDIT_DEBOUNCE)
+    try:
+        await safe_edit(query, text, reply_markup)
+    except Exception as e:
+        logger.error(f"Error editing worker menu: {e}")
+
+def schedule_menu_edit(query, text: str, reply_markup=None):
+    """Renders a worker menu into the query's message after MENU_EDIT_DEBOUNCE, dropping any still-pending render for the chat."""
+    chat_id = query.message.chat_id
+    pending = _pending_edits.get(chat_id)
+    if pending and not pending.done(): pending.cancel()
+    task = asyncio.create_task(_debounced_edit(query, text, reply_markup))
+    _pending_edits[chat_id] = task
+    task.add_done_callback(lambda t, chat_id=chat_id: _pending_edits.pop(chat_id, None) if _pending_edits.get(chat_id) is t else None)
+
+# --- Prebuilt Keyboards ---
+# PTB keyboard objects are immutable, so static / rarely varying markups are built once and reused
+WORKER_PANEL_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("👷 Worker Panel", callback_data="worker_panel")]])
+WORKER_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📦 Add Single Drop", callback_data="worker_city")],
+    [InlineKeyboardButton("📦📦 Bulk Add Drops", callback_data="worker_bulk_city")],
+    [InlineKeyboardButton("❌ Close", callback_data="close_menu")]
+])
+
+@lru_cache(maxsize=4096)
+def _size_markup(city_id: str, dist_id: str, bulk: bool) -> InlineKeyboardMarkup:
+    """Size picker for the single (bulk=False) or bulk add flow; SIZES is a constant, so only the back target varies."""
+    prefix = "worker_bulk" if bulk else "worker"
+    keyboard = [[InlineKeyboardButton(f"📏 {s}", callback_data=f"{prefix}_size|{s}")] for s in SIZES]
+    keyboard.append([InlineKeyboardButton("📏 Custom Size", callback_data=f"{prefix}_custom_size")])
+    keyboard.append([InlineKeyboardButton("⬅️ Back to Types", callback_data=f"{prefix}_type|{city_id}|{dist_id}")])
+    return InlineKeyboardMarkup(keyboard)
 
 # Worker Panel Functions
 
@@ -33,355 +126,249 @@ async def handle_worker_panel(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     msg = f"👷 Worker Panel\n\nWelcome, @{user.username or 'Worker'}!\n\nYou can add drops to existing product types:"
     
-    keyboard = [
-        [InlineKeyboardButton("📦 Add Single Drop", callback_data="worker_city")],
-        [InlineKeyboardButton("📦📦 Bulk Add Drops", callback_data="worker_bulk_city")],
-        [InlineKeyboardButton("❌ Close", callback_data="close_menu")]
-    ]
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = WORKER_MENU_MARKUP
     
     if query:
         try:
-            await query.edit_message_text(msg, reply_markup=reply_markup, parse_mode=None)
+            await safe_edit(query, msg, reply_markup)
         except telegram_error.BadRequest:
             await send_message_with_retry(context.bot, update.effective_chat.id, msg, reply_markup=reply_markup, parse_mode=None)
     else:
         await send_message_with_retry(context.bot, update.effective_chat.id, msg, reply_markup=reply_markup, parse_mode=None)
 
-# Worker functions that reuse admin logic
-async def handle_worker_city(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
-    """Worker city selection - reuses admin logic."""
-    query = update.callback_query
-    if not is_worker(query.from_user.id): 
-        return await query.answer("Access denied.", show_alert=True)
-    
-    # Set worker context and call admin function directly
-    context.user_data["is_worker"] = True
-    context.user_data["worker_id"] = query.from_user.id
-    
-    # Call admin function with worker context
+# --- Worker Add Flows (Single / Bulk) ---
+# The single and bulk add flows walk the same city -> district -> type -> size menus and differ only in
+# callback prefixes, the user_data keys they fill and a few labels. One set of handlers serves both.
+_FLOWS = {
+    False: {
+        "prefix": "worker", "ctx": "admin_",
+        "cancel_markup": InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel Add", callback_data="worker_cancel_add")]]),
+        "city_callbacks": CITY_DIST_CALLBACK, "dist_callbacks": DIST_TYPE_CALLBACK,
+        "city_default": "Select City to Add Product:", "city_header": "",
+        "type_header": "", "size_header": "📦 Adding", "size_title": "", "lost_what": "the product",
+        "price_state": "awaiting_price", "custom_size_state": "awaiting_custom_size", "pending_size_key": "pending_drop_size",
+    },
+    True: {
+        "prefix": "worker_bulk", "ctx": "bulk_admin_",
+        "cancel_markup": InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel Bulk Add", callback_data="worker_cancel_bulk_add")]]),
+        "city_callbacks": CITY_BULK_DIST_CALLBACK, "dist_callbacks": DIST_BULK_TYPE_CALLBACK,
+        "city_default": "Select City to Add Bulk Products:", "city_header": "📦 Bulk Add Products\n\n",
+        "type_header": "📦 Bulk Add Products - {city} / {district}\n\n", "size_header": "📦 Bulk Adding",
+        "size_title": "📦 Bulk Products - ", "lost_what": "the bulk products",
+        "price_state": "awaiting_bulk_price", "custom_size_state": "awaiting_bulk_custom_size", "pending_size_key": "bulk_pending_drop_size",
+    },
+}
+
+# Menus show at most MENU_PAGE_SIZE entries per edit; the page index rides as the last callback param
+# (e.g. worker_dist|<city_id>|<page>), a missing param meaning the first page
+MENU_PAGE_SIZE = 10
+
+def _page_param(params, index: int) -> int:
+    try: return max(0, int(params[index]))
+    except (IndexError, TypeError, ValueError): return 0
+
+def _paged_rows(rows: list, page: int, nav_callback: str) -> list:
+    """Cuts rows down to one page and appends Prev/Next buttons. page is clamped to the last page."""
+    if len(rows) <= MENU_PAGE_SIZE: return rows
+    last_page = (len(rows) - 1) // MENU_PAGE_SIZE
+    page = min(page, last_page)
+    keyboard = rows[page * MENU_PAGE_SIZE:(page + 1) * MENU_PAGE_SIZE]
+    nav_buttons = []
+    if page > 0: nav_buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"{nav_callback}|{page - 1}"))
+    if page < last_page: nav_buttons.append(InlineKeyboardButton("➡️ Next", callback_data=f"{nav_callback}|{page + 1}"))
+    keyboard.append(nav_buttons)
+    return keyboard
+
+# Menu keyboards depend only on CITIES / DISTRICTS / PRODUCT_TYPES, so each page is built once per data
+# generation (bumped by load_all_data) and the immutable markup reused on every render
+@lru_cache(maxsize=64)
+def _city_markup(generation: int, bulk: bool, page: int = 0) -> InlineKeyboardMarkup:
+    flow = _FLOWS[bulk]
+    city_callbacks = flow["city_callbacks"]
+    rows = [[InlineKeyboardButton(CITY_LABELS[c], callback_data=city_callbacks[c])] for c in get_sorted_city_ids()]
+    keyboard = _paged_rows(rows, page, f"{flow['prefix']}_city")
+    keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data="worker_panel")])
+    return InlineKeyboardMarkup(keyboard)
+
+@lru_cache(maxsize=1024)
+def _district_markup(generation: int, city_id: str, bulk: bool, page: int = 0) -> InlineKeyboardMarkup:
+    flow = _FLOWS[bulk]
+    dist_callbacks = flow["dist_callbacks"]
+    rows = [[InlineKeyboardButton(DIST_LABELS[key], callback_data=dist_callbacks[key])] for key in ((city_id, d) for d in get_sorted_district_ids(city_id))]
+    keyboard = _paged_rows(rows, page, f"{flow['prefix']}_dist|{city_id}")
+    keyboard.append([InlineKeyboardButton("⬅️ Back to Cities", callback_data=f"{flow['prefix']}_city")])
+    return InlineKeyboardMarkup(keyboard)
+
+@lru_cache(maxsize=4096)
+def _type_markup(generation: int, city_id: str, dist_id: str, bulk: bool, page: int = 0) -> InlineKeyboardMarkup:
+    flow = _FLOWS[bulk]
+    prefix = flow["prefix"]
+    rows = [[InlineKeyboardButton(f"{emoji} {type_name}", callback_data=f"{prefix}_add|{city_id}|{dist_id}|{type_name}")]
+            for type_name, emoji in get_sorted_product_types()]
+    keyboard = _paged_rows(rows, page, f"{prefix}_type|{city_id}|{dist_id}")
+    keyboard.append([InlineKeyboardButton("⬅️ Back to Districts", callback_data=flow["city_callbacks"].get(city_id, f"{prefix}_dist|{city_id}"))])
+    return InlineKeyboardMarkup(keyboard)
+
+async def _show_city_menu(query, context: ContextTypes.DEFAULT_TYPE, bulk: bool, page: int = 0):
+    flow = _FLOWS[bulk]
     lang, lang_data = _get_lang_data(context)
     if not CITIES:
-        return await query.edit_message_text("No cities configured. Please contact an admin.", parse_mode=None)
+        return await safe_edit(query, "No cities configured. Please contact an admin.")
     
-    sorted_city_ids = sorted(CITIES.keys(), key=lambda city_id: CITIES.get(city_id, ''))
-    keyboard = [[InlineKeyboardButton(f"🏙️ {CITIES.get(c,'N/A')}", callback_data=f"worker_dist|{c}")] for c in sorted_city_ids]
-    keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data="worker_panel")])
-    
-    select_city_text = lang_data.get("admin_select_city", "Select City to Add Product:")
-    await query.edit_message_text(select_city_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+    select_city_text = lang_data.get("admin_select_city", flow["city_default"])
+    schedule_menu_edit(query, f"{flow['city_header']}{select_city_text}", _city_markup(get_menu_generation(), bulk, page))
 
-async def handle_worker_dist(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
-    """Worker district selection."""
-    query = update.callback_query
-    if not is_worker(query.from_user.id): 
-        return await query.answer("Access denied.", show_alert=True)
-    
-    if not params: 
-        return await query.answer("Error: City ID missing.", show_alert=True)
-    
-    city_id = params[0]
+async def _show_district_menu(query, context: ContextTypes.DEFAULT_TYPE, city_id: str, bulk: bool, page: int = 0):
+    flow = _FLOWS[bulk]
     city_name = CITIES.get(city_id)
     if not city_name:
-        return await query.edit_message_text("Error: City not found. Please select again.", parse_mode=None)
+        return await safe_edit(query, "Error: City not found. Please select again.")
     
-    districts_in_city = DISTRICTS.get(city_id, {})
     lang, lang_data = _get_lang_data(context)
     select_district_template = lang_data.get("admin_select_district", "Select District in {city}:")
+    markup = _district_markup(get_menu_generation(), city_id, bulk, page)
     
-    if not districts_in_city:
-        keyboard = [[InlineKeyboardButton("⬅️ Back to Cities", callback_data="worker_city")]]
-        return await query.edit_message_text(f"No districts found for {city_name}. Please contact an admin.",
-                                reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-    
-    sorted_district_ids = sorted(districts_in_city.keys(), key=lambda dist_id: districts_in_city.get(dist_id,''))
-    keyboard = []
-    for d in sorted_district_ids:
-        dist_name = districts_in_city.get(d)
-        if dist_name:
-            keyboard.append([InlineKeyboardButton(f"🏘️ {dist_name}", callback_data=f"worker_type|{city_id}|{d}")])
-        else: 
-            logger.warning(f"District name missing for ID {d} in city {city_id}")
+    if not get_sorted_district_ids(city_id):
+        # markup then holds only the back button
+        return await safe_edit(query, f"No districts found for {city_name}. Please contact an admin.", markup)
     
-    keyboard.append([InlineKeyboardButton("⬅️ Back to Cities", callback_data="worker_city")])
-    select_district_text = select_district_template.format(city=city_name)
-    await query.edit_message_text(select_district_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-
-async def handle_close_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
-    """Close menu."""
-    query = update.callback_query
-    if query:
-        try:
-            await query.delete_message()
-        except:
-            await query.answer("Menu closed.")
+    schedule_menu_edit(query, select_district_template.format(city=city_name), markup)
 
-# --- Worker Single Drop Functions (Reuse Admin Flow) ---
-async def handle_worker_type(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
-    """Worker selects product type."""
-    query = update.callback_query
-    if not is_worker(query.from_user.id): 
-        return await query.answer("Access denied.", show_alert=True)
-    
-    if not params or len(params) < 2: 
-        return await query.answer("Error: City or District ID missing.", show_alert=True)
-    
-    city_id, dist_id = params[0], params[1]
+async def _show_type_menu(query, context: ContextTypes.DEFAULT_TYPE, city_id: str, dist_id: str, bulk: bool, page: int = 0):
+    flow = _FLOWS[bulk]
     city_name = CITIES.get(city_id)
-    district_name = DISTRICTS.get(city_id, {}).get(dist_id)
+    district_name = DISTRICT_NAMES.get((city_id, dist_id))
     
     if not city_name or not district_name:
-        return await query.edit_message_text("Error: City/District not found. Please select again.", parse_mode=None)
+        return await safe_edit(query, "Error: City/District not found. Please select again.")
     
     lang, lang_data = _get_lang_data(context)
     select_type_text = lang_data.get("admin_select_type", "Select Product Type:")
     
     if not PRODUCT_TYPES:
-        return await query.edit_message_text("No product types configured. Contact admin to add types.", parse_mode=None)
+        return await safe_edit(query, "No product types configured. Contact admin to add types.")
 
-    keyboard = []
-    for type_name, emoji in sorted(PRODUCT_TYPES.items()):
-        keyboard.append([InlineKeyboardButton(f"{emoji} {type_name}", callback_data=f"worker_add|{city_id}|{dist_id}|{type_name}")])
+    header = flow["type_header"].format(city=city_name, district=district_name)
+    schedule_menu_edit(query, f"{header}{select_type_text}", _type_markup(get_menu_generation(), city_id, dist_id, bulk, page))
 
-    keyboard.append([InlineKeyboardButton("⬅️ Back to Districts", callback_data=f"worker_dist|{city_id}")])
-    await query.edit_message_text(select_type_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-
-async def handle_worker_add(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
-    """Worker selects size for the new product."""
-    query = update.callback_query
-    if not is_worker(query.from_user.id): 
-        return await query.answer("Access denied.", show_alert=True)
-    
-    if not params or len(params) < 3: 
-        return await query.answer("Error: Location/Type info missing.", show_alert=True)
-    
-    city_id, dist_id, p_type = params
+async def _show_size_menu(query, context: ContextTypes.DEFAULT_TYPE, city_id: str, dist_id: str, p_type: str, bulk: bool):
+    flow = _FLOWS[bulk]
     city_name = CITIES.get(city_id)
-    district_name = DISTRICTS.get(city_id, {}).get(dist_id)
+    district_name = DISTRICT_NAMES.get((city_id, dist_id))
     
     if not city_name or not district_name:
-        return await query.edit_message_text("Error: City/District not found. Please select again.", parse_mode=None)
+        return await safe_edit(query, "Error: City/District not found. Please select again.")
     
     type_emoji = PRODUCT_TYPES.get(p_type, DEFAULT_PRODUCT_EMOJI)
     
-    # Store context as admin functions do, but with worker prefix for separation
-    context.user_data["admin_city_id"] = city_id
-    context.user_data["admin_district_id"] = dist_id
-    context.user_data["admin_product_type"] = p_type
-    context.user_data["admin_city"] = city_name
-    context.user_data["admin_district"] = district_name
+    # Store context under the same keys the admin flows use, so the admin price/media handlers pick it up
+    ctx = flow["ctx"]
+    context.user_data[f"{ctx}city_id"] = city_id
+    context.user_data[f"{ctx}district_id"] = dist_id
+    context.user_data[f"{ctx}product_type"] = p_type
+    context.user_data[f"{ctx}city"] = city_name
+    context.user_data[f"{ctx}district"] = district_name
     context.user_data["is_worker"] = True  # Flag to distinguish worker operations
     
-    keyboard = [[InlineKeyboardButton(f"📏 {s}", callback_data=f"worker_size|{s}")] for s in SIZES]
-    keyboard.append([InlineKeyboardButton("📏 Custom Size", callback_data="worker_custom_size")])
-    keyboard.append([InlineKeyboardButton("⬅️ Back to Types", callback_data=f"worker_type|{city_id}|{dist_id}")])
-    
-    await query.edit_message_text(f"📦 Adding {type_emoji} {p_type} in {city_name} / {district_name}\n\nSelect size:", 
-                                reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+    schedule_menu_edit(query, f"{flow['size_header']} {type_emoji} {p_type} in {city_name} / {district_name}\n\nSelect size:", 
+                       _size_markup(city_id, dist_id, bulk))
 
-async def handle_worker_size(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
-    """Handles selection of a predefined size."""
-    query = update.callback_query
-    if not is_worker(query.from_user.id): 
-        return await query.answer("Access denied.", show_alert=True)
-    
-    if not params: 
-        return await query.answer("Error: Size missing.", show_alert=True)
-    
-    size = params[0]
-    if not all(k in context.user_data for k in ["admin_city", "admin_district", "admin_product_type"]):
-        return await query.edit_message_text("❌ Error: Context lost. Please start adding the product again.", parse_mode=None)
-    
-    context.user_data["pending_drop_size"] = size
-    context.user_data["state"] = "awaiting_price"
-    
-    keyboard = [[InlineKeyboardButton("❌ Cancel Add", callback_data="worker_cancel_add")]]
-    await query.edit_message_text(f"Size set to {size}. Please reply with the price (e.g., 12.50 or 12.5):",
-                            reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-    await query.answer("Enter price in chat.")
+async def _prompt_size_or_price(query, context: ContextTypes.DEFAULT_TYPE, size: str | None, bulk: bool):
+    """size=None prompts for a custom size, otherwise stores the size and prompts for the price."""
+    flow = _FLOWS[bulk]
+    ctx = flow["ctx"]
+    if not all(f"{ctx}{k}" in context.user_data for k in ("city", "district", "product_type")):
+        return await safe_edit(query, f"❌ Error: Context lost. Please start adding {flow['lost_what']} again.")
+    
+    if size is None:
+        context.user_data["state"] = flow["custom_size_state"]
+        prompt, answer = f"{flow['size_title']}Please reply with the custom size (e.g., 10g, 1/4 oz):", "Enter custom size in chat."
+    else:
+        context.user_data[flow["pending_size_key"]] = size
+        context.user_data["state"] = flow["price_state"]
+        prompt, answer = f"{flow['size_title']}Size set to {size}. Please reply with the price (e.g., 12.50 or 12.5):", "Enter price in chat."
+    await safe_edit(query, prompt, flow["cancel_markup"])
+    await query.answer(answer)
 
-async def handle_worker_custom_size(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
-    """Handles 'Custom Size' button press."""
+@worker_only()
+async def handle_worker_city(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
+    """Worker city selection for a single drop."""
     query = update.callback_query
-    if not is_worker(query.from_user.id): 
-        return await query.answer("Access denied.", show_alert=True)
-    
-    if not all(k in context.user_data for k in ["admin_city", "admin_district", "admin_product_type"]):
-        return await query.edit_message_text("❌ Error: Context lost. Please start adding the product again.", parse_mode=None)
-    
-    context.user_data["state"] = "awaiting_custom_size"
-    keyboard = [[InlineKeyboardButton("❌ Cancel Add", callback_data="worker_cancel_add")]]
-    await query.edit_message_text("Please reply with the custom size (e.g., 10g, 1/4 oz):",
-                            reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-    await query.answer("Enter custom size in chat.")
+    context.user_data["is_worker"] = True
+    context.user_data["worker_id"] = query.from_user.id
+    await _show_city_menu(query, context, bulk=False, page=_page_param(params, 0))
 
-# --- Worker Bulk Add Functions (Reuse Admin Flow) ---
+@worker_only()
 async def handle_worker_bulk_city(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Worker selects city to add bulk products to."""
-    query = update.callback_query
-    if not is_worker(query.from_user.id): 
-        return await query.answer("Access denied.", show_alert=True)
-    
-    lang, lang_data = _get_lang_data(context)
-    if not CITIES:
-        return await query.edit_message_text("No cities configured. Please contact an admin.", parse_mode=None)
-    
-    sorted_city_ids = sorted(CITIES.keys(), key=lambda city_id: CITIES.get(city_id, ''))
-    keyboard = [[InlineKeyboardButton(f"🏙️ {CITIES.get(c,'N/A')}", callback_data=f"worker_bulk_dist|{c}")] for c in sorted_city_ids]
-    keyboard.append([InlineKeyboardButton("⬅️ Back", callback_data="worker_panel")])
-    
-    select_city_text = lang_data.get("admin_select_city", "Select City to Add Bulk Products:")
-    await query.edit_message_text(f"📦 Bulk Add Products\n\n{select_city_text}", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+    await _show_city_menu(update.callback_query, context, bulk=True, page=_page_param(params, 0))
 
+@worker_only(min_params=1, missing_msg="Error: City ID missing.")
+async def handle_worker_dist(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
+    """Worker district selection."""
+    await _show_district_menu(update.callback_query, context, params[0], bulk=False, page=_page_param(params, 1))
+
+@worker_only(min_params=1, missing_msg="Error: City ID missing.")
 async def handle_worker_bulk_dist(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Worker selects district for bulk products."""
-    query = update.callback_query
-    if not is_worker(query.from_user.id): 
-        return await query.answer("Access denied.", show_alert=True)
-    
-    if not params: 
-        return await query.answer("Error: City ID missing.", show_alert=True)
-    
-    city_id = params[0]
-    city_name = CITIES.get(city_id)
-    if not city_name:
-        return await query.edit_message_text("Error: City not found. Please select again.", parse_mode=None)
-    
-    districts_in_city = DISTRICTS.get(city_id, {})
-    lang, lang_data = _get_lang_data(context)
-    select_district_template = lang_data.get("admin_select_district", "Select District in {city}:")
-    
-    if not districts_in_city:
-        keyboard = [[InlineKeyboardButton("⬅️ Back to Cities", callback_data="worker_bulk_city")]]
-        return await query.edit_message_text(f"No districts found for {city_name}. Please contact an admin.",
-                                reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-    
-    sorted_district_ids = sorted(districts_in_city.keys(), key=lambda d_id: districts_in_city.get(d_id,''))
-    keyboard = []
-    for d in sorted_district_ids:
-        dist_name = districts_in_city.get(d)
-        if dist_name:
-            keyboard.append([InlineKeyboardButton(f"🏘️ {dist_name}", callback_data=f"worker_bulk_type|{city_id}|{d}")])
-        else: 
-            logger.warning(f"District name missing for ID {d} in city {city_id}")
-    
-    keyboard.append([InlineKeyboardButton("⬅️ Back to Cities", callback_data="worker_bulk_city")])
-    select_district_text = select_district_template.format(city=city_name)
-    await query.edit_message_text(select_district_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+    await _show_district_menu(update.callback_query, context, params[0], bulk=True, page=_page_param(params, 1))
 
+@worker_only(min_params=2, missing_msg="Error: City or District ID missing.")
+async def handle_worker_type(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
+    """Worker selects product type."""
+    await _show_type_menu(update.callback_query, context, params[0], params[1], bulk=False, page=_page_param(params, 2))
+
+@worker_only(min_params=2, missing_msg="Error: City or District ID missing.")
 async def handle_worker_bulk_type(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Worker selects product type for bulk products."""
-    query = update.callback_query
-    if not is_worker(query.from_user.id): 
-        return await query.answer("Access denied.", show_alert=True)
-    
-    if not params or len(params) < 2: 
-        return await query.answer("Error: City or District ID missing.", show_alert=True)
-    
-    city_id, dist_id = params[0], params[1]
-    city_name = CITIES.get(city_id)
-    district_name = DISTRICTS.get(city_id, {}).get(dist_id)
-    
-    if not city_name or not district_name:
-        return await query.edit_message_text("Error: City/District not found. Please select again.", parse_mode=None)
-    
-    lang, lang_data = _get_lang_data(context)
-    select_type_text = lang_data.get("admin_select_type", "Select Product Type:")
-    
-    if not PRODUCT_TYPES:
-        return await query.edit_message_text("No product types configured. Contact admin to add types.", parse_mode=None)
+    await _show_type_menu(update.callback_query, context, params[0], params[1], bulk=True, page=_page_param(params, 2))
 
-    keyboard = []
-    for type_name, emoji in sorted(PRODUCT_TYPES.items()):
-        keyboard.append([InlineKeyboardButton(f"{emoji} {type_name}", callback_data=f"worker_bulk_add|{city_id}|{dist_id}|{type_name}")])
-
-    keyboard.append([InlineKeyboardButton("⬅️ Back to Districts", callback_data=f"worker_bulk_dist|{city_id}")])
-    await query.edit_message_text(f"📦 Bulk Add Products - {city_name} / {district_name}\n\n{select_type_text}", 
-                                reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+@worker_only(min_params=3, missing_msg="Error: Location/Type info missing.")
+async def handle_worker_add(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
+    """Worker selects size for the new product."""
+    await _show_size_menu(update.callback_query, context, params[0], params[1], params[2], bulk=False)
 
+@worker_only(min_params=3, missing_msg="Error: Location/Type info missing.")
 async def handle_worker_bulk_add(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Worker selects size for the bulk products."""
-    query = update.callback_query
-    if not is_worker(query.from_user.id): 
-        return await query.answer("Access denied.", show_alert=True)
-    
-    if not params or len(params) < 3: 
-        return await query.answer("Error: Location/Type info missing.", show_alert=True)
-    
-    city_id, dist_id, p_type = params
-    city_name = CITIES.get(city_id)
-    district_name = DISTRICTS.get(city_id, {}).get(dist_id)
-    
-    if not city_name or not district_name:
-        return await query.edit_message_text("Error: City/District not found. Please select again.", parse_mode=None)
-    
-    type_emoji = PRODUCT_TYPES.get(p_type, DEFAULT_PRODUCT_EMOJI)
-    
-    # Store initial bulk product details (use same keys as admin for compatibility)
-    context.user_data["bulk_admin_city_id"] = city_id
-    context.user_data["bulk_admin_district_id"] = dist_id
-    context.user_data["bulk_admin_product_type"] = p_type
-    context.user_data["bulk_admin_city"] = city_name
-    context.user_data["bulk_admin_district"] = district_name
-    context.user_data["is_worker"] = True  # Flag to distinguish worker operations
-    
-    keyboard = [[InlineKeyboardButton(f"📏 {s}", callback_data=f"worker_bulk_size|{s}")] for s in SIZES]
-    keyboard.append([InlineKeyboardButton("📏 Custom Size", callback_data="worker_bulk_custom_size")])
-    keyboard.append([InlineKeyboardButton("⬅️ Back to Types", callback_data=f"worker_bulk_type|{city_id}|{dist_id}")])
-    
-    await query.edit_message_text(f"📦 Bulk Adding {type_emoji} {p_type} in {city_name} / {district_name}\n\nSelect size:", 
-                                reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
+    await _show_size_menu(update.callback_query, context, params[0], params[1], params[2], bulk=True)
 
+@worker_only(min_params=1, missing_msg="Error: Size missing.")
+async def handle_worker_size(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
+    """Handles selection of a predefined size."""
+    await _prompt_size_or_price(update.callback_query, context, params[0], bulk=False)
+
+@worker_only(min_params=1, missing_msg="Error: Size missing.")
 async def handle_worker_bulk_size(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles selection of a predefined size for bulk products."""
-    query = update.callback_query
-    if not is_worker(query.from_user.id): 
-        return await query.answer("Access denied.", show_alert=True)
-    
-    if not params: 
-        return await query.answer("Error: Size missing.", show_alert=True)
-    
-    size = params[0]
-    if not all(k in context.user_data for k in ["bulk_admin_city", "bulk_admin_district", "bulk_admin_product_type"]):
-        return await query.edit_message_text("❌ Error: Context lost. Please start adding the bulk products again.", parse_mode=None)
-    
-    context.user_data["bulk_pending_drop_size"] = size
-    context.user_data["state"] = "awaiting_bulk_price"
-    
-    keyboard = [[InlineKeyboardButton("❌ Cancel Bulk Add", callback_data="worker_cancel_bulk_add")]]
-    await query.edit_message_text(f"📦 Bulk Products - Size set to {size}. Please reply with the price (e.g., 12.50 or 12.5):",
-                            reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-    await query.answer("Enter price in chat.")
+    await _prompt_size_or_price(update.callback_query, context, params[0], bulk=True)
 
+@worker_only()
+async def handle_worker_custom_size(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
+    """Handles 'Custom Size' button press."""
+    await _prompt_size_or_price(update.callback_query, context, None, bulk=False)
+
+@worker_only()
 async def handle_worker_bulk_custom_size(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Handles 'Custom Size' button press for bulk products."""
+    await _prompt_size_or_price(update.callback_query, context, None, bulk=True)
+
+async def handle_close_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
+    """Close menu."""
     query = update.callback_query
-    if not is_worker(query.from_user.id): 
-        return await query.answer("Access denied.", show_alert=True)
-    
-    if not all(k in context.user_data for k in ["bulk_admin_city", "bulk_admin_district", "bulk_admin_product_type"]):
-        return await query.edit_message_text("❌ Error: Context lost. Please start adding the bulk products again.", parse_mode=None)
-    
-    context.user_data["state"] = "awaiting_bulk_custom_size"
-    keyboard = [[InlineKeyboardButton("❌ Cancel Bulk Add", callback_data="worker_cancel_bulk_add")]]
-    await query.edit_message_text("📦 Bulk Products - Please reply with the custom size (e.g., 10g, 1/4 oz):",
-                            reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=None)
-    await query.answer("Enter custom size in chat.")
+    if query:
+        try:
+            await query.delete_message()
+        except telegram_error.BadRequest as e:
+            # Usually already deleted (double tap) or too old to delete; no need for another API call
+            logger.debug(f"Could not delete closed menu: {e}")
 
 # --- Worker Bulk Message Management (Compatible with Admin Flow) ---
+@worker_only()
 async def handle_worker_bulk_create_all(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Worker version of create all bulk products."""
     query = update.callback_query
-    user_id = query.from_user.id
-    
-    if not is_worker(user_id): 
-        return await query.answer("Access denied.", show_alert=True)
-    
     # Reuse the admin bulk execute function but with worker context
-    from admin import handle_adm_bulk_execute
-    
-    # Set worker flag
     context.user_data["is_worker"] = True
     
     try:
@@ -394,91 +381,71 @@ async def handle_worker_bulk_create_all(update: Update, context: ContextTypes.DE
         logger.error(f"Error in worker bulk create: {e}")
         await query.answer("❌ Error creating bulk drops. Please try again.", show_alert=True)
 
+@worker_only()
 async def handle_worker_bulk_remove_last_message(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Worker version of remove last bulk message."""
     query = update.callback_query
-    user_id = query.from_user.id
-    
-    if not is_worker(user_id): 
-        return await query.answer("Access denied.", show_alert=True)
-    
-    from admin import handle_adm_bulk_remove_last_message
     context.user_data["is_worker"] = True
     await handle_adm_bulk_remove_last_message(update, context, params)
 
+@worker_only()
 async def handle_worker_bulk_back_to_management(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Worker version of back to bulk management."""
     query = update.callback_query
-    user_id = query.from_user.id
-    
-    if not is_worker(user_id): 
-        return await query.answer("Access denied.", show_alert=True)
-    
-    from admin import show_bulk_messages_status
     context.user_data["is_worker"] = True
     await show_bulk_messages_status(update, context)
 
 # --- Worker Cancel Functions ---
+# user_data keys of the single drop flow, dropped on cancel
+_CANCEL_ADD_KEYS = _DROP_PENDING_KEYS + _DROP_LOCATION_KEYS + _DROP_MEDIA_GROUP_KEYS + ("is_worker",)
+
+def _log_temp_dir_cleanup(task: asyncio.Task, temp_dir_path: str):
+    """Done-callback for the background temp dir removal on cancel."""
+    if task.cancelled(): return
+    error = task.exception()
+    if error: logger.error(f"Error cleaning temp dir {temp_dir_path}: {error}")
+    else: logger.info(f"Cleaned temp dir on worker cancel: {temp_dir_path}")
+
+@worker_only()
 async def handle_worker_cancel_add(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Cancels the worker add product flow and cleans up."""
     query = update.callback_query
     user_id = update.effective_user.id
     
-    if not is_worker(user_id):
-        return await query.answer("Access denied.", show_alert=True)
-    
     # Use same cleanup logic as admin cancel but route back to worker panel
     user_specific_data = context.user_data
     pending_drop = user_specific_data.get("pending_drop")
     
     if pending_drop and "temp_dir" in pending_drop and pending_drop["temp_dir"]:
         temp_dir_path = pending_drop["temp_dir"]
-        if await asyncio.to_thread(os.path.exists, temp_dir_path):
-            try: 
-                await asyncio.to_thread(shutil.rmtree, temp_dir_path, ignore_errors=True)
-                logger.info(f"Cleaned temp dir on worker cancel: {temp_dir_path}")
-            except Exception as e: 
-                logger.error(f"Error cleaning temp dir {temp_dir_path}: {e}")
+        # Delete in the background so the cancel reply isn't held up by the rmtree (missing dirs are ignored)
+        cleanup_task = asyncio.create_task(asyncio.to_thread(shutil.rmtree, temp_dir_path, ignore_errors=True))
+        cleanup_task.add_done_callback(lambda t, path=temp_dir_path: _log_temp_dir_cleanup(t, path))
     
-    keys_to_clear = ["state", "pending_drop", "pending_drop_size", "pending_drop_price", "admin_city_id", 
-                     "admin_district_id", "admin_product_type", "admin_city", "admin_district", 
-                     "collecting_media_group_id", "collected_media", "is_worker"]
-    for key in keys_to_clear: 
+    # Taken before the sweep below, which would otherwise drop it before the job is looked up
+    media_group_id = user_specific_data.pop('collecting_media_group_id', None)
+    for key in _CANCEL_ADD_KEYS: 
         user_specific_data.pop(key, None)
     
-    if 'collecting_media_group_id' in user_specific_data:
-        media_group_id = user_specific_data.pop('collecting_media_group_id', None)
-        if media_group_id: 
-            # Import here to avoid circular imports
-            from admin import remove_job_if_exists
-            job_name = f"process_media_group_{user_id}_{media_group_id}"
-            remove_job_if_exists(job_name, context)
+    if media_group_id: 
+        job_name = f"process_media_group_{user_id}_{media_group_id}"
+        remove_job_if_exists(job_name, context)
     
     try:
-        await query.edit_message_text("❌ Add Product Cancelled", parse_mode=None)
+        await safe_edit(query, "❌ Add Product Cancelled")
     except telegram_error.BadRequest as e:
-        if "message is not modified" in str(e).lower():
-            pass  # It's okay if the message wasn't modified
-        else:
-            logger.error(f"Error editing cancel message: {e}")
+        logger.error(f"Error editing cancel message: {e}")
     
-    keyboard = [[InlineKeyboardButton("👷 Worker Panel", callback_data="worker_panel")]]
     await send_message_with_retry(context.bot, query.message.chat_id, "Returning to Worker Panel.", 
-                                reply_markup=InlineKeyboardMarkup(keyboard))
+                                reply_markup=WORKER_PANEL_MARKUP)
 
+@worker_only()
 async def handle_worker_cancel_bulk_add(update: Update, context: ContextTypes.DEFAULT_TYPE, params=None):
     """Cancels the worker bulk add flow."""
     query = update.callback_query
     user_id = update.effective_user.id
     
-    if not is_worker(user_id):
-        return await query.answer("Access denied.", show_alert=True)
-    
     # Use admin cancel bulk function but adjust routing
-    from admin import cancel_bulk_add
-    
-    # Store original context
-    original_context = context.user_data.copy()
     context.user_data["is_worker"] = True
     
     try:
@@ -488,9 +455,8 @@ async def handle_worker_cancel_bulk_add(update: Update, context: ContextTypes.DE
     
     # Override the final routing to worker panel
     try:
-        keyboard = [[InlineKeyboardButton("👷 Worker Panel", callback_data="worker_panel")]]
         await send_message_with_retry(context.bot, query.message.chat_id, "Bulk operation cancelled. Returning to Worker Panel.", 
-                                    reply_markup=InlineKeyboardMarkup(keyboard))
+                                    reply_markup=WORKER_PANEL_MARKUP)
     except Exception as e:
         logger.error(f"Error sending worker cancel bulk message: {e}")
 